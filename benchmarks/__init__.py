@@ -0,0 +1,12 @@
+"""オフラインで動かすベンチマーク類
+
+``pipenv run python -m benchmarks.<name>`` で実行する。
+"""
+
+import os
+
+# .env が無くても planetsclub.settings を読み込めるようにする
+os.environ.setdefault("SECRET_KEY", "benchmark")
+os.environ.setdefault("REDIS_URL", "redis://localhost")
+os.environ.setdefault("ELASTICSEARCH_HOSTS", "localhost")
+os.environ.setdefault("ELASTICSEARCH_HTTP_AUTH", "elastic:elastic")
@@ -0,0 +1,80 @@
+"""GraphQL 文書キャッシュの効果
+
+フロントエンドが送る代表的な操作について、parse + validate を毎回行う場合（cold）と
+DocumentCache から取り出す場合（warm）の所要時間を比べる。
+リポジトリのルートで実行すること（schema.graphql を読み込むため）。
+"""
+
+import time
+
+from planetsclub.graphql import _make_executable_schema
+from planetsclub.graphql.server import DocumentCache
+
+N = 2000
+
+OPERATIONS = {
+    "archiveItems": """
+        query ArchiveItems($q: String, $first: Int, $after: String) {
+          archiveItems(q: $q, first: $first, after: $after) {
+            hasNextPage
+            hasPreviousPage
+            startCursor
+            endCursor
+            totalCount
+            totalCountRel
+            items {
+              id
+              title
+              type
+              series
+              description
+              tags
+              privacy
+              thumbnailUrl
+              bodyHighlights
+              publishedAt
+              createdAt
+              updatedAt
+              createdBy { id realName pictureUri }
+              updatedBy { id realName pictureUri }
+            }
+          }
+        }
+    """,
+    "archiveItem": """
+        query ArchiveItem($id: ID!) {
+          archiveItem(id: $id) {
+            id title type series body htmlContent length tags privacy
+            source sourceId thumbnailUrl publishedAt createdAt updatedAt
+            createdBy { id realName } updatedBy { id realName }
+          }
+        }
+    """,
+    "me": "query Me { me { id isAuthenticated isActive isAdmin realName pictureUri } }",
+}
+
+
+def main():
+    schema = _make_executable_schema()
+    for (name, query) in OPERATIONS.items():
+        start = time.perf_counter()
+        for _ in range(N):
+            DocumentCache(schema, 1).parse_and_validate(query)
+        cold = (time.perf_counter() - start) / N
+
+        cache = DocumentCache(schema, 16)
+        cache.parse_and_validate(query)
+        start = time.perf_counter()
+        for _ in range(N):
+            cache.parse_and_validate(query)
+        warm = (time.perf_counter() - start) / N
+
+        print(
+            "{:<14} cold {:8.1f} us   warm {:6.1f} us   x{:.0f}".format(
+                name, cold * 1e6, warm * 1e6, cold / warm
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
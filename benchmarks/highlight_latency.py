@@ -0,0 +1,70 @@
+"""archiveItems の検索にかかる時間をハイライトの有無・方式ごとに比べる
+
+代用品の ES はハイライトしないので、settings の ES（本番相当のデータを入れた
+検証用のクラスタ）に対して ArchiveModel.get_archives を実行する。
+
+    python -m benchmarks.highlight_latency 宇宙 惑星 "対談 AND 文化"
+
+fvh を比べるには index の body に term_vector: with_positions_offsets が
+必要（ArchiveModel.ES_MAPPINGS）。無い index では fvh の行はエラーになる。
+"""
+
+import asyncio
+import sys
+import time
+
+from starlette.authentication import AuthCredentials
+
+from planetsclub import settings
+from planetsclub.archives.models import ArchiveModel
+from planetsclub.services import create_elasticsearch, services
+from planetsclub.services.elasticsearch import page_boundaries
+from planetsclub.users.base import UnauthenticatedUser
+from tests.fakes import FakeRedis
+
+ROUNDS = 20
+PAGE_SIZE = 50
+CASES = [("no highlight", None), ("unified", "unified"), ("fvh", "fvh")]
+
+
+async def measure(queries, highlighter):
+    if highlighter is not None:
+        settings.ES_HIGHLIGHTER = highlighter
+    (user, auth) = (UnauthenticatedUser(), AuthCredentials())
+    latencies = []
+    for _ in range(ROUNDS):
+        for q in queries:
+            started = time.perf_counter()
+            await ArchiveModel.get_archives(
+                user, auth, q=q, first=PAGE_SIZE, highlight=highlighter is not None
+            )
+            latencies.append(time.perf_counter() - started)
+    latencies.sort()
+    return (latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.95)])
+
+
+async def main(queries):
+    services.es = create_elasticsearch()
+    # ページ境界のキャッシュは Redis の代用品で済ませる
+    services.redis_pool = FakeRedis()
+    page_boundaries.ttl = 0
+    try:
+        # 最初の検索は index のキャッシュを温めるだけ
+        await measure(queries, None)
+        for (name, highlighter) in CASES:
+            try:
+                (p50, p95) = await measure(queries, highlighter)
+            except Exception as e:
+                print("{:<14} error: {}".format(name, e))
+                continue
+            print(
+                "{:<14} p50 {:7.1f} ms   p95 {:7.1f} ms".format(
+                    name, p50 * 1000, p95 * 1000
+                )
+            )
+    finally:
+        await services.es.transport.close()
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(main(sys.argv[1:] or ["宇宙"]))
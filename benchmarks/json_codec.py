@@ -0,0 +1,124 @@
+"""JSON コーデックごとの archiveItems レスポンスの符号化と ES の応答の復号の時間
+
+starlette の JSONResponse（標準の json）と、使えるコーデックの dumps_native を比べる。
+bodyHighlights を含む 100 件のページと、それに相当する ES の応答を使う。
+"""
+
+import time
+
+from starlette.responses import JSONResponse
+
+from planetsclub.services import CustomJSONSerializer
+from planetsclub.services.jsoncodec import get_codec, orjson, ujson
+
+ITEMS = 100
+N = 200
+
+HIGHLIGHT = "… 第{}回の放送では<em>宇宙</em>開発と<em>惑星</em>探査の最新の話題を取り上げ、…"
+
+
+def make_page():
+    items = []
+    for i in range(ITEMS):
+        items.append(
+            {
+                "id": "item{}".format(i),
+                "title": "PLANETS アーカイブ 第{}回".format(i),
+                "type": "video",
+                "series": "PLANETS Radio",
+                "description": "宇宙と惑星についての対談。" * 8,
+                "tags": ["宇宙", "惑星", "対談"],
+                "privacy": "PUBLIC",
+                "thumbnailUrl": "https://example.com/thumbs/{}.jpg".format(i),
+                "bodyHighlights": [HIGHLIGHT.format(i + k) for k in range(3)],
+                "publishedAt": "2019-07-01T10:00:00.000+00:00",
+                "createdAt": "2019-07-01T10:00:00.123+00:00",
+                "updatedAt": "2019-07-02T11:30:00.123+00:00",
+                "createdBy": {"id": "u1", "realName": "山田 太郎"},
+                "updatedBy": {"id": "u2", "realName": "佐藤 花子"},
+            }
+        )
+    return {
+        "data": {
+            "archiveItems": {
+                "hasNextPage": True,
+                "hasPreviousPage": False,
+                "startCursor": "kgGjaXRlbTA",
+                "endCursor": "kgGkaXRlbTk5",
+                "totalCount": 1234,
+                "totalCountRel": "eq",
+                "items": items,
+            }
+        }
+    }
+
+
+def make_es_response(page):
+    hits = []
+    for item in page["data"]["archiveItems"]["items"]:
+        hits.append(
+            {
+                "_index": "planets-archive",
+                "_id": item["id"],
+                "_score": None,
+                "_source": {
+                    "title": item["title"],
+                    "type": item["type"],
+                    "series": item["series"],
+                    "description": item["description"],
+                    "tags": item["tags"],
+                    "privacy": "public",
+                    "thumbnail_url": item["thumbnailUrl"],
+                    "published_at": item["publishedAt"],
+                    "created_at": item["createdAt"],
+                    "updated_at": item["updatedAt"],
+                },
+                "highlight": {"body": item["bodyHighlights"]},
+                "sort": [1561975200123, item["id"]],
+            }
+        )
+    return {"took": 3, "hits": {"total": {"value": 1234}, "hits": hits}}
+
+
+def timeit(fn, arg) -> float:
+    start = time.perf_counter()
+    for _ in range(N):
+        fn(arg)
+    return (time.perf_counter() - start) / N * 1e6
+
+
+def main():
+    page = make_page()
+    es_response = get_codec("json").dumps_native(make_es_response(page))
+    print(
+        "page {:.0f} KiB, ES response {:.0f} KiB".format(
+            len(JSONResponse(page).body) / 1024, len(es_response) / 1024
+        )
+    )
+
+    print(
+        "{:<22} {:>9.0f} us".format(
+            "starlette JSONResponse", timeit(lambda p: JSONResponse(p).body, page)
+        )
+    )
+    names = ["json"] + [n for (n, m) in [("ujson", ujson), ("orjson", orjson)] if m]
+    for name in names:
+        codec = get_codec(name)
+        print(
+            "{:<22} {:>9.0f} us   loads ES {:>6.0f} us".format(
+                name + " dumps_native",
+                timeit(codec.dumps_native, page),
+                timeit(codec.loads, es_response),
+            )
+        )
+
+    serializer = CustomJSONSerializer()
+    print(
+        "{:<22} {:>9.0f} us".format(
+            "ES serializer loads", timeit(serializer.loads, es_response)
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,424 @@
+"""planetsclub:app の負荷試験
+
+tests.fakes の Elasticsearch / Redis の代用品にアーカイブとユーザのコーパスを入れ、
+``planetsclub:app`` を ASGI で直接呼び出して GraphQL の操作を再生する。
+操作の組み合わせは NDJSON（1 行が 1 つの GraphQL リクエストの body に
+``weight``、``user``、``walk`` を加えたもの）で与える。既定は load_mix.ndjson。
+
+    SECRET_KEY=x REDIS_URL=redis://localhost ELASTICSEARCH_HOSTS=localhost \\
+        ELASTICSEARCH_HTTP_AUTH=a:b python -m benchmarks.load_test
+
+req/s、p50/p95/p99、リクエストあたりの ES / Redis の呼び出し回数を表示し、
+結果を .benchmarks/load_test/ に保存する。前回（または --baseline）の結果より
+p95 が --tolerance を超えて遅くなったり、バックエンドの呼び出しが増えたりした
+場合は終了コード 1 で終わる。レスポンスキャッシュは --response-cache を付けた
+ときだけ使う。
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+import jwt
+
+from planetsclub import app, settings
+from planetsclub.archives.models import ArchiveModel, _set_suggest_input
+from planetsclub.graphql.server import GraphQLServer
+from planetsclub.services import services
+from planetsclub.services.indices import index_name
+from planetsclub.users.models import UserModel
+from tests.fakes import FakeElasticsearch, FakeRedis
+
+MIX_PATH = os.path.join(os.path.dirname(__file__), "load_mix.ndjson")
+RESULTS_DIR = os.path.join(".benchmarks", "load_test")
+
+WORDS = ["宇宙", "惑星", "対談", "文化", "批評", "アニメ", "都市", "テクノロジー", "政治", "食"]
+
+
+def seed(es: FakeElasticsearch, archives: int, users: int, rng: random.Random):
+    """アーカイブとユーザのコーパスを入れ、それぞれの id の一覧を返す"""
+    base = datetime(2019, 1, 1, tzinfo=timezone.utc)
+    user_ids = ["user{}".format(i) for i in range(users)]
+    for (i, id) in enumerate(user_ids):
+        es.add(
+            UserModel.ES_INDEX,
+            id,
+            {
+                "real_name": "ユーザ {}".format(i),
+                "email": "user{}@example.com".format(i),
+                "picture_uri": "https://example.com/u/{}.png".format(i),
+                "is_admin": i == 0,
+                "created_at": (base + timedelta(hours=i)).isoformat(),
+            },
+        )
+
+    archive_ids = ["item{}".format(i) for i in range(archives)]
+    for (i, id) in enumerate(archive_ids):
+        created = (base + timedelta(minutes=7 * i)).isoformat()
+        words = rng.sample(WORDS, 3)
+        body = "".join(w + "についての対談。" for w in words) * 60
+        data = {
+            "title": "PLANETS アーカイブ 第{}回 {}".format(i, words[0]),
+            "type": rng.choice(["video", "article", "podcast"]),
+            "series": rng.choice(["PLANETS Radio", "遅いインターネット", "月刊"]),
+            "description": body[:200],
+            "body": body,
+            "html_content": "<p>{}</p>".format(body),
+            "tags": words,
+            "privacy": rng.choice(["public", "club"]),
+            "thumbnail_url": "https://example.com/thumbs/{}.jpg".format(i),
+            "length": rng.randint(600, 7200),
+            "published_at": created,
+            "created_at": created,
+            "updated_at": created,
+            "created_by": rng.choice(user_ids),
+            "updated_by": rng.choice(user_ids),
+        }
+        _set_suggest_input(data)
+        es.add(ArchiveModel.ES_INDEX, id, data)
+    # 移行済み（宣言された版の index を指している）とする
+    es.indices.aliases[ArchiveModel.ES_INDEX] = index_name(ArchiveModel)
+    return (archive_ids, user_ids)
+
+
+def graphql_server() -> GraphQLServer:
+    for route in app.routes:
+        if isinstance(getattr(route, "app", None), GraphQLServer):
+            return route.app
+    raise RuntimeError("GraphQLServer is not mounted")
+
+
+def load_mix(path: str) -> List[dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def session_cookies(user_ids: List[str]) -> Dict[str, Optional[bytes]]:
+    """閲覧者の区分ごとの Cookie（クレームが最新なので ES を見ずに認証される）"""
+
+    def cookie(id: str, admin: bool) -> bytes:
+        token = jwt.encode(
+            {"sub": id, "scope": [], "act": True, "adm": admin, "ver": 0},
+            settings.SECRET_KEY,
+        )
+        return b"token=" + token
+
+    return {
+        "anonymous": None,
+        "member": cookie(user_ids[1], False),
+        "admin": cookie(user_ids[0], True),
+    }
+
+
+async def post_graphql(body: bytes, cookie: Optional[bytes]) -> dict:
+    """ASGI の http リクエストとして /api/graphql/ に POST する"""
+    headers = [(b"content-type", b"application/json")]
+    if cookie is not None:
+        headers.append((b"cookie", cookie))
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/api/graphql/",
+        "root_path": "",
+        "query_string": b"",
+        "headers": headers,
+        "client": ("127.0.0.1", 50000),
+        "server": ("testserver", 80),
+    }
+    sent = False
+    (status, chunks) = (None, [])
+
+    async def receive():
+        nonlocal sent
+        if sent:
+            await asyncio.sleep(3600)
+        sent = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+
+    await app(scope, receive, send)
+    result = json.loads(b"".join(chunks))
+    if status != 200 or result.get("errors"):
+        raise RuntimeError("{} {}".format(status, result.get("errors")))
+    return result
+
+
+class Replayer:
+    def __init__(self, mix: List[dict], archive_ids: List[str], cookies, seed=0):
+        self.mix = mix
+        self.archive_ids = archive_ids
+        self.cookies = cookies
+        self.rng = random.Random(seed)
+        self.weights = [entry.get("weight", 1) for entry in mix]
+
+    def name(self, entry: dict) -> str:
+        name = entry.get("operationName") or "anonymous"
+        if entry.get("walk"):
+            name += " (walk)"
+        return "{} [{}]".format(name, entry.get("user", "anonymous"))
+
+    def _variables(self, entry: dict) -> Dict[str, Any]:
+        variables = dict(entry.get("variables") or {})
+        for (k, v) in variables.items():
+            if v == "$archive":
+                variables[k] = self.rng.choice(self.archive_ids)
+        return variables
+
+    async def run(self, entry: dict) -> int:
+        """1 つの操作を実行し、送ったリクエストの数を返す（walk はページ数）"""
+        variables = self._variables(entry)
+        cookie = self.cookies[entry.get("user", "anonymous")]
+        walk = entry.get("walk") or {}
+        requests = 0
+        while requests < walk.get("pages", 1):
+            requests += 1
+            body = {
+                "query": entry["query"],
+                "operationName": entry.get("operationName"),
+                "variables": variables,
+            }
+            result = await post_graphql(json.dumps(body).encode("utf-8"), cookie)
+            if not walk:
+                break
+            connection = result["data"][walk["field"]]
+            if not connection["hasNextPage"]:
+                break
+            variables = dict(variables, after=connection["endCursor"])
+        return requests
+
+    def choose(self) -> dict:
+        return self.rng.choices(self.mix, self.weights)[0]
+
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    k = min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[k]
+
+
+def summarize(latencies: List[float]) -> Dict[str, float]:
+    return {
+        "count": len(latencies),
+        "p50": percentile(latencies, 50) * 1000,
+        "p95": percentile(latencies, 95) * 1000,
+        "p99": percentile(latencies, 99) * 1000,
+    }
+
+
+async def calibrate(replayer: Replayer, es, redis) -> Dict[str, Dict[str, float]]:
+    """操作ごとのリクエストあたりのバックエンドの呼び出し回数（1 つずつ順に実行）"""
+    calls = {}
+    for entry in replayer.mix:
+        (es_before, redis_before) = (es.requests, redis.commands)
+        requests = await replayer.run(entry)
+        calls[replayer.name(entry)] = {
+            "es": (es.requests - es_before) / requests,
+            "redis": (redis.commands - redis_before) / requests,
+        }
+    return calls
+
+
+async def load(replayer: Replayer, total: int, concurrency: int, es, redis) -> dict:
+    latencies: Dict[str, List[float]] = {}
+    state = {"remaining": total, "requests": 0}
+
+    async def worker():
+        while state["remaining"] > 0:
+            state["remaining"] -= 1
+            entry = replayer.choose()
+            started = time.perf_counter()
+            requests = await replayer.run(entry)
+            elapsed = time.perf_counter() - started
+            state["requests"] += requests
+            latencies.setdefault(replayer.name(entry), []).append(elapsed / requests)
+
+    (es_before, redis_before) = (es.requests, redis.commands)
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+
+    requests = state["requests"]
+    return {
+        "requests": requests,
+        "seconds": elapsed,
+        "rps": requests / elapsed,
+        "es_per_request": (es.requests - es_before) / requests,
+        "redis_per_request": (redis.commands - redis_before) / requests,
+        "all": summarize([v for values in latencies.values() for v in values]),
+        "operations": {
+            name: summarize(values) for (name, values) in sorted(latencies.items())
+        },
+    }
+
+
+def report(result: dict, out=sys.stdout):
+    load = result["load"]
+    print(
+        "{} requests in {:.2f}s: {:.0f} req/s, ES {:.2f}/req, Redis {:.2f}/req".format(
+            load["requests"],
+            load["seconds"],
+            load["rps"],
+            load["es_per_request"],
+            load["redis_per_request"],
+        ),
+        file=out,
+    )
+    print(
+        "{:<34} {:>6} {:>8} {:>8} {:>8} {:>6} {:>6}".format(
+            "operation", "count", "p50 ms", "p95 ms", "p99 ms", "ES", "Redis"
+        ),
+        file=out,
+    )
+    rows = [("all", load["all"], None)] + [
+        (name, s, result["calls"].get(name)) for (name, s) in load["operations"].items()
+    ]
+    for (name, s, calls) in rows:
+        print(
+            "{:<34} {:>6} {:>8.2f} {:>8.2f} {:>8.2f} {:>6} {:>6}".format(
+                name,
+                s["count"],
+                s["p50"],
+                s["p95"],
+                s["p99"],
+                "{:.1f}".format(calls["es"]) if calls else "",
+                "{:.1f}".format(calls["redis"]) if calls else "",
+            ),
+            file=out,
+        )
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> List[str]:
+    """baseline からの悪化を列挙する"""
+    regressions = []
+    if result["config"] != baseline.get("config"):
+        print("warning: the baseline was recorded with a different configuration")
+
+    base_ops = baseline["load"]["operations"]
+    for (name, s) in result["load"]["operations"].items():
+        base = base_ops.get(name)
+        if base and s["p95"] > base["p95"] * (1 + tolerance):
+            regressions.append(
+                "{}: p95 {:.2f} ms -> {:.2f} ms".format(name, base["p95"], s["p95"])
+            )
+    for (name, calls) in result["calls"].items():
+        base = baseline["calls"].get(name)
+        if base is None:
+            continue
+        for backend in ("es", "redis"):
+            if calls[backend] > base[backend] + 0.01:
+                regressions.append(
+                    "{}: {} calls/req {:.2f} -> {:.2f}".format(
+                        name, backend, base[backend], calls[backend]
+                    )
+                )
+    return regressions
+
+
+def latest_result(directory: str) -> Optional[str]:
+    if not os.path.isdir(directory):
+        return None
+    names = sorted(n for n in os.listdir(directory) if n.endswith(".json"))
+    return os.path.join(directory, names[-1]) if names else None
+
+
+async def run(args) -> dict:
+    rng = random.Random(args.seed)
+    es = FakeElasticsearch(latency=args.es_latency)
+    redis = FakeRedis(latency=args.redis_latency)
+    (archive_ids, user_ids) = seed(es, args.archives, args.users, rng)
+    (services.es, services.redis_pool) = (es, redis)
+    # 既定ではレスポンスキャッシュを使わず、リゾルバとモデルの変化がそのまま現れるようにする
+    graphql_server().response_cache.ttl = (
+        settings.GRAPHQL_RESPONSE_CACHE_TTL if args.response_cache else 0
+    )
+
+    replayer = Replayer(
+        load_mix(args.mix), archive_ids, session_cookies(user_ids), args.seed
+    )
+    # 1 回目で温まる文書キャッシュやユーザキャッシュを除いて数える
+    await calibrate(replayer, es, redis)
+    calls = await calibrate(replayer, es, redis)
+    load_result = await load(replayer, args.requests, args.concurrency, es, redis)
+    return {
+        "time": datetime.now(timezone.utc).isoformat(),
+        "config": {
+            k: getattr(args, k)
+            for k in (
+                "mix",
+                "requests",
+                "concurrency",
+                "archives",
+                "users",
+                "es_latency",
+                "redis_latency",
+                "seed",
+                "response_cache",
+            )
+        },
+        "calls": calls,
+        "load": load_result,
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.load_test")
+    parser.add_argument("--mix", default=MIX_PATH)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--archives", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--es-latency", type=float, default=0.002)
+    parser.add_argument("--redis-latency", type=float, default=0.0002)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--response-cache", action="store_true")
+    parser.add_argument("--results-dir", default=RESULTS_DIR)
+    parser.add_argument("--baseline", help="比較する結果（既定は前回の結果）")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--no-save", action="store_true")
+    args = parser.parse_args(argv)
+
+    baseline_path = args.baseline or latest_result(args.results_dir)
+    result = asyncio.get_event_loop().run_until_complete(run(args))
+    report(result)
+
+    if not args.no_save:
+        os.makedirs(args.results_dir, exist_ok=True)
+        path = os.path.join(
+            args.results_dir,
+            datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ") + ".json",
+        )
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print("saved", path)
+
+    if baseline_path is None:
+        return 0
+    with open(baseline_path, encoding="utf-8") as f:
+        regressions = compare(result, json.load(f), args.tolerance)
+    if regressions:
+        print("regressions against", baseline_path)
+        for line in regressions:
+            print("  " + line)
+        return 1
+    print("no regressions against", baseline_path)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,98 @@
+"""2000 件のページを ArchiveModel にして各フィールドを読むときの CPU 時間とメモリ
+
+__dict__ を持ち、日時を毎回 dateutil で読む以前の形（legacy）と今の ArchiveModel を比べる。
+メモリは tracemalloc で測ったもので、models はモデルを作った直後、
+peak はフィールドの解決まで（ArchiveModel では変換した値を覚えておく分を含む）。
+"""
+
+import time
+import tracemalloc
+
+import dateutil.parser
+
+from planetsclub.archives.models import ArchiveModel
+
+N = 2000
+ROUNDS = 5
+
+FIELDS = [
+    "title",
+    "type",
+    "series",
+    "description",
+    "tags",
+    "privacy",
+    "thumbnail_url",
+    "published_at",
+    "created_at",
+    "updated_at",
+]
+
+
+class LegacyArchiveModel(ArchiveModel):
+    # __slots__ を宣言しないので __dict__ を持つ
+
+    def _datetime(self, name):
+        v = self._data.get(name)
+        return dateutil.parser.parse(v) if v else None
+
+
+def make_hits():
+    return [
+        {
+            "_id": "item{}".format(i),
+            "_source": {
+                "title": "タイトル {}".format(i),
+                "type": "video",
+                "series": "シリーズ",
+                "description": "説明" * 20,
+                "tags": ["tag1", "tag2"],
+                "privacy": "public",
+                "thumbnail_url": "https://example.com/{}.jpg".format(i),
+                "published_at": "2019-07-01T10:00:00.000Z",
+                "created_at": "2019-07-01T10:00:00.123456+00:00",
+                "updated_at": "2019-07-02T11:30:00.123456+00:00",
+            },
+        }
+        for i in range(N)
+    ]
+
+
+def build(cls, hits):
+    return [cls(hit["_id"], data=hit["_source"]) for hit in hits]
+
+
+def resolve(items):
+    for item in items:
+        for field in FIELDS:
+            getattr(item, field)
+        # DateTime スカラーの直列化などで同じフィールドがもう一度読まれる
+        item.created_at
+        item.updated_at
+
+
+def main():
+    hits = make_hits()
+    for cls in (LegacyArchiveModel, ArchiveModel):
+        start = time.perf_counter()
+        for _ in range(ROUNDS):
+            resolve(build(cls, hits))
+        elapsed = (time.perf_counter() - start) / ROUNDS
+
+        tracemalloc.start()
+        items = build(cls, hits)
+        (built, _) = tracemalloc.get_traced_memory()
+        resolve(items)
+        (_, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del items
+
+        print(
+            "{:<20} {:7.1f} ms/page   models {:6.1f} KiB   peak {:6.1f} KiB".format(
+                cls.__name__, elapsed * 1000, built / 1024, peak / 1024
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
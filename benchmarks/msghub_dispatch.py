@@ -0,0 +1,93 @@
+"""MessageHub のディスパッチ性能
+
+10k 件の購読がある状態で、深いトピックのメッセージを振り分けるコストを測る。
+比較のため、トピック名の前方一致文字列を毎回組み立てていた以前の実装も計測する。
+"""
+
+import asyncio
+import time
+import weakref
+
+from planetsclub.services.msghub import MessageHub
+
+N_SUBSCRIPTIONS = 10000
+N_MESSAGES = 100000
+DEPTH = 8
+
+
+def _legacy_match(subs, topic):
+    def gen_topic_name():
+        yield "*"
+        nodes = topic.split(".")
+        for i in range(1, len(nodes) + 1):
+            yield ".".join(nodes[:i]) + ".*"
+        yield topic
+
+    all_queues = set()
+    for to in gen_topic_name():
+        queues = subs.get(to)
+        if queues:
+            all_queues.update(queues)
+    return all_queues
+
+
+def _patterns():
+    for i in range(N_SUBSCRIPTIONS):
+        nodes = ["archives", "item{}".format(i % 500)] + [
+            "n{}".format(j) for j in range(i % (DEPTH - 1))
+        ]
+        yield ".".join(nodes) + (".*" if i % 3 == 0 else "")
+
+
+def _topics():
+    return [
+        ".".join(
+            ["archives", "item{}".format(i % 500)]
+            + ["n{}".format(j) for j in range(DEPTH - 2)]
+        )
+        for i in range(1000)
+    ]
+
+
+def _bench(name, fn, topics):
+    start = time.perf_counter()
+    delivered = 0
+    for i in range(N_MESSAGES):
+        delivered += len(fn(topics[i % len(topics)]))
+    elapsed = time.perf_counter() - start
+    print(
+        "{:<8} {:8.2f} us/msg  ({} deliveries)".format(
+            name, elapsed / N_MESSAGES * 1e6, delivered
+        )
+    )
+
+
+def main():
+    hub = MessageHub()
+    legacy = {}
+    subscriptions = []
+    for pattern in _patterns():
+        sub = hub.subscribe(pattern)
+        subscriptions.append(sub)
+        legacy.setdefault(pattern, weakref.WeakSet()).add(sub)
+
+    topics = _topics()
+    print(
+        "{} subscriptions, {} messages, topic depth {}".format(
+            N_SUBSCRIPTIONS, N_MESSAGES, DEPTH
+        )
+    )
+    _bench("legacy", lambda t: _legacy_match(legacy, t), topics)
+    _bench("trie", hub._registry.match, topics)
+
+    # 実際のディスパッチ（キューへの投入を含む）
+    loop = asyncio.get_event_loop()
+    start = time.perf_counter()
+    for i in range(N_MESSAGES // 10):
+        loop.run_until_complete(hub._process_msg(topics[i % len(topics)], None))
+    elapsed = time.perf_counter() - start
+    print("dispatch {:8.2f} us/msg".format(elapsed / (N_MESSAGES // 10) * 1e6))
+
+
+if __name__ == "__main__":
+    main()
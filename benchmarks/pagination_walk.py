@@ -0,0 +1,70 @@
+"""カーソルによるページ送りで ES に投げる検索の数と所要時間
+
+先頭を取るための検索を毎ページ加える場合（probe）と、ページ境界を Redis に
+覚えておく場合（boundary cache）を比べる。ES と Redis は tests.fakes の代用品に
+往復の遅延を与えたもの。
+"""
+
+import asyncio
+import time
+
+from planetsclub.services import services
+from planetsclub.services.elasticsearch import ESDocModel, page_boundaries
+from tests.fakes import FakeElasticsearch, FakeRedis
+
+DOCS = 1000
+PAGE_SIZE = 20
+ES_LATENCY = 0.004
+REDIS_LATENCY = 0.0003
+
+
+class Doc(ESDocModel):
+    ES_INDEX = "docs"
+
+
+async def walk(forward: bool, cursor=None):
+    """最後のページまでたどり、ページ数と最後のカーソルを返す"""
+    pages = 0
+    while True:
+        if forward:
+            p = await Doc._es_search_pagable(
+                None, None, None, [{"n": "desc"}], PAGE_SIZE, None, cursor, None
+            )
+        else:
+            p = await Doc._es_search_pagable(
+                None, None, None, [{"n": "desc"}], None, PAGE_SIZE, None, cursor
+            )
+        pages += 1
+        cursor = p["end_cursor"] if forward else p["start_cursor"]
+        if not (p["has_next_page"] if forward else p["has_previous_page"]):
+            return (pages, cursor)
+
+
+async def main():
+    es = FakeElasticsearch(latency=ES_LATENCY)
+    for i in range(DOCS):
+        es.add("docs", "d{}".format(i), {"n": i})
+    services.es = es
+
+    for (name, ttl) in [("probe", 0), ("boundary cache", 30)]:
+        services.redis_pool = FakeRedis(latency=REDIS_LATENCY)
+        page_boundaries.ttl = ttl
+        cursor = None
+        for forward in (True, False):
+            (es.requests, es.searches) = (0, 0)
+            start = time.perf_counter()
+            (pages, cursor) = await walk(forward, cursor)
+            elapsed = time.perf_counter() - start
+            print(
+                "{:<15} {:<8} {:3d} pages  {:4d} searches  {:5.2f} ms/page".format(
+                    name,
+                    "forward" if forward else "backward",
+                    pages,
+                    es.searches,
+                    elapsed / pages * 1000,
+                )
+            )
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(main())
@@ -1,11 +1,13 @@
+import hmac
 import logging
 
 from starlette.applications import Starlette
 from starlette.endpoints import HTTPEndpoint
+from starlette.requests import Request
 from starlette.responses import PlainTextResponse
 
 from . import graphql, settings
-from .services import services
+from .services import metrics, services
 from .users.middleware import AuthenticationMiddleware
 from .users.models import AuthenticationBackend
 
@@ -14,5 +16,36 @@ _LOGGER = logging.getLogger("planetsclub")
 app = Starlette(debug=True)
 
 services.setup(app)
-app.add_middleware(AuthenticationMiddleware, backend=AuthenticationBackend())
+auth_backend = AuthenticationBackend()
+app.add_event_handler("startup", auth_backend.startup)
+app.add_event_handler("shutdown", auth_backend.shutdown)
+app.add_middleware(AuthenticationMiddleware, backend=auth_backend)
 graphql.setup(app)
+
+
+def _can_read_metrics(request: Request) -> bool:
+    """管理者か、METRICS_TOKEN を Bearer で渡したもの"""
+    if request.user.is_admin:
+        return True
+    if not settings.METRICS_TOKEN:
+        return False
+    expected = "Bearer " + settings.METRICS_TOKEN
+    return hmac.compare_digest(
+        request.headers.get("authorization", "").encode("utf-8"),
+        expected.encode("utf-8"),
+    )
+
+
+@app.route("/metrics")
+async def metrics_endpoint(request: Request):
+    """Prometheus 用（このホストの全ワーカーの合計）"""
+    if not _can_read_metrics(request):
+        return PlainTextResponse("Forbidden", status_code=403)
+    try:
+        snapshots = await services.metrics.collect(services.redis_pool)
+    except Exception:
+        _LOGGER.exception("exception:")
+        snapshots = [metrics.registry.snapshot()]
+    return PlainTextResponse(
+        metrics.registry.render(snapshots), media_type="text/plain; version=0.0.4",
+    )
@@ -0,0 +1,171 @@
+"""アーカイブの本文と HTML を planets-archive-content に分ける
+
+    python -m planetsclub.services.indices create
+    ARCHIVE_CONTENT_STORE=index にしてアプリケーションを再起動する
+    python -m planetsclub.archives.content split
+    python -m planetsclub.archives.content prune
+
+split はアーカイブの文書の本文と HTML を planets-archive-content に写す。
+アプリケーションが先に書き込んだもの（切り替えた後の更新）は上書きしない。
+写し終えるまでは、まだ無いものをアーカイブの文書から読むので止めずに移行できる。
+
+prune はアーカイブの文書から HTML を消す（本文は検索とハイライトに使うので残す）。
+ARCHIVE_CONTENT_STORE=index でなければ実行しない。planets-archive-content に
+文書が無いもの（split で写せなかったもの）は消さずに残し、その件数を表示する。
+
+どちらも point in time の上で _shard_doc の順に読むので、index の版によらず
+途中の更新で読み落とすことはない。
+"""
+
+import argparse
+import asyncio
+import logging
+import sys
+from typing import Optional
+
+from planetsclub import settings
+from planetsclub.archives.models import HEAVY_FIELDS, ArchiveContentModel, ArchiveModel
+from planetsclub.archives.transfer import Progress, scan
+from planetsclub.services import create_elasticsearch, services
+from planetsclub.services.elasticsearch import BulkItemError, BulkWriter
+
+_LOGGER = logging.getLogger("planetsclub.archives.content")
+
+_PRUNE_SCRIPT = """
+if (ctx._source.containsKey('html_content')) {
+  ctx._source.remove('html_content')
+} else {
+  ctx.op = 'noop'
+}
+"""
+
+
+async def split_contents(
+    batch_size: int = 500, concurrency: int = 2, progress: Optional[Progress] = None
+) -> int:
+    """planets-archive-content に無い本文と HTML を写し、写した件数を返す"""
+    progress = progress or Progress("copied")
+    skipped = 0
+
+    def done(future: asyncio.Future):
+        nonlocal skipped
+        error = future.exception()
+        if isinstance(error, BulkItemError) and error.status == 409:
+            skipped += 1
+        elif error is not None:
+            progress.failed += 1
+            _LOGGER.error("failed: %s", error)
+        else:
+            progress.add()
+
+    writer = BulkWriter(
+        max_actions=batch_size,
+        interval=1.0,
+        max_pending=batch_size * (concurrency + 1),
+        concurrency=concurrency,
+    )
+    writer.start()
+    body = {"size": batch_size, "_source": {"includes": list(HEAVY_FIELDS)}}
+    try:
+        async for hits in scan(ArchiveModel.ES_INDEX, body):
+            for hit in hits:
+                contents = hit.get("_source") or {}
+                if not contents:
+                    continue
+                future = await writer.create(
+                    ArchiveContentModel.ES_INDEX, hit["_id"], contents
+                )
+                future.add_done_callback(done)
+    finally:
+        await writer.close()
+    # done callback を実行させる
+    await asyncio.sleep(0)
+    _LOGGER.info(
+        "%d documents were already in %s", skipped, ArchiveContentModel.ES_INDEX
+    )
+    return progress.count
+
+
+async def prune_contents(
+    batch_size: int = 500, concurrency: int = 2, progress: Optional[Progress] = None
+) -> int:
+    """planets-archive-content に写してあるものだけ、アーカイブの文書から HTML を消す"""
+    progress = progress or Progress("pruned")
+    missing = 0
+
+    def done(future: asyncio.Future):
+        error = future.exception()
+        if error is not None:
+            progress.failed += 1
+            _LOGGER.error("failed: %s", error)
+        else:
+            progress.add()
+
+    writer = BulkWriter(
+        max_actions=batch_size,
+        interval=1.0,
+        max_pending=batch_size * (concurrency + 1),
+        concurrency=concurrency,
+    )
+    writer.start()
+    body = {
+        "size": batch_size,
+        "query": {"exists": {"field": "html_content"}},
+        "_source": False,
+    }
+    script = {"script": {"source": _PRUNE_SCRIPT, "lang": "painless"}}
+    try:
+        async for hits in scan(ArchiveModel.ES_INDEX, body):
+            res = await services.es.mget(
+                index=ArchiveContentModel.ES_INDEX,
+                body={"ids": [hit["_id"] for hit in hits]},
+                _source=False,
+            )
+            for doc in res["docs"]:
+                if not doc.get("found"):
+                    missing += 1
+                    continue
+                future = await writer.update(ArchiveModel.ES_INDEX, doc["_id"], script)
+                future.add_done_callback(done)
+    finally:
+        await writer.close()
+    # done callback を実行させる
+    await asyncio.sleep(0)
+    if missing:
+        _LOGGER.warning(
+            "%d documents are not in %s and were kept (run split first)",
+            missing,
+            ArchiveContentModel.ES_INDEX,
+        )
+    return progress.count
+
+
+async def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m planetsclub.archives.content")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=2)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("split")
+    subparsers.add_parser("prune")
+    args = parser.parse_args(argv)
+
+    if args.command == "prune" and settings.ARCHIVE_CONTENT_STORE != "index":
+        parser.error("ARCHIVE_CONTENT_STORE must be 'index' before pruning")
+
+    logging.basicConfig(level=logging.INFO)
+    services.es = create_elasticsearch()
+    try:
+        if args.command == "split":
+            progress = Progress("copied", sys.stderr)
+            await split_contents(args.batch_size, args.concurrency, progress)
+            progress.report()
+        else:
+            progress = Progress("pruned", sys.stderr)
+            await prune_contents(args.batch_size, args.concurrency, progress)
+            progress.report()
+    finally:
+        await services.es.transport.close()
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,113 @@
+"""アーカイブの絞り込みと件数の集計（ファセット）
+
+tags / series / type ごとの件数と公開年ごとの件数を ES の集計で求める。
+集計結果は検索語・絞り込み・閲覧者の区分ごとに Redis に保存し、
+ArchiveModel.update などが世代番号を進めると使われなくなる。
+世代番号は更新が検索に出てから（refresh の後で）進めるので、古い集計が
+新しい世代で保存されることはない。transfer の import も読み込んだ後に進める。
+"""
+
+import hashlib
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+from planetsclub.services.generation_cache import GenerationCache
+
+_REDIS_KEY_PREFIX = "planetsclub-archive-facets-"
+
+# 公開年はこのタイムゾーンで数える
+TIME_ZONE = "+09:00"
+
+# GraphQL の名前 -> 集計するフィールド（ArchiveModel.ES_MAPPINGS の keyword サブフィールド）
+TERMS_FACETS = {
+    "tags": "tags.keyword",
+    "series": "series.keyword",
+    "types": "type.keyword",
+}
+TERMS_FACET_SIZE = 50
+
+Facets = Dict[str, List[Dict[str, Any]]]
+
+
+def filter_clauses(filters: Optional[dict]) -> List[dict]:
+    """ArchiveFilters を bool query の filter にする"""
+    clauses: List[dict] = []
+    if not filters:
+        return clauses
+    for (name, field) in TERMS_FACETS.items():
+        values = filters.get(name)
+        if values:
+            clauses.append({"terms": {field: values}})
+    years = filters.get("years")
+    if years:
+        clauses.append(
+            {
+                "bool": {
+                    "should": [
+                        {
+                            "range": {
+                                "published_at": {
+                                    "gte": "{}-01-01".format(year),
+                                    "lt": "{}-01-01".format(year + 1),
+                                    "time_zone": TIME_ZONE,
+                                }
+                            }
+                        }
+                        for year in years
+                    ],
+                    "minimum_should_match": 1,
+                }
+            }
+        )
+    return clauses
+
+
+def aggregations() -> dict:
+    aggs = {
+        name: {"terms": {"field": field, "size": TERMS_FACET_SIZE}}
+        for (name, field) in TERMS_FACETS.items()
+    }
+    aggs["years"] = {
+        "date_histogram": {
+            "field": "published_at",
+            "calendar_interval": "year",
+            "format": "yyyy",
+            "time_zone": TIME_ZONE,
+            "min_doc_count": 1,
+        }
+    }
+    return aggs
+
+
+def parse_aggregations(res_aggs: dict) -> Facets:
+    facets: Facets = {}
+    for name in TERMS_FACETS:
+        buckets = res_aggs.get(name, {}).get("buckets", [])
+        facets[name] = [{"value": b["key"], "count": b["doc_count"]} for b in buckets]
+    buckets = res_aggs.get("years", {}).get("buckets", [])
+    # 新しい年から
+    facets["years"] = [
+        {"value": b["key_as_string"], "count": b["doc_count"]}
+        for b in reversed(buckets)
+    ]
+    return facets
+
+
+class FacetCache(GenerationCache):
+    def __init__(self, ttl: int, generation_key: str):
+        super().__init__("facets", _REDIS_KEY_PREFIX, ttl, generation_key)
+
+    @staticmethod
+    def key_for(q: Optional[str], filters: Optional[dict], tier: str) -> str:
+        normalized_filters = {k: sorted(v) for (k, v) in (filters or {}).items() if v}
+        normalized = json.dumps(
+            [q or "", normalized_filters, tier], sort_keys=True, separators=(",", ":")
+        )
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    async def get(self, key: str) -> Tuple[Optional[Facets], int]:
+        """保存された集計（現在の世代のものだけ）と現在の世代番号"""
+        return await self._load(key)
+
+    async def set(self, key: str, generation: int, facets: Facets):
+        await self._store(key, generation, facets)
@@ -1,28 +1,258 @@
 """Planets Club Archive"""
 
+import asyncio
+import logging
 import re
 from datetime import datetime
 from enum import Enum
-from typing import List, Optional, Type, TypeVar
+from typing import Dict, List, Optional, Tuple, Type, TypeVar, Union
 
-from dateutil.parser import parse as parse_datetime
 from pytz import UTC
 from starlette.authentication import AuthCredentials
 
-from planetsclub.services.elasticsearch import ESDocModel, NotFoundError
+from planetsclub import settings
+from planetsclub.archives.facets import (
+    FacetCache,
+    Facets,
+    aggregations,
+    filter_clauses,
+    parse_aggregations,
+)
+from planetsclub.services import services
+from planetsclub.services.dataloader import DataLoader
+from planetsclub.services.elasticsearch import (
+    STORED_ONLY,
+    TEXT_ANALYSIS,
+    TEXT_WITH_KEYWORD,
+    ESDocModel,
+    NotFoundError,
+)
+from planetsclub.services.localcache import LocalCache
 from planetsclub.users.base import BaseUser
 from planetsclub.users.models import UserModel
 
+_LOGGER = logging.getLogger("planetsclub.archives")
+
 T = TypeVar("T", bound="ArchiveModel")
 
+# 一覧や通知には含めない大きなフィールド
+HEAVY_FIELDS = ("body", "html_content")
+
+# ハイライトできるフィールド（bodyHighlights）
+HIGHLIGHT_FIELDS = ("body",)
+
+# アーカイブが更新されるたびに進む世代番号（レスポンスキャッシュの無効化に使う）
+ARCHIVE_GENERATION_KEY = "planetsclub-archive-generation"
+
+facet_cache = FacetCache(settings.ARCHIVE_FACET_CACHE_TTL, ARCHIVE_GENERATION_KEY)
+
+SUGGEST_MAX_SIZE = 20
+SUGGEST_MAX_PREFIX = 50
+
+# 入力補完の結果のワーカー内キャッシュ（(区分, 前方一致の文字列, 件数) -> 結果）
+suggest_cache: LocalCache[List[dict]] = LocalCache(
+    settings.ARCHIVE_SUGGEST_CACHE_SIZE, settings.ARCHIVE_SUGGEST_CACHE_TTL, "suggest"
+)
+# 同じキーの問い合わせを ES に 1 つだけ送るための実行中の問い合わせ
+_suggest_inflight: Dict[tuple, asyncio.Future] = {}
+# エイリアスが宣言された版の index を指しているか（ワーカー内に短時間保存）
+_declared_index_cache: LocalCache[bool] = LocalCache(1, 60.0)
+
+
+def _highlight_spec() -> dict:
+    """ES_HIGHLIGHTER が fvh なら ES_MAPPINGS の term_vector を使う"""
+    return {
+        "fields": {
+            name: {"type": settings.ES_HIGHLIGHTER} for name in HIGHLIGHT_FIELDS
+        },
+        "fragment_size": 60,
+        "number_of_fragments": 3,
+    }
+
+
+def _set_suggest_input(data: dict):
+    """入力補完の候補（suggest フィールド）をタイトル・シリーズ・タグから作る"""
+    if "title" not in data:
+        return
+    inputs: List[str] = []
+    for value in [data.get("title"), data.get("series")] + list(data.get("tags") or []):
+        if value and value not in inputs:
+            inputs.append(value)
+    data["suggest"] = {"input": inputs}
+
+
+# _set_suggest_input と同じことを ES_PIPELINE で行う（_reindex や一括読み込みの文書にも付く）。
+# パイプラインは部分更新（_update）には適用されないので、更新では _set_suggest_input を使う
+_SUGGEST_SCRIPT = """
+if (!ctx.containsKey('title')) {
+  return;
+}
+List values = new ArrayList();
+values.add(ctx.title);
+values.add(ctx.series);
+if (ctx.tags instanceof List) {
+  values.addAll(ctx.tags);
+}
+List inputs = new ArrayList();
+for (def value : values) {
+  if (value != null && value != '' && !inputs.contains(value)) {
+    inputs.add(value);
+  }
+}
+ctx.suggest = ['input': inputs];
+"""
+
+
+async def _suggest_available() -> bool:
+    """suggest の mapping がある（宣言された版の）index を指しているか
+
+    移行前の index は dynamic mapping なので、suggest を書くとただのオブジェクトとして
+    登録され、入力補完の問い合わせが失敗する。移行するまでは書かず、候補も返さない。
+    """
+    available = _declared_index_cache.get(ArchiveModel.ES_INDEX)
+    if available is None:
+        # indices はモデルを import するのでここで読み込む
+        from planetsclub.services import indices
+
+        try:
+            current = await indices.current_indices(ArchiveModel.ES_INDEX)
+        except Exception:
+            _LOGGER.exception("exception:")
+            return False
+        available = current == [indices.index_name(ArchiveModel)]
+        _declared_index_cache.set(ArchiveModel.ES_INDEX, available)
+    return available
+
+
+def _tier(user: BaseUser) -> str:
+    return "member" if user.is_member else "anonymous"
+
+
+def _content_split() -> bool:
+    return settings.ARCHIVE_CONTENT_STORE == "index"
+
+
+def _split_contents(data: dict) -> dict:
+    """更新する本文と HTML
+
+    ARCHIVE_CONTENT_STORE=index なら HTML は ``data`` から除く
+    （本文は検索とハイライトに使うのでアーカイブの文書にも置く）。
+    """
+    contents = {k: data[k] for k in HEAVY_FIELDS if k in data}
+    if _content_split():
+        data.pop("html_content", None)
+    return contents
+
 
 class ArchiveItemPrivacy(Enum):
     PUBLIC = "public"
     CLUB = "club"
 
 
+class ArchiveItemSort(Enum):
+    CREATED_AT_DESC = "created_at_desc"
+    # 検索語が無ければ CREATED_AT_DESC と同じ
+    RELEVANCE = "relevance"
+
+
+# index のソート（ArchiveModel.ES_SETTINGS）と同じ並びなら、ES は件数を数えない
+# 検索（track_total_hits: false）でページの件数だけ集めて打ち切れる
+# doc_id は v3 からなので、移行前の index では unmapped_type で値の無いものとして扱う
+_CREATED_AT_DESC = [
+    {"created_at": "desc"},
+    {"doc_id": {"order": "desc", "unmapped_type": "keyword"}},
+]
+SORTS = {
+    ArchiveItemSort.CREATED_AT_DESC: _CREATED_AT_DESC,
+    ArchiveItemSort.RELEVANCE: [{"_score": "desc"}] + _CREATED_AT_DESC,
+}
+
+
+class ArchiveContentModel(ESDocModel):
+    """アーカイブの本文と HTML（ARCHIVE_CONTENT_STORE=index のとき。id はアーカイブと同じ）"""
+
+    ES_INDEX = "planets-archive-content"
+    ES_SETTINGS = {
+        "index": {
+            "number_of_shards": 1,
+            "number_of_replicas": 1,
+            # id で読むだけなので検索に出るのは遅くてよい
+            "refresh_interval": "30s",
+        }
+    }
+    ES_MAPPINGS = {
+        "dynamic": False,
+        "properties": {
+            "body": {"type": "text", "index": False},
+            "html_content": {"type": "text", "index": False},
+        },
+    }
+    __slots__ = ()
+
+
 class ArchiveModel(ESDocModel):
     ES_INDEX = "planets-archive"
+    ES_INDEX_VERSION = 3
+    ES_SETTINGS = {
+        "index": {
+            "number_of_shards": 1,
+            "number_of_replicas": 1,
+            # 更新は検索に出るのを待ってから（refresh="wait_for"）キャッシュの世代を
+            # 進めるので、長くすると更新の応答とキャッシュが古いままの時間が延びる
+            "refresh_interval": "1s",
+            # 既定の一覧（新しい順）の並び。doc_id は search_after の同順位の解消用
+            "sort.field": ["created_at", "doc_id"],
+            "sort.order": ["desc", "desc"],
+        },
+        "analysis": TEXT_ANALYSIS,
+    }
+    # _id はソートに使えない（doc_values が無い）ので doc_id に写す
+    ES_PIPELINE = {
+        "description": "copy _id to doc_id and build suggest",
+        "processors": [
+            {"set": {"field": "doc_id", "value": "{{_id}}"}},
+            {"script": {"lang": "painless", "source": _SUGGEST_SCRIPT}},
+        ],
+    }
+    ES_MAPPINGS = {
+        # 宣言していないフィールドは _source に残すだけで索引しない
+        "dynamic": False,
+        "properties": {
+            # tags / series / type の keyword サブフィールドはファセットで集計する
+            "title": TEXT_WITH_KEYWORD,
+            "type": TEXT_WITH_KEYWORD,
+            "series": TEXT_WITH_KEYWORD,
+            "tags": TEXT_WITH_KEYWORD,
+            # fvh で使う位置とオフセットを保存しておく
+            "body": {
+                "type": "text",
+                "analyzer": "planets_text",
+                "term_vector": "with_positions_offsets",
+            },
+            "description": {"type": "text", "analyzer": "planets_text"},
+            # 表示するだけで検索しない
+            "html_content": {"type": "text", "index": False},
+            "thumbnail_url": STORED_ONLY,
+            "doc_id": {"type": "keyword"},
+            "privacy": {"type": "keyword"},
+            "source": {"type": "keyword"},
+            "source_id": {"type": "keyword"},
+            "length": {"type": "integer"},
+            "created_by": {"type": "keyword"},
+            "updated_by": {"type": "keyword"},
+            "published_at": {"type": "date"},
+            "created_at": {"type": "date"},
+            "updated_at": {"type": "date"},
+            # 入力補完（タイトル・シリーズ・タグ）。非会員には公開のものだけを返す
+            "suggest": {
+                "type": "completion",
+                "contexts": [
+                    {"name": "privacy", "type": "category", "path": "privacy"}
+                ],
+            },
+        },
+    }
+    __slots__ = ()
 
     @property
     def title(self) -> str:
@@ -69,64 +299,97 @@ class ArchiveModel(ESDocModel):
     def body_highlights(self) -> List[str]:
         return self._highlight.get("body", []) if self._highlight else []
 
-    @property
-    def body(self) -> Optional[str]:
-        return self._data.get("body")
+    async def get_body(
+        self, loader: Optional[DataLoader[dict]] = None
+    ) -> Optional[str]:
+        return await self._get_content("body", loader)
 
-    @property
-    def html_content(self) -> Optional[str]:
-        if self._user.is_member:
-            return self._data.get("html_content")
-        else:
+    async def get_html_content(
+        self, loader: Optional[DataLoader[dict]] = None
+    ) -> Optional[str]:
+        if not self._user.is_member:
             return None
+        return await self._get_content("html_content", loader)
+
+    async def _get_content(
+        self, name: str, loader: Optional[DataLoader[dict]]
+    ) -> Optional[str]:
+        """本文か HTML（一覧などで読んでいなければ get_contents で読む）"""
+        if name in self._data or self._id is None:
+            return self._data.get(name)
+        if loader is not None:
+            content = await loader.load(self._id)
+        else:
+            content = (await self.get_contents([self._id])).get(self._id)
+        return content.get(name) if content else None
 
     @property
     def published_at(self) -> Optional[datetime]:
-        v = self._data.get("published_at")
-        return parse_datetime(v) if v else None
+        return self._datetime("published_at")
 
     @property
     def created_at(self) -> Optional[datetime]:
-        v = self._data.get("created_at")
-        return parse_datetime(v) if v else None
+        return self._datetime("created_at")
 
     @property
     def updated_at(self) -> Optional[datetime]:
-        v = self._data.get("updated_at")
-        return parse_datetime(v) if v else None
-
-    async def get_created_by(self) -> Optional[UserModel]:
-        if not self._user.is_member:
-            return None
-        uid: Optional[str] = self._data.get("created_by")
-        if uid:
-            return await UserModel.get_by_id(uid, self._user, self._auth)
-        else:
-            return None
-
-    async def get_updated_by(self) -> Optional[UserModel]:
-        if not self._user.is_member:
-            return None
-        uid: Optional[str] = self._data.get("updated_by")
-        print(uid)
-        if uid:
-            return await UserModel.get_by_id(uid, self._user, self._auth)
-        else:
+        return self._datetime("updated_at")
+
+    async def get_created_by(
+        self, loader: Optional[DataLoader[UserModel]] = None
+    ) -> Optional[UserModel]:
+        return await self._get_user(self._data.get("created_by"), loader)
+
+    async def get_updated_by(
+        self, loader: Optional[DataLoader[UserModel]] = None
+    ) -> Optional[UserModel]:
+        return await self._get_user(self._data.get("updated_by"), loader)
+
+    async def _get_user(
+        self, uid: Optional[str], loader: Optional[DataLoader[UserModel]]
+    ) -> Optional[UserModel]:
+        if not self._user.is_member or not uid:
             return None
+        if loader is not None:
+            return await loader.load(uid)
+        return await UserModel.get_by_id(uid, self._user, self._auth)
 
     @classmethod
     async def get_by_id(
-        cls: Type[T], id, user: BaseUser, auth: AuthCredentials
+        cls: Type[T],
+        id,
+        user: BaseUser,
+        auth: AuthCredentials,
+        fields: Optional[List[str]] = None,
     ) -> Optional[T]:
-        model = await cls._es_get(id, user, auth)
+        if fields is not None and _content_split():
+            # 本文と HTML は解決するときに planets-archive-content から読む
+            fields = [f for f in fields if f not in HEAVY_FIELDS]
+        model = await cls._es_get(id, user, auth, fields=fields)
         return model
 
+    @classmethod
+    async def get_contents(cls, ids: List[str]) -> Dict[str, dict]:
+        """id -> 本文と HTML
+
+        planets-archive-content にまだ無いもの（移行中）はアーカイブの文書から読む。
+        """
+        contents: Dict[str, dict] = {}
+        if _content_split():
+            docs = await ArchiveContentModel._es_mget(ids, None, None)
+            contents.update((doc._id, doc._data) for doc in docs)
+        missing = [id for id in ids if id not in contents]
+        if missing:
+            docs = await cls._es_mget(missing, None, None, fields=list(HEAVY_FIELDS))
+            contents.update((doc._id, doc._data) for doc in docs)
+        return contents
+
     @classmethod
     async def get_archives(
         cls: Type[T],
         user: BaseUser,
         auth: AuthCredentials,
-        sort=None,
+        sort: ArchiveItemSort = ArchiveItemSort.CREATED_AT_DESC,
         q=None,
         state=None,
         phase=None,
@@ -134,33 +397,137 @@ class ArchiveModel(ESDocModel):
         last=None,
         after=None,
         before=None,
+        fields: Optional[List[str]] = None,
+        track_total_hits: Union[bool, int, None] = None,
+        consistent: bool = False,
+        highlight: bool = False,
+        filters: Optional[dict] = None,
+        facets: bool = False,
     ):
-        must = []
-        sort = sort or []
-        sort = sort + [{"_id": "desc"}]
+        """``highlight`` はハイライトが要るか（``q`` が無ければ行わない）
 
-        if not user.is_member:
-            must.append({"term": {"privacy": "public"}})
+        ``sort`` は index のソートで賄える並びだけ（``q`` が無ければ新しい順）。
+        ``facets`` なら検索語と絞り込みに合うものの件数を ``facets`` に入れる。
+        保存された集計が無ければ同じ検索で集計する。
+        """
+        if not q:
+            sort = ArchiveItemSort.CREATED_AT_DESC
 
-        if q:
-            must.append({"query_string": {"query": q, "default_operator": "AND"}})
+        (facet_key, facet_generation, cached_facets) = (None, -1, None)
+        if facets:
+            facet_key = facet_cache.key_for(q, filters, _tier(user))
+            (cached_facets, facet_generation) = await facet_cache.get(facet_key)
 
-        return await cls._es_search_pagable(
+        pagable = await cls._es_search_pagable(
             user,
             auth,
-            query={"bool": {"must": must}},
-            sort=sort,
+            query=cls._search_query(user, q, filters),
+            sort=SORTS[sort],
             first=first,
             last=last,
             before=before,
             after=after,
-            highlight={
-                "fields": {"*": {}},
-                "fragment_size": 60,
-                "number_of_fragments": 3,
-            },
-            _source={"excludes": ["body", "html_content"]},
+            highlight=_highlight_spec() if (q and highlight) else None,
+            _source={"excludes": list(HEAVY_FIELDS)},
+            fields=(
+                None if fields is None else [f for f in fields if f not in HEAVY_FIELDS]
+            ),
+            track_total_hits=track_total_hits,
+            consistent=consistent,
+            aggs=aggregations() if facets and cached_facets is None else None,
         )
+        if facets:
+            if cached_facets is None:
+                cached_facets = parse_aggregations(pagable.pop("aggregations"))
+                await facet_cache.set(facet_key, facet_generation, cached_facets)
+            pagable["facets"] = cached_facets
+        return pagable
+
+    @classmethod
+    async def get_facets(
+        cls, user: BaseUser, auth: AuthCredentials, q=None, filters=None
+    ) -> Facets:
+        """tags / series / types / years ごとの件数（閲覧者の区分ごとに保存する）"""
+        key = facet_cache.key_for(q, filters, _tier(user))
+        (facets, generation) = await facet_cache.get(key)
+        if facets is None:
+            res = await cls._es_search_raw(
+                {
+                    "size": 0,
+                    "track_total_hits": False,
+                    "query": cls._search_query(user, q, filters),
+                    "aggs": aggregations(),
+                }
+            )
+            facets = parse_aggregations(res.get("aggregations") or {})
+            await facet_cache.set(key, generation, facets)
+        return facets
+
+    @classmethod
+    async def suggest(cls, user: BaseUser, prefix: str, size: int = 10) -> List[dict]:
+        """タイトル・シリーズ・タグが ``prefix`` で始まるアイテムの id と title
+
+        結果はワーカー内に短時間保存し、同じ問い合わせが重なったときは 1 つだけ送る。
+        """
+        prefix = prefix.strip().lower()[:SUGGEST_MAX_PREFIX]
+        size = max(1, min(size, SUGGEST_MAX_SIZE))
+        if not prefix or not await _suggest_available():
+            return []
+
+        key = (_tier(user), prefix, size)
+        suggestions = suggest_cache.get(key)
+        if suggestions is not None:
+            return suggestions
+        pending = _suggest_inflight.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_event_loop().create_future()
+        _suggest_inflight[key] = future
+        try:
+            suggestions = await cls._es_suggest(user, prefix, size)
+        except Exception as e:
+            future.set_exception(e)
+            # 待っているものが無くても警告が出ないように
+            future.exception()
+            raise
+        finally:
+            del _suggest_inflight[key]
+        suggest_cache.set(key, suggestions)
+        future.set_result(suggestions)
+        return suggestions
+
+    @classmethod
+    async def _es_suggest(cls, user: BaseUser, prefix: str, size: int) -> List[dict]:
+        completion: dict = {"field": "suggest", "size": size}
+        if not user.is_member:
+            completion["contexts"] = {"privacy": ["public"]}
+        res = await cls._es_search_raw(
+            {
+                "_source": ["title"],
+                "suggest": {"archive": {"prefix": prefix, "completion": completion}},
+            }
+        )
+        options = res["suggest"]["archive"][0]["options"]
+        return [
+            {"id": o["_id"], "title": o.get("_source", {}).get("title") or "Untitled"}
+            for o in options
+        ]
+
+    @staticmethod
+    def _search_query(user: BaseUser, q: Optional[str], filters: Optional[dict]):
+        must = []
+        if not user.is_member:
+            must.append({"term": {"privacy": "public"}})
+
+        if q:
+            must.append({"query_string": {"query": q, "default_operator": "AND"}})
+
+        query: dict = {"bool": {"must": must}}
+        clauses = filter_clauses(filters)
+        if clauses:
+            query["bool"]["filter"] = clauses
+        return query
 
     @classmethod
     async def create(cls: Type[T], user: BaseUser, auth, data: dict) -> Optional[T]:
@@ -173,15 +540,88 @@ class ArchiveModel(ESDocModel):
 
         if "body" in data:
             data["description"] = re.sub(r"\s+", "", data["body"])[:200]
+        if await _suggest_available():
+            _set_suggest_input(data)
+        contents = _split_contents(data)
 
         alert = cls(id, user=user, auth=auth)
         data["updated_at"] = datetime.now(UTC)
         data["updated_by"] = user.id
         try:
-            await alert._es_update(data)
-            return alert
+            # 本文と HTML は応答に含めない（入力のものを使う）。
+            # 検索に出てから世代を進めないと、古い一覧が新しい世代で保存される
+            await alert._es_update(
+                data, refresh="wait_for", _source_excludes=list(HEAVY_FIELDS)
+            )
         except NotFoundError:
             return None
+        if contents and _content_split():
+            await ArchiveContentModel(id)._es_update(
+                contents, doc_as_upsert=True, _source=False
+            )
+        alert._data.update(contents)
+
+        await cls._broadcast_updates([alert])
+        return alert
+
+    @classmethod
+    async def bulk_update(
+        cls: Type[T], updates: List[Tuple[str, dict]], user: BaseUser, auth
+    ) -> Optional[List[Union[T, Exception]]]:
+        """複数のアイテムをまとめて更新する（失敗したアイテムの位置には例外が入る）"""
+        if not user.is_member:
+            return None
+
+        now = datetime.now(UTC)
+        suggest = await _suggest_available()
+        contents = []
+        for (_, data) in updates:
+            if "body" in data:
+                data["description"] = re.sub(r"\s+", "", data["body"])[:200]
+            if suggest:
+                _set_suggest_input(data)
+            contents.append(_split_contents(data))
+            data["updated_at"] = now
+            data["updated_by"] = user.id
+
+        results = await cls._es_bulk_update(
+            updates, user, auth, _source={"excludes": list(HEAVY_FIELDS)}, refresh=True,
+        )
+        positions = []
+        for (i, result) in enumerate(results):
+            if isinstance(result, cls):
+                result._data.update(contents[i])
+                if contents[i] and _content_split():
+                    positions.append(i)
+        if positions:
+            written = await ArchiveContentModel._es_bulk_update(
+                [(updates[i][0], contents[i]) for i in positions],
+                None,
+                None,
+                _source=False,
+                doc_as_upsert=True,
+            )
+            for (i, result) in zip(positions, written):
+                if isinstance(result, Exception):
+                    results[i] = result
+        await cls._broadcast_updates([r for r in results if isinstance(r, cls)])
+        return results
+
+    @classmethod
+    async def _broadcast_updates(cls, items: List[T]):
+        """世代を進めて更新を通知する（更新が検索に出てから呼ぶ）"""
+        if not items:
+            return
+        try:
+            with (await services.redis_pool) as r:
+                await r.incr(ARCHIVE_GENERATION_KEY)
+            for item in items:
+                data = {k: v for (k, v) in item._data.items() if k not in HEAVY_FIELDS}
+                await services.msghub.emit(
+                    "archives.updated." + item._id, {"id": item._id, "data": data}
+                )
+        except Exception:
+            _LOGGER.exception("exception:")
 
     @classmethod
     async def delete(cls: Type[T], id, user: BaseUser, auth) -> bool:
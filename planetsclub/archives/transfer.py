@@ -0,0 +1,255 @@
+"""アーカイブの index を NDJSON で書き出す・読み込む
+
+    python -m planetsclub.archives.transfer export archives.ndjson.gz
+    python -m planetsclub.archives.transfer import archives.ndjson.gz
+
+1 行が 1 文書で ``{"_id": ..., "_source": {...}}`` の形。ファイル名が ``.gz`` で
+終わる場合は gzip で圧縮する。``-`` なら標準入出力を使う。
+書き出しは point in time の上で _shard_doc の順に（fielddata の要る _id ではなく）、
+読み込みは BulkWriter で少しずつ処理するので、
+index の大きさによらずメモリの使用量は一定。
+読み込んだ後は、保存された archiveItems の応答と集計を無効にする。
+
+ARCHIVE_CONTENT_STORE=index のとき、アーカイブの index（既定）の書き出しには
+planets-archive-content の本文と HTML を合わせる（prune で消した HTML も失わない）。
+読み込みでは、アプリケーションが書くときと同じく本文と HTML を planets-archive-content
+にも書き、アーカイブの文書からは HTML を除く（``_id`` の無い文書はそのまま書くので、
+後で content の split と prune を実行する）。そのため ``--index planets-archive-content``
+で別に書き出す必要はない。書き出した場合は、その index にそのまま読み込まれる。
+"""
+
+import argparse
+import asyncio
+import gzip
+import io
+import json
+import logging
+import sys
+import time
+from contextlib import contextmanager
+from typing import AsyncIterator, Iterator, List, Optional, TextIO
+
+from planetsclub.archives.models import (
+    ARCHIVE_GENERATION_KEY,
+    HEAVY_FIELDS,
+    ArchiveContentModel,
+    ArchiveModel,
+    _content_split,
+    _split_contents,
+)
+from planetsclub.services import create_elasticsearch, services
+from planetsclub.services.elasticsearch import BulkWriter
+from planetsclub.services.redis import create_redis
+
+_LOGGER = logging.getLogger("planetsclub.archives.transfer")
+
+_PIT_KEEP_ALIVE = "5m"
+
+
+class Progress:
+    """処理した件数と docs/sec を一定間隔で表示する"""
+
+    def __init__(self, label: str, out: Optional[TextIO] = None, interval=2.0):
+        self.label = label
+        self.out = out
+        self.interval = interval
+        self.count = 0
+        self.failed = 0
+        self._started = time.perf_counter()
+        self._reported = self._started
+
+    def add(self, n: int = 1):
+        self.count += n
+        now = time.perf_counter()
+        if now - self._reported >= self.interval:
+            self._reported = now
+            self.report()
+
+    def report(self):
+        if self.out is None:
+            return
+        elapsed = time.perf_counter() - self._started
+        print(
+            "{} {} docs ({} failed) in {:.1f}s, {:.0f} docs/sec".format(
+                self.label,
+                self.count,
+                self.failed,
+                elapsed,
+                self.count / elapsed if elapsed else 0.0,
+            ),
+            file=self.out,
+            flush=True,
+        )
+
+
+async def scan(index: str, body: dict) -> AsyncIterator[List[dict]]:
+    """point in time を開き、_shard_doc の順にページごとの hits を返す"""
+    transport = services.es.transport
+    res = await transport.perform_request(
+        "POST", "/{}/_pit".format(index), params={"keep_alive": _PIT_KEEP_ALIVE}
+    )
+    pit_id = res["id"]
+    body = dict(body, sort=[{"_shard_doc": "asc"}])
+    try:
+        while True:
+            body["pit"] = {"id": pit_id, "keep_alive": _PIT_KEEP_ALIVE}
+            res = await transport.perform_request("POST", "/_search", body=body)
+            pit_id = res.get("pit_id") or pit_id
+            hits = res["hits"]["hits"]
+            if hits:
+                yield hits
+            if len(hits) < body["size"]:
+                break
+            body["search_after"] = hits[-1]["sort"]
+    finally:
+        try:
+            await transport.perform_request("DELETE", "/_pit", body={"id": pit_id})
+        except Exception:
+            _LOGGER.exception("exception:")
+
+
+async def export_documents(
+    index: str, out: TextIO, batch_size: int = 1000, progress: Optional[Progress] = None
+) -> int:
+    """index の全文書を NDJSON で ``out`` に書き出す"""
+    progress = progress or Progress("exported")
+    merge = index == ArchiveModel.ES_INDEX and _content_split()
+    async for hits in scan(index, {"size": batch_size}):
+        if merge:
+            await _merge_contents(hits)
+        for hit in hits:
+            out.write(
+                json.dumps(
+                    {"_id": hit["_id"], "_source": hit["_source"]}, ensure_ascii=False
+                )
+            )
+            out.write("\n")
+        progress.add(len(hits))
+    return progress.count
+
+
+async def _merge_contents(hits: List[dict]):
+    """planets-archive-content にある本文と HTML を hits の _source に入れる"""
+    res = await services.es.mget(
+        index=ArchiveContentModel.ES_INDEX,
+        body={"ids": [hit["_id"] for hit in hits]},
+        _source_includes=list(HEAVY_FIELDS),
+    )
+    for (hit, doc) in zip(hits, res["docs"]):
+        if doc.get("found"):
+            hit["_source"].update(doc.get("_source") or {})
+
+
+async def import_documents(
+    index: str,
+    inp: TextIO,
+    batch_size: int = 500,
+    concurrency: int = 2,
+    progress: Optional[Progress] = None,
+) -> int:
+    """NDJSON を読み込んで index に書き込み、書き込めた件数を返す"""
+    progress = progress or Progress("imported")
+    split = index == ArchiveModel.ES_INDEX and _content_split()
+
+    def done(future: asyncio.Future):
+        if future.exception() is not None:
+            progress.failed += 1
+            _LOGGER.error("failed: %s", future.exception())
+        else:
+            progress.add()
+
+    def content_done(future: asyncio.Future):
+        if future.exception() is not None:
+            progress.failed += 1
+            _LOGGER.error("failed: %s", future.exception())
+
+    writer = BulkWriter(
+        max_actions=batch_size,
+        interval=1.0,
+        max_pending=batch_size * (concurrency + 1),
+        concurrency=concurrency,
+    )
+    writer.start()
+    try:
+        for line in inp:
+            if not line.strip():
+                continue
+            doc = json.loads(line)
+            (id, source) = (doc.get("_id"), doc["_source"])
+            if split and id is not None:
+                contents = _split_contents(source)
+                if contents:
+                    future = await writer.index(
+                        ArchiveContentModel.ES_INDEX, id, contents
+                    )
+                    future.add_done_callback(content_done)
+            future = await writer.index(index, id, source)
+            future.add_done_callback(done)
+    finally:
+        await writer.close()
+    # done callback を実行させる
+    await asyncio.sleep(0)
+    return progress.count
+
+
+async def invalidate_caches(index: str):
+    """読み込んだものを検索に出してから、保存された一覧と集計の世代を進める"""
+    await services.es.indices.refresh(index=index)
+    redis = await create_redis()
+    try:
+        await redis.incr(ARCHIVE_GENERATION_KEY)
+    finally:
+        redis.close()
+        await redis.wait_closed()
+
+
+@contextmanager
+def _open(path: str, mode: str) -> Iterator[TextIO]:
+    if path == "-":
+        stream = sys.stdout if mode == "w" else sys.stdin
+        wrapper = io.TextIOWrapper(stream.buffer, encoding="utf-8")
+        try:
+            yield wrapper
+        finally:
+            # 標準入出力そのものは閉じない
+            wrapper.flush()
+            wrapper.detach()
+    elif path.endswith(".gz"):
+        with gzip.open(path, mode + "t", encoding="utf-8") as f:
+            yield f
+    else:
+        with open(path, mode, encoding="utf-8") as f:
+            yield f
+
+
+async def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m planetsclub.archives.transfer")
+    parser.add_argument("--index", default=ArchiveModel.ES_INDEX)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=2)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("export").add_argument("path")
+    subparsers.add_parser("import").add_argument("path")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    services.es = create_elasticsearch()
+    try:
+        if args.command == "export":
+            progress = Progress("exported", sys.stderr)
+            with _open(args.path, "w") as out:
+                await export_documents(args.index, out, args.batch_size, progress)
+        else:
+            progress = Progress("imported", sys.stderr)
+            with _open(args.path, "r") as inp:
+                await import_documents(
+                    args.index, inp, args.batch_size, args.concurrency, progress
+                )
+            await invalidate_caches(args.index)
+        progress.report()
+    finally:
+        await services.es.transport.close()
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(main())
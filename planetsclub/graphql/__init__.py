@@ -7,12 +7,13 @@ from ariadne import (
     make_executable_schema,
     snake_case_fallback_resolvers,
 )
-from ariadne.asgi import GraphQL
 from graphql.type import GraphQLSchema
 
 from planetsclub import settings
 
 from . import archives, common, users
+from .extensions import MetricsExtension
+from .server import GraphQLServer
 
 _LOGGER = logging.getLogger("planetsclub.graphql")
 
@@ -28,4 +29,12 @@ def _make_executable_schema() -> GraphQLSchema:
 
 
 def setup(app) -> None:
-    app.mount("/api/graphql", GraphQL(_make_executable_schema(), debug=settings.DEBUG))
+    app.mount(
+        "/api/graphql",
+        GraphQLServer(
+            _make_executable_schema(),
+            debug=settings.DEBUG,
+            keepalive=10,
+            extensions=[MetricsExtension],
+        ),
+    )
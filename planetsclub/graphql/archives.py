@@ -1,10 +1,29 @@
 from typing import List, Optional
 
-from ariadne import EnumType, MutationType, ObjectType, QueryType, SchemaBindable
+from ariadne import (
+    EnumType,
+    MutationType,
+    ObjectType,
+    QueryType,
+    SchemaBindable,
+    SubscriptionType,
+)
+from graphql import OperationType
 
-from planetsclub.archives.models import ArchiveItemPrivacy, ArchiveModel
+from planetsclub.archives.models import (
+    ArchiveItemPrivacy,
+    ArchiveItemSort,
+    ArchiveModel,
+)
+from planetsclub.services import services
+from planetsclub.services.dataloader import DataLoader
+from planetsclub.services.elasticsearch import BulkItemError
 from planetsclub.users.models import UserModel
 
+from .common import track_total_hits
+from .projection import ARCHIVE_ITEM_SOURCE_FIELDS, selected_fields, source_includes
+from .users import ensure_user_cache
+
 
 def _get_request(info):
     return info.context["request"]
@@ -12,6 +31,7 @@ def _get_request(info):
 
 query = QueryType()
 mutation = MutationType()
+subscription = SubscriptionType()
 archiveItem = ObjectType("ArchiveItem")
 
 
@@ -41,32 +61,115 @@ async def resolve_update_archive_item(_, info, id, input) -> Optional[ArchiveMod
     return await ArchiveModel.update(id, user, auth, data=data)
 
 
+@mutation.field("bulkUpdateArchiveItems")
+async def resolve_bulk_update_archive_items(_, info, items) -> Optional[dict]:
+    request = _get_request(info)
+    (user, auth) = (request.user, request.auth)
+    updates = [(item["id"], input_to_data(item["input"])) for item in items]
+    results = await ArchiveModel.bulk_update(updates, user, auth)
+    if results is None:
+        return None
+
+    errors = []
+    for (index, ((id, _), result)) in enumerate(zip(updates, results)):
+        if isinstance(result, BulkItemError) and result.status == 404:
+            errors.append({"index": index, "id": id, "message": "not found"})
+        elif isinstance(result, Exception):
+            errors.append({"index": index, "id": id, "message": str(result)})
+    return {
+        "items": [None if isinstance(r, Exception) else r for r in results],
+        "errors": errors,
+    }
+
+
 @query.field("archiveItem")
 async def resolve_archive_item(_, info, id) -> Optional[ArchiveModel]:
     request = _get_request(info)
-    alert = await ArchiveModel.get_by_id(id, request.user, request.auth)
+    fields = source_includes(info, ARCHIVE_ITEM_SOURCE_FIELDS)
+    alert = await ArchiveModel.get_by_id(id, request.user, request.auth, fields=fields)
     return alert
 
 
 @query.field("archiveItems")
 async def resolve_archive_items(_, info, **kwargs) -> str:
     request = _get_request(info)
-    kwargs.setdefault("sort", [{"created_at": "desc"}])
+    kwargs["sort"] = kwargs.get("sort") or ArchiveItemSort.CREATED_AT_DESC
+    kwargs["fields"] = source_includes(info, ARCHIVE_ITEM_SOURCE_FIELDS, ("items",))
+    kwargs["highlight"] = "bodyHighlights" in selected_fields(info, ("items",))
+    kwargs["facets"] = "facets" in selected_fields(info)
+    kwargs["track_total_hits"] = track_total_hits(
+        info, kwargs.pop("countMode", None), kwargs.pop("countCap", None)
+    )
     pagable = await ArchiveModel.get_archives(request.user, request.auth, **kwargs)
     return pagable
 
 
+@query.field("archiveFacets")
+async def resolve_archive_facets(_, info, q=None, filters=None) -> dict:
+    request = _get_request(info)
+    return await ArchiveModel.get_facets(request.user, request.auth, q, filters)
+
+
+@query.field("archiveSuggest")
+async def resolve_archive_suggest(_, info, prefix, size=10) -> List[dict]:
+    request = _get_request(info)
+    return await ArchiveModel.suggest(request.user, prefix, size)
+
+
+@subscription.source("archiveItemUpdated")
+async def archive_item_updated_source(_, info, id=None):
+    request = _get_request(info)
+    (user, auth) = (request.user, request.auth)
+    topic = "archives.updated." + (id or "*")
+    async for (_, msg) in services.msghub.subscribe(topic):
+        item = ArchiveModel(msg["id"], data=msg["data"], user=user, auth=auth)
+        if user.is_member or item.privacy == ArchiveItemPrivacy.PUBLIC:
+            yield item
+
+
+@subscription.field("archiveItemUpdated")
+def resolve_archive_item_updated(item: ArchiveModel, info, id=None) -> ArchiveModel:
+    return item
+
+
+def _content_loader(info) -> Optional[DataLoader[dict]]:
+    """リクエスト内の本文と HTML の読み込みをまとめる（購読では更新のたびに読む）"""
+    if info.operation.operation == OperationType.SUBSCRIPTION:
+        return None
+    state = _get_request(info).state
+    if not hasattr(state, "archive_contents"):
+        state.archive_contents = DataLoader(ArchiveModel.get_contents)
+    return state.archive_contents
+
+
+@archiveItem.field("body")
+async def resolve_body(item: ArchiveModel, info) -> Optional[str]:
+    return await item.get_body(_content_loader(info))
+
+
+@archiveItem.field("htmlContent")
+async def resolve_html_content(item: ArchiveModel, info) -> Optional[str]:
+    return await item.get_html_content(_content_loader(info))
+
+
 @archiveItem.field("updatedBy")
 async def resolve_update_by(item: ArchiveModel, info) -> Optional[UserModel]:
-    return await item.get_updated_by()
+    return await item.get_updated_by(ensure_user_cache(_get_request(info)))
 
 
 @archiveItem.field("createdBy")
 async def resolve_created_by(item: ArchiveModel, info) -> Optional[UserModel]:
-    return await item.get_created_by()
+    return await item.get_created_by(ensure_user_cache(_get_request(info)))
 
 
 resolvers: List[SchemaBindable] = []
 resolvers.extend(
-    [query, mutation, archiveItem, EnumType("ArchiveItemPrivacy", ArchiveItemPrivacy)]
+    [
+        query,
+        mutation,
+        subscription,
+        archiveItem,
+        EnumType("ArchiveItemPrivacy", ArchiveItemPrivacy),
+        EnumType("ArchiveItemSort", ArchiveItemSort),
+    ]
 )
@@ -1,11 +1,14 @@
 """共通"""
 
 from datetime import datetime
-from typing import Optional
+from enum import Enum
+from typing import Optional, Union
 
-from ariadne import InterfaceType, ScalarType
+from ariadne import EnumType, InterfaceType, ScalarType
 from dateutil.parser import parse as parse_datetime
 
+from .projection import selected_fields
+
 datetime_scalar = ScalarType("DateTime")
 
 
@@ -27,4 +30,32 @@ def parse_datetime_value(value) -> Optional[datetime]:
 
 pagable = InterfaceType("Pagable")
 
-resolvers = [datetime_scalar, pagable]
+
+class CountMode(Enum):
+    EXACT = "exact"
+    CAPPED = "capped"
+    NONE = "none"
+
+
+DEFAULT_COUNT_CAP = 10000
+
+
+def track_total_hits(
+    info, count_mode: Optional[CountMode] = None, count_cap: Optional[int] = None
+) -> Union[bool, int, None]:
+    """Pagable の件数の数え方を ES の track_total_hits に変換する
+
+    totalCount / totalCountRel が選択されていなければ数えない。
+    """
+    if not (selected_fields(info) & {"totalCount", "totalCountRel"}):
+        return False
+    if count_mode == CountMode.NONE:
+        return False
+    elif count_mode == CountMode.EXACT:
+        return True
+    elif count_mode == CountMode.CAPPED:
+        return max(count_cap or DEFAULT_COUNT_CAP, 1)
+    return None
+
+
+resolvers = [datetime_scalar, pagable, EnumType("CountMode", CountMode)]
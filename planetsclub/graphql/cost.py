@@ -0,0 +1,225 @@
+"""操作のコストの静的な見積もり
+
+実行する前に、文書と変数だけから ES や Redis にかかる負荷のおおよその大きさを求め、
+閲覧者の区分（非会員 / 会員 / 管理者）ごとの上限を超える操作は実行しない。
+
+- フィールドの重みは ``FIELD_COSTS``（既定はオブジェクトを返すフィールドが 1、
+  スカラーが 0）
+- ``first`` / ``last`` を取るフィールドの下のリストは、その件数倍にする
+  （要素 1 件あたり 1 を加える）。それ以外のオブジェクトのリストは
+  ``DEFAULT_LIST_SIZE`` 件とみなす
+- 変数は実行するときと同じく既定値を補って型に合わせてから読む
+- ``@skip`` / ``@include`` は考えない（上限の見積もり）
+"""
+
+from typing import Any, Dict, Optional, Set
+
+from graphql import (
+    DocumentNode,
+    FieldNode,
+    FragmentDefinitionNode,
+    FragmentSpreadNode,
+    GraphQLError,
+    GraphQLObjectType,
+    GraphQLSchema,
+    InlineFragmentNode,
+    IntValueNode,
+    ListValueNode,
+    OperationDefinitionNode,
+    OperationType,
+    SelectionSetNode,
+    VariableNode,
+    get_named_type,
+    get_nullable_type,
+    is_composite_type,
+    is_list_type,
+)
+from graphql.execution.values import get_variable_values
+
+from planetsclub import settings
+from planetsclub.users.base import BaseUser
+
+# Type.field -> 重み
+FIELD_COSTS: Dict[str, int] = {
+    "Query.archiveItem": 1,
+    "Query.archiveItems": 10,
+    "Query.archiveFacets": 10,
+    "Query.archiveSuggest": 1,
+    # 同じ検索で集計する
+    "ArchiveItems.facets": 5,
+    "Query.me": 0,
+    "Query.user": 1,
+    "Query.users": 10,
+    # ページの要素の取得は「要素 1 件あたり 1」で数える
+    "ArchiveItems.items": 0,
+    "Users.items": 0,
+    # ハイライトは ES の側で要素ごとに本文を解析する
+    "ArchiveItem.bodyHighlights": 2,
+    # 一覧では読んでいないので要素ごとに別に読む（リクエスト内ではまとめて読む）
+    "ArchiveItem.body": 1,
+    "ArchiveItem.htmlContent": 1,
+    "Mutation.updateArchiveItem": 10,
+    "Mutation.bulkUpdateArchiveItems": 10,
+    "Mutation.signInWithFacebook": 10,
+}
+
+# Type.field -> (リストの引数, 要素 1 件あたりの重み)
+ARGUMENT_LIST_COSTS = {"Mutation.bulkUpdateArchiveItems": ("items", 2)}
+
+DEFAULT_LIST_SIZE = 10
+# ESDocModel._es_search_pagable の上限と同じ
+MAX_PAGE_SIZE = 2000
+
+
+class QueryTooCostly(GraphQLError):
+    def __init__(self, cost: int, limit: int):
+        super().__init__(
+            "Query cost {} exceeds the limit {}".format(cost, limit),
+            extensions={"code": "QUERY_TOO_COSTLY", "cost": cost, "limit": limit},
+        )
+
+
+def cost_limit(user: BaseUser) -> int:
+    if user.is_admin:
+        return settings.GRAPHQL_COST_LIMIT_ADMIN
+    elif user.is_member:
+        return settings.GRAPHQL_COST_LIMIT_MEMBER
+    else:
+        return settings.GRAPHQL_COST_LIMIT_ANONYMOUS
+
+
+def operation_cost(
+    schema: GraphQLSchema,
+    document: DocumentNode,
+    operation: OperationDefinitionNode,
+    variables: Optional[Dict[str, Any]],
+) -> int:
+    fragments = {
+        d.name.value: d
+        for d in document.definitions
+        if isinstance(d, FragmentDefinitionNode)
+    }
+    root = {
+        OperationType.QUERY: schema.query_type,
+        OperationType.MUTATION: schema.mutation_type,
+        OperationType.SUBSCRIPTION: schema.subscription_type,
+    }[operation.operation]
+    return _CostVisitor(
+        schema, fragments, _coerce_variables(schema, operation, variables)
+    ).selection_set(root, operation.selection_set, None, set())
+
+
+def _coerce_variables(
+    schema: GraphQLSchema,
+    operation: OperationDefinitionNode,
+    variables: Optional[Dict[str, Any]],
+) -> Dict[str, Any]:
+    """既定値を補った変数（型に合わないものがあれば実行で弾かれるのでそのまま）"""
+    variables = variables if isinstance(variables, dict) else {}
+    (errors, coerced) = get_variable_values(
+        schema, operation.variable_definitions or [], variables
+    )
+    return variables if errors else coerced
+
+
+class _CostVisitor:
+    def __init__(self, schema: GraphQLSchema, fragments, variables: Dict[str, Any]):
+        self.schema = schema
+        self.fragments = fragments
+        self.variables = variables
+
+    def selection_set(
+        self,
+        parent_type,
+        selection_set: Optional[SelectionSetNode],
+        page_size: Optional[int],
+        visited: Set[str],
+    ) -> int:
+        if selection_set is None:
+            return 0
+        cost = 0
+        for selection in selection_set.selections:
+            if isinstance(selection, FieldNode):
+                cost += self.field(parent_type, selection, page_size, visited)
+            elif isinstance(selection, InlineFragmentNode):
+                cost += self.selection_set(
+                    self._type_condition(selection, parent_type),
+                    selection.selection_set,
+                    page_size,
+                    visited,
+                )
+            elif isinstance(selection, FragmentSpreadNode):
+                name = selection.name.value
+                fragment = self.fragments.get(name)
+                # 循環は検証で弾かれるが、念のため同じ枝で 2 度は辿らない
+                if fragment is None or name in visited:
+                    continue
+                cost += self.selection_set(
+                    self._type_condition(fragment, parent_type),
+                    fragment.selection_set,
+                    page_size,
+                    visited | {name},
+                )
+        return cost
+
+    def field(
+        self, parent_type, node: FieldNode, page_size: Optional[int], visited: Set[str]
+    ) -> int:
+        name = node.name.value
+        if name.startswith("__") or not isinstance(parent_type, GraphQLObjectType):
+            return 0
+        field_def = parent_type.fields.get(name)
+        if field_def is None:
+            return 0
+
+        key = parent_type.name + "." + name
+        field_type = get_nullable_type(field_def.type)
+        composite = is_composite_type(get_named_type(field_type))
+        weight = FIELD_COSTS.get(key, 1 if composite else 0)
+
+        list_argument = ARGUMENT_LIST_COSTS.get(key)
+        if list_argument is not None:
+            (argument, per_item) = list_argument
+            weight += per_item * self._list_length(node, argument)
+
+        named_type = get_named_type(field_type)
+        if is_list_type(field_type) and composite:
+            # ページの大きさはすぐ下のリストにだけ効く
+            children = self.selection_set(named_type, node.selection_set, None, visited)
+            count = page_size if page_size is not None else DEFAULT_LIST_SIZE
+            return weight + count * (1 + children)
+
+        children = self.selection_set(
+            named_type, node.selection_set, self._page_size(field_def, node), visited
+        )
+        return weight + children
+
+    def _type_condition(self, node, parent_type):
+        if node.type_condition is None:
+            return parent_type
+        return self.schema.get_type(node.type_condition.name.value) or parent_type
+
+    def _argument(self, node: FieldNode, name: str):
+        for argument in node.arguments or ():
+            if argument.name.value == name:
+                value = argument.value
+                if isinstance(value, VariableNode):
+                    return self.variables.get(value.name.value)
+                elif isinstance(value, IntValueNode):
+                    return int(value.value)
+                elif isinstance(value, ListValueNode):
+                    return value.values
+                return None
+        return None
+
+    def _page_size(self, field_def, node: FieldNode) -> Optional[int]:
+        """first / last を取るフィールドならページの大きさ"""
+        if "first" not in field_def.args and "last" not in field_def.args:
+            return None
+        sizes = [self._argument(node, name) for name in ("first", "last")]
+        sizes = [s for s in sizes if isinstance(s, int) and s > 0]
+        return min(max(sizes), MAX_PAGE_SIZE) if sizes else DEFAULT_LIST_SIZE
+
+    def _list_length(self, node: FieldNode, name: str) -> int:
+        value = self._argument(node, name)
+        return len(value) if isinstance(value, (list, tuple)) else 1
@@ -0,0 +1,66 @@
+"""ariadne の extension"""
+
+import re
+import time
+from inspect import isawaitable
+from typing import Any, Set
+
+from ariadne.types import Extension, Resolver
+from graphql import GraphQLResolveInfo
+
+from planetsclub import settings
+from planetsclub.services import metrics
+
+_ROOT_TYPES = frozenset(["Query", "Mutation", "Subscription"])
+
+_OPERATION_NAME_RE = re.compile(r"^[_A-Za-z][_0-9A-Za-z]{0,63}$")
+
+# このワーカーでラベルにした操作名
+_operation_labels: Set[str] = set()
+
+
+def operation_label(operation_name: Any) -> str:
+    """メトリクスのラベルにする操作名（値の種類が増えすぎないようにする）
+
+    操作名はクライアントが自由に付けられるので、ワーカーごとに
+    METRICS_MAX_OPERATION_LABELS 種類までとし、それを超えたものは other にする。
+    """
+    if operation_name is None:
+        return "anonymous"
+    if not isinstance(operation_name, str) or not _OPERATION_NAME_RE.match(
+        operation_name
+    ):
+        return "other"
+    if operation_name not in _operation_labels:
+        if len(_operation_labels) >= settings.METRICS_MAX_OPERATION_LABELS:
+            return "other"
+        _operation_labels.add(operation_name)
+    return operation_name
+
+
+class MetricsExtension(Extension):
+    """フィールドのリゾルバの所要時間を測る
+
+    ルートのフィールドと非同期のリゾルバだけを測る。同期のリゾルバ
+    （_source の値を返すだけのもの）は件数が多く、測る方が高くつく。
+    """
+
+    def resolve(self, next_: Resolver, parent: Any, info: GraphQLResolveInfo, **kwargs):
+        started = time.perf_counter()
+        result = next_(parent, info, **kwargs)
+        field = info.parent_type.name + "." + info.field_name
+        if isawaitable(result):
+            return self._observe_async(result, field, started)
+        if info.parent_type.name in _ROOT_TYPES:
+            metrics.GRAPHQL_RESOLVER_SECONDS.observe(
+                time.perf_counter() - started, field
+            )
+        return result
+
+    async def _observe_async(self, result, field: str, started: float):
+        try:
+            return await result
+        finally:
+            metrics.GRAPHQL_RESOLVER_SECONDS.observe(
+                time.perf_counter() - started, field
+            )
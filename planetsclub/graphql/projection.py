@@ -0,0 +1,99 @@
+"""選択されたフィールドから ES の _source に含めるフィールドを決める"""
+
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from graphql import (
+    FieldNode,
+    FragmentSpreadNode,
+    GraphQLResolveInfo,
+    InlineFragmentNode,
+    SelectionSetNode,
+)
+
+# GraphQL のフィールド名 -> 必要な _source のフィールド
+ARCHIVE_ITEM_SOURCE_FIELDS: Dict[str, Tuple[str, ...]] = {
+    "__typename": (),
+    "id": (),
+    "title": ("title",),
+    "type": ("type",),
+    "series": ("series",),
+    "description": ("description",),
+    "body": ("body",),
+    "htmlContent": ("html_content",),
+    "length": ("length",),
+    "tags": ("tags",),
+    "privacy": ("privacy",),
+    "source": ("source",),
+    "sourceId": ("source_id",),
+    "thumbnailUrl": ("thumbnail_url",),
+    "bodyHighlights": (),
+    "publishedAt": ("published_at",),
+    "createdAt": ("created_at",),
+    "updatedAt": ("updated_at",),
+    "createdBy": ("created_by",),
+    "updatedBy": ("updated_by",),
+}
+
+USER_SOURCE_FIELDS: Dict[str, Tuple[str, ...]] = {
+    "__typename": (),
+    "id": (),
+    "isAuthenticated": ("deactivated",),
+    "isActive": ("deactivated",),
+    "realName": ("real_name",),
+    "email": ("email",),
+    "isAdmin": ("deactivated", "is_admin"),
+    "isMember": (),
+    "googleId": ("google_id",),
+    "facebookId": (),
+    "pictureUri": ("picture_uri",),
+    "createdAt": ("created_at",),
+    "updatedAt": ("updated_at",),
+}
+
+
+def selected_fields(info: GraphQLResolveInfo, path: Sequence[str] = ()) -> Set[str]:
+    """Names of the fields selected below the current field
+
+    ``path`` descends through nested fields first, e.g. ``("items",)`` for the
+    items of a Pagable.
+    """
+    selection_sets = [
+        node.selection_set for node in info.field_nodes if node.selection_set
+    ]
+    for name in path:
+        selection_sets = [
+            field.selection_set
+            for field in _iter_fields(info, selection_sets)
+            if field.name.value == name and field.selection_set
+        ]
+    return {field.name.value for field in _iter_fields(info, selection_sets)}
+
+
+def _iter_fields(
+    info: GraphQLResolveInfo, selection_sets: Iterable[SelectionSetNode]
+) -> Iterable[FieldNode]:
+    for selection_set in selection_sets:
+        for selection in selection_set.selections:
+            if isinstance(selection, FieldNode):
+                yield selection
+            elif isinstance(selection, InlineFragmentNode):
+                yield from _iter_fields(info, [selection.selection_set])
+            elif isinstance(selection, FragmentSpreadNode):
+                fragment = info.fragments.get(selection.name.value)
+                if fragment:
+                    yield from _iter_fields(info, [fragment.selection_set])
+
+
+def source_includes(
+    info: GraphQLResolveInfo,
+    field_map: Dict[str, Tuple[str, ...]],
+    path: Sequence[str] = (),
+) -> Optional[List[str]]:
+    """_source includes for the selection, or ``None`` when it can't be narrowed"""
+    includes: Set[str] = set()
+    for name in selected_fields(info, path):
+        fields = field_map.get(name)
+        if fields is None:
+            return None
+        includes.update(fields)
+    return sorted(includes)
@@ -0,0 +1,362 @@
+"""/api/graphql の ASGI アプリケーション"""
+
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from inspect import isawaitable
+from typing import Any, Dict, Optional, Tuple
+
+from ariadne.asgi import GraphQL
+from ariadne.exceptions import HttpError
+from ariadne.extensions import ExtensionManager
+from ariadne.graphql import (
+    handle_graphql_errors,
+    handle_query_result,
+    validate_operation_name,
+    validate_variables,
+)
+from ariadne.types import GraphQLResult
+from graphql import (
+    DocumentNode,
+    ExecutionContext,
+    GraphQLError,
+    GraphQLSchema,
+    execute,
+    get_operation_ast,
+    parse,
+    print_ast,
+)
+from graphql.validation import validate
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+
+from planetsclub import settings
+from planetsclub.services import json_codec, metrics, services, slowlog
+from planetsclub.users.base import BaseUser, UnauthenticatedUser
+
+from .cost import QueryTooCostly, cost_limit, operation_cost
+from .extensions import operation_label
+from .response_cache import ResponseCache
+
+_LOGGER = logging.getLogger("planetsclub.graphql.server")
+
+_APQ_REDIS_KEY_PREFIX = "planetsclub-apq-"
+
+_ANONYMOUS = UnauthenticatedUser()
+
+
+class GraphQLJSONResponse(JSONResponse):
+    """GraphQL の結果は JSON の型だけからなるので速いコーデックでそのまま符号化する"""
+
+    def render(self, content: Any) -> bytes:
+        return json_codec.dumps_native(content)
+
+
+class PersistedQueryNotFound(GraphQLError):
+    def __init__(self):
+        super().__init__(
+            "PersistedQueryNotFound", extensions={"code": "PERSISTED_QUERY_NOT_FOUND"},
+        )
+
+
+class DocumentCache:
+    """LRU cache of parsed and validated documents keyed by sha256 of the query"""
+
+    def __init__(self, schema: GraphQLSchema, maxsize: int):
+        self.schema = schema
+        self.maxsize = maxsize
+        self._documents: "OrderedDict[str, DocumentNode]" = OrderedDict()
+        self._fingerprints: Dict[str, str] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def hash_query(query: str) -> str:
+        return hashlib.sha256(query.encode("utf-8")).hexdigest()
+
+    def get(self, query_hash: str) -> Optional[DocumentNode]:
+        document = self._documents.get(query_hash)
+        if document is not None:
+            self._documents.move_to_end(query_hash)
+            self.hits += 1
+        return document
+
+    def parse_and_validate(self, query: str, query_hash: Optional[str] = None):
+        """Return the document for ``query`` or raise ``_ValidationFailed``"""
+        if query_hash is None:
+            query_hash = self.hash_query(query)
+        document = self.get(query_hash)
+        if document is not None:
+            return document
+
+        self.misses += 1
+        try:
+            document = parse(query)
+        except GraphQLError as error:
+            raise _ValidationFailed([error])
+        except Exception as error:
+            raise _ValidationFailed([GraphQLError(str(error), original_error=error)])
+
+        errors = validate(self.schema, document)
+        if errors:
+            raise _ValidationFailed(errors)
+
+        documents = self._documents
+        documents[query_hash] = document
+        while len(documents) > self.maxsize:
+            (evicted, _) = documents.popitem(last=False)
+            self._fingerprints.pop(evicted, None)
+        return document
+
+    def fingerprint(self, query_hash: str, document: DocumentNode) -> str:
+        """Hash of the normalized (re-printed) document"""
+        fingerprint = self._fingerprints.get(query_hash)
+        if fingerprint is None:
+            fingerprint = self.hash_query(print_ast(document))
+            if query_hash in self._documents:
+                self._fingerprints[query_hash] = fingerprint
+        return fingerprint
+
+
+class _ValidationFailed(Exception):
+    def __init__(self, errors):
+        super().__init__(errors)
+        self.errors = errors
+
+
+class GraphQLServer(GraphQL):
+    """ariadne の GraphQL に文書キャッシュと Automatic Persisted Queries を加えたもの
+
+    Clients may send ``extensions.persistedQuery.sha256Hash`` without ``query``.
+    Unknown hashes are answered with ``PersistedQueryNotFound``, after which the
+    client resends the full query together with its hash.
+    """
+
+    def __init__(self, schema: GraphQLSchema, **kwargs):
+        super().__init__(schema, **kwargs)
+        self.document_cache = DocumentCache(
+            schema, settings.GRAPHQL_DOCUMENT_CACHE_SIZE
+        )
+        self.response_cache = ResponseCache(settings.GRAPHQL_RESPONSE_CACHE_TTL)
+
+    async def graphql_http_server(self, request: Request) -> Response:
+        try:
+            data = await self.extract_data_from_request(request)
+        except HttpError as error:
+            return PlainTextResponse(error.message or error.status, status_code=400)
+
+        context_value = await self.get_context_for_request(request)
+        extensions = await self.get_extensions_for_request(request, context_value)
+        middleware = await self.get_middleware_for_request(request, context_value)
+
+        extension_manager = ExtensionManager(extensions)
+        with extension_manager.request(context_value):
+            (success, response) = await self.execute_operation(
+                data, context_value, extension_manager, middleware
+            )
+        return GraphQLJSONResponse(response, status_code=200 if success else 400)
+
+    async def execute_operation(
+        self, data: Any, context_value: Any, extension_manager, middleware
+    ) -> GraphQLResult:
+        started = time.perf_counter()
+        labels = {"operation": "unknown", "type": "unknown", "cached": "false"}
+        extensions: Dict[str, Any] = {}
+        tokens = _set_slowlog_context(data, context_value)
+        try:
+            (success, response) = await self._execute_operation(
+                data, context_value, extension_manager, middleware, labels, extensions
+            )
+            if extensions and isinstance(response, dict):
+                response["extensions"] = dict(response.get("extensions") or {})
+                response["extensions"].update(extensions)
+            return (success, response)
+        finally:
+            slowlog.current_operation.reset(tokens[0])
+            slowlog.profile_requested.reset(tokens[1])
+            metrics.GRAPHQL_OPERATION_SECONDS.observe(
+                time.perf_counter() - started,
+                labels["operation"],
+                labels["type"],
+                labels["cached"],
+            )
+
+    async def _execute_operation(
+        self,
+        data: Any,
+        context_value: Any,
+        extension_manager,
+        middleware,
+        labels: Dict[str, str],
+        extensions: Dict[str, Any],
+    ) -> GraphQLResult:
+        error_handling = {
+            "logger": self.logger,
+            "error_formatter": self.error_formatter,
+            "debug": self.debug,
+            "extension_manager": extension_manager,
+        }
+        try:
+            (query_hash, document, variables, operation_name) = await self.get_document(
+                data
+            )
+            operation = get_operation_ast(document, operation_name)
+            labels["operation"] = operation_label(operation_name)
+            if operation is not None:
+                labels["type"] = operation.operation.value
+                # 見積もりが上限を超える操作は実行しない
+                cost = operation_cost(self.schema, document, operation, variables)
+                limit = cost_limit(_request_user(context_value))
+                extensions["cost"] = {"requested": cost, "limit": limit}
+                if cost > limit:
+                    raise QueryTooCostly(cost, limit)
+
+            cache_key = self.response_cache.key_for(
+                context_value,
+                self.document_cache.fingerprint(query_hash, document),
+                document,
+                variables,
+                operation_name,
+            )
+            if cache_key is not None:
+                (cached, generation) = await self.response_cache.get(cache_key)
+                if cached is not None:
+                    labels["cached"] = "true"
+                    return (True, cached)
+
+            start = time.perf_counter()
+            result = execute(
+                self.schema,
+                document,
+                root_value=self.root_value,
+                context_value=context_value,
+                variable_values=variables,
+                operation_name=operation_name,
+                execution_context_class=ExecutionContext,
+                middleware=extension_manager.as_middleware_manager(middleware),
+            )
+            if isawaitable(result):
+                result = await result
+
+            if cache_key is not None and not result.errors:
+                await self.response_cache.set(
+                    cache_key,
+                    generation,
+                    {"data": result.data},
+                    time.perf_counter() - start,
+                )
+        except PersistedQueryNotFound as error:
+            # Apollo のクライアントは 200 を期待する
+            (_, response) = handle_graphql_errors([error], **error_handling)
+            return (True, response)
+        except _ValidationFailed as exc:
+            return handle_graphql_errors(exc.errors, **error_handling)
+        except GraphQLError as error:
+            return handle_graphql_errors([error], **error_handling)
+        else:
+            return handle_query_result(result, **error_handling)
+
+    async def get_document(
+        self, data: Any
+    ) -> Tuple[str, DocumentNode, Optional[dict], Optional[str]]:
+        if not isinstance(data, dict):
+            raise GraphQLError("Operation data should be a JSON object")
+        (query, variables, operation_name) = (
+            data.get("query"),
+            data.get("variables"),
+            data.get("operationName"),
+        )
+        validate_variables(variables)
+        validate_operation_name(operation_name)
+
+        query_hash = _persisted_query_hash(data)
+        cache = self.document_cache
+        if query_hash is None:
+            if not query or not isinstance(query, str):
+                raise GraphQLError("The query must be a string.")
+            query_hash = cache.hash_query(query)
+            document = cache.parse_and_validate(query, query_hash)
+        elif query:
+            if not isinstance(query, str):
+                raise GraphQLError("The query must be a string.")
+            if cache.hash_query(query) != query_hash:
+                raise GraphQLError("provided sha does not match query")
+            document = cache.parse_and_validate(query, query_hash)
+            await _store_persisted_query(query_hash, query)
+        else:
+            document = cache.get(query_hash)
+            if document is None:
+                query = await _load_persisted_query(query_hash)
+                if query is None:
+                    raise PersistedQueryNotFound()
+                document = cache.parse_and_validate(query, query_hash)
+
+        return (query_hash, document, variables, operation_name)
+
+
+def _request_user(context_value: Any) -> BaseUser:
+    request = context_value.get("request") if isinstance(context_value, dict) else None
+    user = getattr(request, "scope", {}).get("user") if request is not None else None
+    return user if user is not None else _ANONYMOUS
+
+
+def _set_slowlog_context(data: Any, context_value: Any):
+    """遅い検索の記録に残す操作と、profile を付けるかを設定する"""
+    request = context_value.get("request") if isinstance(context_value, dict) else None
+    user = _request_user(context_value)
+    variables = data.get("variables") if isinstance(data, dict) else None
+    if isinstance(variables, dict) and not settings.ES_SLOW_QUERY_LOG_VARIABLES:
+        # 値には検索語や個人の情報が入りうるので、既定では名前だけを残す
+        variables = sorted(variables)
+    operation = {
+        "name": data.get("operationName") if isinstance(data, dict) else None,
+        "user": user.id if user.is_authenticated else None,
+        "variables": variables,
+    }
+    profile = bool(
+        user.is_admin
+        and request is not None
+        and request.headers.get("x-es-profile") == "1"
+    )
+    return (
+        slowlog.current_operation.set(operation),
+        slowlog.profile_requested.set(profile),
+    )
+
+
+def _persisted_query_hash(data: dict) -> Optional[str]:
+    extensions = data.get("extensions")
+    if not isinstance(extensions, dict):
+        return None
+    persisted = extensions.get("persistedQuery")
+    if not isinstance(persisted, dict):
+        return None
+    if persisted.get("version", 1) != 1:
+        raise GraphQLError("Unsupported persisted query version")
+    query_hash = persisted.get("sha256Hash")
+    if not isinstance(query_hash, str):
+        raise GraphQLError("persistedQuery.sha256Hash must be a string")
+    return query_hash.lower()
+
+
+async def _store_persisted_query(query_hash: str, query: str) -> None:
+    try:
+        with (await services.redis_pool) as r:
+            await r.setex(
+                _APQ_REDIS_KEY_PREFIX + query_hash,
+                settings.GRAPHQL_PERSISTED_QUERY_TTL,
+                query,
+            )
+    except Exception:
+        _LOGGER.exception("exception:")
+
+
+async def _load_persisted_query(query_hash: str) -> Optional[str]:
+    """保存されたクエリ（Redis に繋がらなければ None を返し、全文を送り直させる）"""
+    try:
+        with (await services.redis_pool) as r:
+            return await r.get(_APQ_REDIS_KEY_PREFIX + query_hash, encoding="utf-8")
+    except Exception:
+        _LOGGER.exception("exception:")
+        return None
@@ -1,31 +1,51 @@
 from typing import Dict, List, Optional
 
-from ariadne import MutationType, QueryType, SchemaBindable
+from ariadne import MutationType, QueryType, SchemaBindable, SubscriptionType
 from starlette.authentication import AuthCredentials
 
-from planetsclub.users.models import UserModel
+from planetsclub.services import services
+from planetsclub.services.dataloader import DataLoader
+from planetsclub.users.base import BaseUser, UnauthenticatedUser
+from planetsclub.users.models import SessionUser, UserModel
+
+from .common import track_total_hits
+from .projection import USER_SOURCE_FIELDS, selected_fields, source_includes
 
 query = QueryType()
 mutation = MutationType()
+subscription = SubscriptionType()
 
 
-def ensure_user_cache(request):
+def ensure_user_cache(request) -> DataLoader[UserModel]:
     state = request.state
     if not hasattr(state, "user_cache"):
-        state.user_cache = {}
+        (user, auth) = (request.user, request.auth)
+        state.user_cache = DataLoader(
+            lambda ids: UserModel.get_many_by_ids(ids, user, auth)
+        )
     return state.user_cache
 
 
 async def _user_from_info(info, id) -> Optional[UserModel]:
     request = info.context["request"]
-    user = await UserModel.get_by_id(id, request.user, request.auth)
-    return user
+    return await ensure_user_cache(request).load(id)
+
+
+# SessionUser がクレームだけで答えられるフィールド
+_SESSION_USER_FIELDS = frozenset(
+    ["__typename", "id", "isAuthenticated", "isActive", "isAdmin", "isMember"]
+)
 
 
 @query.field("me")
-def resolve_me(_, info) -> UserModel:
+async def resolve_me(_, info) -> BaseUser:
     request = info.context["request"]
-    return request.user
+    user = request.user
+    if isinstance(user, SessionUser) and not (
+        selected_fields(info) <= _SESSION_USER_FIELDS
+    ):
+        return await user.load() or UnauthenticatedUser()
+    return user
 
 
 @query.field("user")
@@ -36,10 +56,32 @@ async def resolve_user(_, info, id) -> Optional[UserModel]:
 @query.field("users")
 async def resolve_users(_, info, **kwargs):
     kwargs["include_deactivated"] = kwargs.pop("includeDeactivated", False)
+    kwargs["fields"] = source_includes(info, USER_SOURCE_FIELDS, ("items",))
+    kwargs["track_total_hits"] = track_total_hits(
+        info, kwargs.pop("countMode", None), kwargs.pop("countCap", None)
+    )
     request = info.context["request"]
     return await UserModel.get_users(request.user, request.auth, **kwargs)
 
 
+@subscription.source("userUpdated")
+async def user_updated_source(_, info, id=None):
+    request = info.context["request"]
+    (user, auth) = (request.user, request.auth)
+    if id is None and not user.is_member:
+        return
+    topic = "users.updated." + (id or "*")
+    async for (_, msg) in services.msghub.subscribe(topic):
+        u = UserModel(msg["id"], data=msg["data"], user=user, auth=auth)
+        if u.is_member_or_me():
+            yield u
+
+
+@subscription.field("userUpdated")
+def resolve_user_updated(u: UserModel, info, id=None) -> UserModel:
+    return u
+
+
 @mutation.field("signInWithFacebook")
 async def resolve_signin_with_google(_, info, accessToken) -> Dict:
     request = info.context["request"]
@@ -94,4 +136,4 @@ async def resolve_sign_out(_, info) -> bool:
 
 
 resolvers: List[SchemaBindable] = []
-resolvers.extend([query, mutation])
+resolvers.extend([query, mutation, subscription])
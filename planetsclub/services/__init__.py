@@ -1,5 +1,6 @@
 """データベースなどのサービス類"""
 
+import asyncio
 import logging
 import ssl
 from enum import Enum
@@ -7,27 +8,67 @@ from enum import Enum
 import aiohttp
 import aioredis
 import certifi
+from elasticsearch.exceptions import SerializationError
 from elasticsearch.serializer import JSONSerializer
 from elasticsearch_async import AsyncElasticsearch
 
 from planetsclub import settings
+from planetsclub.services import metrics
+from planetsclub.services.jsoncodec import get_codec
+from planetsclub.services.msghub import MessageHub, OverflowPolicy
 
 _LOGGER = logging.getLogger("planetsclub.services")
 
 
+json_codec = get_codec(settings.JSON_CODEC)
+
+
 class CustomJSONSerializer(JSONSerializer):
     def default(self, obj):
         if isinstance(obj, Enum):
             return obj.value
         return super().default(obj)
 
+    def dumps(self, data):
+        if isinstance(data, str):
+            return data
+        try:
+            return json_codec.dumps(data, default=self.default)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(data, e)
+
+    def loads(self, s):
+        try:
+            return json_codec.loads(s)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(s, e)
+
+
+def create_elasticsearch() -> AsyncElasticsearch:
+    ssl_context = ssl.create_default_context(cafile=certifi.where())
+    return AsyncElasticsearch(
+        hosts=settings.ELASTICSEARCH_HOSTS,
+        http_auth=settings.ELASTICSEARCH_HTTP_AUTH,
+        use_ssl=settings.ELASTICSEARCH_USE_SSL,
+        ssl_context=ssl_context,
+        serializer=CustomJSONSerializer(),
+    )
+
 
 class _Services:
     def __init__(self):
         self.redis_pool = None
         self.es = None
-        self.msghub = None
+        self.bulk_writer = None
+        self.msghub = MessageHub(
+            queue_size=settings.MSGHUB_QUEUE_SIZE,
+            overflow=OverflowPolicy(settings.MSGHUB_OVERFLOW_POLICY),
+        )
         self.http_session = None
+        self.metrics = metrics.MetricsPublisher(
+            metrics.registry, settings.METRICS_PUBLISH_INTERVAL
+        )
+        self._metrics_task = None
         # self.gcs = google.cloud.storage.Client()
         # self.gcp_vision_image_annotator = google.cloud.vision.ImageAnnotatorClient()
 
@@ -37,44 +78,73 @@ class _Services:
 
     async def _startup(self):
         # HTTP Session
-        self.http_session = aiohttp.ClientSession(cookie_jar=aiohttp.DummyCookieJar())
+        self.http_session = aiohttp.ClientSession(
+            cookie_jar=aiohttp.DummyCookieJar(),
+            trace_configs=[metrics.http_trace_config()],
+        )
 
         # Redis
         self.redis_pool = await aioredis.create_redis_pool(
-            address=settings.REDIS_URL, maxsize=10
+            address=settings.REDIS_URL,
+            maxsize=10,
+            pool_cls=metrics.InstrumentedPool,
+            connection_cls=metrics.InstrumentedConnection,
         )
         _LOGGER.info("Redis pool ready")
 
         # Elasticsearch
-        ssl_context = ssl.create_default_context(cafile=certifi.where())
-        self.es = AsyncElasticsearch(
-            hosts=settings.ELASTICSEARCH_HOSTS,
-            http_auth=settings.ELASTICSEARCH_HTTP_AUTH,
-            use_ssl=settings.ELASTICSEARCH_USE_SSL,
-            ssl_context=ssl_context,
-            serializer=CustomJSONSerializer(),
-        )
+        self.es = create_elasticsearch()
         _LOGGER.info("Elasticsearch ready")
 
-        # # Message Hub
-        # self.msghub = MessageHub(self.redis_pool)
-        # await self.msghub.run()
-        # _LOGGER.info("Message hub ready")
+        # planetsclub.services.elasticsearch はこのモジュールを import するのでここで読み込む
+        from planetsclub.services.elasticsearch import BulkWriter
+
+        self.bulk_writer = BulkWriter(
+            max_actions=settings.ES_BULK_MAX_ACTIONS,
+            max_bytes=settings.ES_BULK_MAX_BYTES,
+            interval=settings.ES_BULK_FLUSH_INTERVAL,
+            max_pending=settings.ES_BULK_MAX_PENDING,
+            concurrency=settings.ES_BULK_CONCURRENCY,
+        )
+        self.bulk_writer.start()
+
+        # Message Hub
+        await self.msghub.run(self.redis_pool)
+        _LOGGER.info("Message hub ready")
+
+        # Metrics
+        self._metrics_task = asyncio.ensure_future(self._publish_metrics())
+
+    async def _publish_metrics(self):
+        while True:
+            await asyncio.sleep(self.metrics.interval)
+            try:
+                await self.metrics.publish(self.redis_pool)
+            except Exception:
+                _LOGGER.exception("exception:")
 
     async def _shutdown(self):
         await self.http_session.close()
 
-        # # Message Hub
-        # try:
-        #     self.msghub.close()
-        #     await self.msghub.wait_close()
-        # except Exception:
-        #     _LOGGER.exception("exception:")
-        #     raise
-        # else:
-        #     _LOGGER.info("Message hub closed")
+        # Metrics
+        if self._metrics_task is not None:
+            self._metrics_task.cancel()
+
+        # Message Hub
+        try:
+            self.msghub.close()
+            await self.msghub.wait_close()
+        except Exception:
+            _LOGGER.exception("exception:")
+        else:
+            _LOGGER.info("Message hub closed")
 
         # Elasticsearch
+        try:
+            await self.bulk_writer.close()
+        except Exception:
+            _LOGGER.exception("exception:")
+
         try:
             await self.es.transport.close()
         except Exception:
@@ -0,0 +1,65 @@
+"""リクエスト単位のバッチローダー"""
+
+import asyncio
+from typing import Awaitable, Callable, Dict, Generic, List, Mapping, Optional, TypeVar
+
+V = TypeVar("V")
+
+BatchLoadFn = Callable[[List[str]], Awaitable[Mapping[str, V]]]
+
+
+class DataLoader(Generic[V]):
+    """Collects keys requested within one event-loop tick and loads them at once
+
+    ``batch_load_fn`` receives the list of pending keys and returns a mapping
+    from key to value. Keys missing from the mapping resolve to ``None``.
+    Results are memoized for the lifetime of the loader, so a loader should be
+    scoped to a single request.
+    """
+
+    def __init__(self, batch_load_fn: BatchLoadFn):
+        self._batch_load_fn = batch_load_fn
+        self._futures: Dict[str, asyncio.Future] = {}
+        self._pending: List[str] = []
+
+    def load(self, key: str) -> Awaitable[Optional[V]]:
+        fut = self._futures.get(key)
+        if fut is None:
+            loop = asyncio.get_event_loop()
+            fut = loop.create_future()
+            self._futures[key] = fut
+            if not self._pending:
+                loop.call_soon(self._dispatch)
+            self._pending.append(key)
+        return fut
+
+    async def load_many(self, keys: List[str]) -> List[Optional[V]]:
+        return await asyncio.gather(*[self.load(key) for key in keys])
+
+    def prime(self, key: str, value: V) -> None:
+        if key not in self._futures:
+            fut = asyncio.get_event_loop().create_future()
+            fut.set_result(value)
+            self._futures[key] = fut
+
+    def clear(self, key: str) -> None:
+        self._futures.pop(key, None)
+
+    def _dispatch(self) -> None:
+        (keys, self._pending) = (self._pending, [])
+        asyncio.ensure_future(self._load_batch(keys))
+
+    async def _load_batch(self, keys: List[str]) -> None:
+        try:
+            values = await self._batch_load_fn(keys)
+        except Exception as exc:
+            for key in keys:
+                fut = self._futures.pop(key, None)
+                if fut is not None and not fut.done():
+                    fut.set_exception(exc)
+            return
+
+        for key in keys:
+            fut = self._futures.get(key)
+            if fut is not None and not fut.done():
+                fut.set_result(values.get(key))
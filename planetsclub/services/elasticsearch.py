@@ -1,15 +1,35 @@
 """Elasticsearch"""
 
+import asyncio
 import base64
+import hashlib
+import hmac
+import json
 import logging
+import time
 from copy import deepcopy
-from typing import Any, Dict, List, Optional, Sequence, Type, TypeVar
-
+from datetime import datetime
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+)
+
+import dateutil.parser
 import msgpack
 from elasticsearch import NotFoundError
 from starlette.authentication import AuthCredentials
 
-from planetsclub.services import services
+from planetsclub import settings
+from planetsclub.services import metrics, services
+from planetsclub.services.slowlog import slow_queries
 from planetsclub.users.base import BaseUser, UnauthenticatedUser
 
 _LOGGER = logging.getLogger("planetsclub.services.elasticsearch")
@@ -17,21 +37,269 @@ _LOGGER = logging.getLogger("planetsclub.services.elasticsearch")
 
 T = TypeVar("T", bound="ESDocModel")
 
+_PAGE_BOUNDARY_KEY_PREFIX = "planetsclub-page-boundary-"
+_PIT_REDIS_KEY = "planetsclub-es-pits"
+
 
-def _sort_to_cursor(values) -> str:
-    return base64.urlsafe_b64encode(msgpack.dumps(values)).decode("ascii").rstrip("=")
+def _sort_to_cursor(
+    values, pit: Optional[dict] = None, index: Optional[str] = None
+) -> str:
+    if pit is not None:
+        # PIT と開いた時刻は閲覧者に変えられないよう署名する
+        payload = msgpack.dumps(
+            {"s": values, "p": pit["id"], "t": pit["t"], "i": index}, use_bin_type=True
+        )
+        values = {"d": payload, "m": _cursor_mac(payload)}
+    data = msgpack.dumps(values, use_bin_type=True)
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
 
 
 def _cursor_to_sort(cursor: str):
+    if not cursor:
+        return None
     try:
         c = cursor.encode("ascii")
         c += b"=" * (4 - len(c) % 4)
         s = base64.urlsafe_b64decode(c)
         return msgpack.loads(s, raw=False)
-    except ValueError:
+    except (ValueError, TypeError, msgpack.UnpackException):
+        # 壊れた cursor は渡されなかったものとする
         return None
 
 
+def _cursor_mac(payload: bytes) -> bytes:
+    key = settings.SECRET_KEY.encode("utf-8")
+    return hmac.new(key, b"pit-cursor:" + payload, hashlib.sha256).digest()
+
+
+class InvalidCursor(ValueError):
+    def __init__(self, message: str = "invalid cursor"):
+        super().__init__(message)
+
+
+def _parse_cursor(
+    cursor: str, index: Optional[str] = None
+) -> Tuple[Optional[list], Optional[dict]]:
+    """cursor から sort の値と（PIT モードなら）PIT を取り出す
+
+    PIT の cursor は署名と index を確かめ、合わなければ InvalidCursor にする。
+    """
+    value = _cursor_to_sort(cursor)
+    if isinstance(value, dict):
+        (payload, mac) = (value.get("d"), value.get("m"))
+        if not isinstance(payload, bytes) or not isinstance(mac, bytes):
+            raise InvalidCursor()
+        if not hmac.compare_digest(mac, _cursor_mac(payload)):
+            raise InvalidCursor()
+        try:
+            value = msgpack.loads(payload, raw=False)
+            (values, pit) = (value["s"], {"id": value["p"], "t": value["t"]})
+        except (ValueError, KeyError, TypeError):
+            raise InvalidCursor()
+        if value.get("i") != index:
+            raise InvalidCursor()
+        return (values, pit)
+    elif isinstance(value, list):
+        return (value, None)
+    return (None, None)
+
+
+def parse_datetime(value) -> datetime:
+    """ES の日時を読む
+
+    保存されている形（isoformat の出力や ``Z`` 付き）は fromisoformat で読み、
+    それ以外だけ dateutil を使う。
+    """
+    if isinstance(value, datetime):
+        return value
+    try:
+        if value.endswith("Z"):
+            return datetime.fromisoformat(value[:-1] + "+00:00")
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return dateutil.parser.parse(value)
+
+
+def _observe_es(operation: str, started: float, res: Any = None):
+    metrics.ES_REQUEST_SECONDS.observe(time.perf_counter() - started, operation)
+    took = res.get("took") if isinstance(res, dict) else None
+    if took is not None:
+        metrics.ES_TOOK_SECONDS.observe(took / 1000, operation)
+
+
+def _source_params(fields: Optional[List[str]]) -> Dict[str, Any]:
+    """get/mget 用の _source 指定（fields が None なら全体）"""
+    if fields is None:
+        return {}
+    elif not fields:
+        return {"_source": False}
+    else:
+        return {"_source_includes": fields}
+
+
+class PageBoundaryCache:
+    """検索結果全体の先頭・末尾の sort 値を Redis に短時間保存する
+
+    after / before 付きのページで前のページがあるかを知るには結果全体の先頭（末尾）が
+    必要になる。これは最初（最後）のページを返したときに分かるので覚えておき、
+    分からないときだけ先頭を取るための検索を msearch に加える。
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def fingerprint(index: str, query: Optional[dict], sort) -> str:
+        normalized = json.dumps(
+            [index, query, sort], sort_keys=True, separators=(",", ":"), default=str
+        )
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    async def get(self, fingerprint: str, edge: str) -> Optional[list]:
+        if self.ttl <= 0:
+            return None
+        try:
+            with (await services.redis_pool) as r:
+                value = await r.get(_PAGE_BOUNDARY_KEY_PREFIX + fingerprint + edge)
+        except Exception:
+            _LOGGER.exception("exception:")
+            value = None
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return msgpack.loads(value, raw=False)
+
+    async def set(self, fingerprint: str, edges: Dict[str, list]):
+        if self.ttl <= 0:
+            return
+        try:
+            with (await services.redis_pool) as r:
+                tr = r.pipeline()
+                for (edge, values) in edges.items():
+                    tr.setex(
+                        _PAGE_BOUNDARY_KEY_PREFIX + fingerprint + edge,
+                        self.ttl,
+                        msgpack.dumps(values),
+                    )
+                await tr.execute()
+        except Exception:
+            _LOGGER.exception("exception:")
+
+
+page_boundaries = PageBoundaryCache(settings.ES_PAGE_BOUNDARY_TTL)
+
+
+class PointInTimes:
+    """ページ送り用の point in time (PIT) を開き、Redis の ZSET で数を管理する
+
+    ZSET のスコアは PIT が ES 側で失効する時刻で、最後に使われてから keep_alive 秒後。
+    放置されたページ送りの PIT は ES が自動的に解放するので、ここでは
+    同時に開く数を max_open までに抑え、max_lifetime を過ぎた PIT を閉じて開き直す。
+    PIT には ES 7.10 以降が必要。
+    """
+
+    def __init__(self, keep_alive: int, max_lifetime: int, max_open: int):
+        self.keep_alive = keep_alive
+        self.max_lifetime = max_lifetime
+        self.max_open = max_open
+
+    async def open(self, index: str, force: bool = False) -> Optional[dict]:
+        """PIT を開く。上限に達している場合は None（force なら上限を無視する）"""
+        now = time.time()
+        if not force:
+            try:
+                with (await services.redis_pool) as r:
+                    await r.zremrangebyscore(_PIT_REDIS_KEY, max=now)
+                    if await r.zcard(_PIT_REDIS_KEY) >= self.max_open:
+                        _LOGGER.warning("too many open point in times")
+                        return None
+            except Exception:
+                _LOGGER.exception("exception:")
+
+        res = await services.es.transport.perform_request(
+            "POST",
+            "/{}/_pit".format(index),
+            params={"keep_alive": "{}s".format(self.keep_alive)},
+        )
+        pit = {"id": res["id"], "t": now}
+        await self._track(pit["id"])
+        return pit
+
+    async def close(self, pit_id: str):
+        try:
+            await services.es.transport.perform_request(
+                "DELETE", "/_pit", body={"id": pit_id}
+            )
+        except NotFoundError:
+            pass
+        except Exception:
+            _LOGGER.exception("exception:")
+        await self._untrack(pit_id)
+
+    async def search(self, index: str, body: dict, pit: dict) -> Tuple[dict, dict]:
+        """PIT の上で検索する。失効していたり古すぎたりする PIT は開き直す
+
+        search_after の値（_shard_doc を含む）は開き直した PIT では意味を持たないので、
+        続きのページでは開き直さずに InvalidCursor にする（最初のページから取り直す）。
+        """
+        resumed = "search_after" in body
+        if time.time() - pit["t"] > self.max_lifetime:
+            await self.close(pit["id"])
+            if resumed:
+                raise InvalidCursor("expired cursor")
+            pit = await self.open(index, force=True)
+
+        slow_queries.prepare(body)
+        for retry in (True, False):
+            body["pit"] = {"id": pit["id"], "keep_alive": "{}s".format(self.keep_alive)}
+            started = time.perf_counter()
+            try:
+                res = await services.es.transport.perform_request(
+                    "POST", "/_search", body=body
+                )
+                _observe_es("search_pit", started, res)
+                slow_queries.record(
+                    "search_pit", index, body, time.perf_counter() - started, res
+                )
+            except NotFoundError:
+                if not retry:
+                    raise
+                await self._untrack(pit["id"])
+                if resumed:
+                    raise InvalidCursor("expired cursor")
+                pit = await self.open(index, force=True)
+                continue
+            break
+
+        pit_id = res.get("pit_id") or pit["id"]
+        if pit_id != pit["id"]:
+            await self._untrack(pit["id"])
+        await self._track(pit_id)
+        return (res, {"id": pit_id, "t": pit["t"]})
+
+    async def _track(self, pit_id: str):
+        try:
+            with (await services.redis_pool) as r:
+                await r.zadd(_PIT_REDIS_KEY, time.time() + self.keep_alive, pit_id)
+        except Exception:
+            _LOGGER.exception("exception:")
+
+    async def _untrack(self, pit_id: str):
+        try:
+            with (await services.redis_pool) as r:
+                await r.zrem(_PIT_REDIS_KEY, pit_id)
+        except Exception:
+            _LOGGER.exception("exception:")
+
+
+point_in_times = PointInTimes(
+    settings.ES_PIT_KEEP_ALIVE, settings.ES_PIT_MAX_LIFETIME, settings.ES_PIT_MAX_OPEN
+)
+
+
 def _reversed_sort_spec(sort):
     r = []
     for s in sort:
@@ -58,14 +326,277 @@ def _reversed_sort_spec(sort):
     return r
 
 
+class BulkItemError(Exception):
+    """_bulk の 1 件ごとの失敗"""
+
+    def __init__(self, status: Optional[int], error: Any):
+        if isinstance(error, dict):
+            message = "{}: {}".format(error.get("type"), error.get("reason"))
+        else:
+            message = str(error)
+        super().__init__(message)
+        self.status = status
+        self.error = error
+
+
+class BulkWriter:
+    """書き込みをためて _bulk API でまとめて送る
+
+    ``max_actions`` 件または ``max_bytes`` バイトたまるか、``interval`` 秒ごとに送る。
+    各操作は Future を返し、その結果は _bulk の応答の対応する要素（失敗なら BulkItemError）。
+    送信中のリクエストは ``concurrency`` 個までで、確定していない操作が ``max_pending``
+    件を超えると、ES が追いつくまで新しい操作の受け付けを待たせる。
+    """
+
+    def __init__(
+        self,
+        max_actions: int = 500,
+        max_bytes: int = 5 * 1024 * 1024,
+        interval: float = 1.0,
+        max_pending: int = 5000,
+        concurrency: int = 2,
+    ):
+        self.max_actions = max_actions
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.max_pending = max_pending
+        self.concurrency = concurrency
+        self._buffer: List[Tuple[str, asyncio.Future]] = []
+        self._buffer_bytes = 0
+        # たまっている操作に refresh=wait_for で送るものがあるか
+        self._buffer_refresh = False
+        self._pending: Optional[asyncio.Semaphore] = None
+        self._inflight: Optional[asyncio.Semaphore] = None
+        self._tasks: List[asyncio.Future] = []
+        self._interval_task: Optional[asyncio.Future] = None
+
+    def start(self):
+        self._pending = asyncio.Semaphore(self.max_pending)
+        self._inflight = asyncio.Semaphore(self.concurrency)
+        self._interval_task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        if self._interval_task is not None:
+            self._interval_task.cancel()
+            self._interval_task = None
+        await self.flush()
+        if self._tasks:
+            await asyncio.wait(self._tasks)
+
+    async def index(self, index: str, id: Optional[str], doc: dict) -> asyncio.Future:
+        meta: Dict[str, Any] = {"_index": index}
+        if id is not None:
+            meta["_id"] = id
+        return await self._submit({"index": meta}, doc)
+
+    async def create(self, index: str, id: str, doc: dict) -> asyncio.Future:
+        """文書が無いときだけ書き込む（あれば 409 の BulkItemError）"""
+        return await self._submit({"create": {"_index": index, "_id": id}}, doc)
+
+    async def update(
+        self,
+        index: str,
+        id: str,
+        body: dict,
+        _source: Union[bool, dict] = False,
+        refresh: bool = False,
+    ) -> asyncio.Future:
+        """``body`` は update API と同じ形（``{"doc": ...}`` など）
+
+        ``_source`` は応答に含める文書（True か ``{"excludes": [...]}`` など）。
+        ``refresh`` なら、その操作を含む _bulk を refresh=wait_for で送る
+        （Future が終わった時点で検索に出る）。
+        """
+        meta: Dict[str, Any] = {"_index": index, "_id": id}
+        if _source:
+            meta["_source"] = _source
+        return await self._submit({"update": meta}, body, refresh)
+
+    async def delete(self, index: str, id: str) -> asyncio.Future:
+        return await self._submit({"delete": {"_index": index, "_id": id}})
+
+    async def flush(self):
+        """たまっている操作を送り、その応答を待つ"""
+        (batch, refresh) = self._take_batch()
+        if batch:
+            await self._send(batch, refresh)
+
+    async def _submit(
+        self, action: dict, source: Optional[dict] = None, refresh: bool = False
+    ):
+        if self._pending is None:
+            raise RuntimeError("BulkWriter is not started")
+        # backpressure
+        await self._pending.acquire()
+
+        serializer = services.es.transport.serializer
+        lines = serializer.dumps(action) + "\n"
+        if source is not None:
+            lines += serializer.dumps(source) + "\n"
+
+        future = asyncio.get_event_loop().create_future()
+        self._buffer.append((lines, future))
+        self._buffer_bytes += len(lines)
+        self._buffer_refresh = self._buffer_refresh or refresh
+        if (
+            len(self._buffer) >= self.max_actions
+            or self._buffer_bytes >= self.max_bytes
+        ):
+            self._tasks = [t for t in self._tasks if not t.done()]
+            self._tasks.append(asyncio.ensure_future(self._send(*self._take_batch())))
+        return future
+
+    def _take_batch(self) -> Tuple[List[Tuple[str, asyncio.Future]], bool]:
+        batch = (self._buffer, self._buffer_refresh)
+        (self._buffer, self._buffer_bytes, self._buffer_refresh) = ([], 0, False)
+        return batch
+
+    async def _send(self, batch: List[Tuple[str, asyncio.Future]], refresh: bool):
+        kwargs = {"refresh": "wait_for"} if refresh else {}
+        try:
+            async with self._inflight:
+                started = time.perf_counter()
+                res = await services.es.bulk(
+                    body="".join(b for (b, _) in batch), **kwargs
+                )
+                _observe_es("bulk", started, res)
+        except Exception as exc:
+            _LOGGER.exception("exception:")
+            for (_, future) in batch:
+                if not future.done():
+                    future.set_exception(exc)
+        else:
+            for ((_, future), item) in zip(batch, res.get("items") or []):
+                ((_, result),) = item.items()
+                if future.done():
+                    continue
+                if "error" in result:
+                    future.set_exception(
+                        BulkItemError(result.get("status"), result["error"])
+                    )
+                else:
+                    future.set_result(result)
+        finally:
+            # 応答に含まれなかった操作も待っている側に失敗として返す
+            for (_, future) in batch:
+                if not future.done():
+                    future.set_exception(
+                        BulkItemError(None, "no result in the _bulk response")
+                    )
+            for _ in batch:
+                self._pending.release()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                if self._buffer:
+                    await self.flush()
+            except Exception:
+                _LOGGER.exception("exception:")
+
+
+async def _search_with_boundaries(
+    index: str, body: dict, forward_sort, cursor: Optional[str], reverse_order: bool
+) -> Tuple[dict, bool]:
+    """通常の検索を行い、前のページ（逆順なら次のページ）があるかを合わせて返す"""
+    (query, sort, size) = (body["query"], body["sort"], body["size"] - 1)
+    edge = "tail" if reverse_order else "head"
+    fingerprint = page_boundaries.fingerprint(index, query, forward_sort)
+
+    search_meta = {"index": index}
+    msearch_body = [search_meta, body]
+    edge_sort = None
+    if cursor is not None:
+        edge_sort = await page_boundaries.get(fingerprint, edge)
+        if edge_sort is None:
+            msearch_body.extend(
+                [
+                    search_meta,
+                    {
+                        "_source": False,
+                        "size": 1,
+                        "track_total_hits": False,
+                        "query": query,
+                        "sort": sort,
+                    },
+                ]
+            )
+
+    slow_queries.prepare(body)
+    started = time.perf_counter()
+    msearch_res = await services.es.msearch(body=msearch_body)
+    _observe_es("search", started, msearch_res)
+    res = msearch_res["responses"][0]
+    slow_queries.record("search", index, body, time.perf_counter() - started, res)
+    hits = res["hits"]["hits"][:size]
+    has_more = len(res["hits"]["hits"]) > size
+
+    learned = {}
+    if cursor is None:
+        has_prev = False
+        if hits:
+            learned[edge] = hits[0]["sort"]
+    else:
+        if len(msearch_res["responses"]) > 1:
+            probe = msearch_res["responses"][1]["hits"]["hits"]
+            edge_sort = probe[0]["sort"] if probe else None
+            if edge_sort is not None:
+                learned[edge] = edge_sort
+        has_prev = bool(edge_sort is not None and hits and edge_sort != hits[0]["sort"])
+    if hits and not has_more:
+        learned["head" if reverse_order else "tail"] = hits[-1]["sort"]
+    if learned:
+        await page_boundaries.set(fingerprint, learned)
+    return (res, has_prev)
+
+
+# 閲覧者が指定されていないときに共有する既定値（どちらも変更されない）
+_ANONYMOUS = UnauthenticatedUser()
+_NO_CREDENTIALS = AuthCredentials()
+
+
+# 日本語を含む文章用（プラグインの要らない CJK の bi-gram）
+TEXT_ANALYSIS = {
+    "analyzer": {
+        "planets_text": {
+            "type": "custom",
+            "tokenizer": "standard",
+            "filter": ["cjk_width", "lowercase", "cjk_bigram"],
+        }
+    }
+}
+
+# 動的マッピングと同じく keyword サブフィールドを持つ文字列
+TEXT_WITH_KEYWORD = {
+    "type": "text",
+    "analyzer": "planets_text",
+    "fields": {"keyword": {"type": "keyword", "ignore_above": 256}},
+}
+
+# 検索も集計もしない文字列
+STORED_ONLY = {"type": "keyword", "index": False, "doc_values": False}
+
+
 class ESDocModel:
+    # エイリアスの名前。実体の index は planetsclub.services.indices が版ごとに作る
     ES_INDEX = ""
+    # ES_SETTINGS / ES_MAPPINGS を変えたら上げて migrate する
+    ES_INDEX_VERSION = 1
+    # index を作るときの設定とマッピング（None なら既定・動的マッピングに任せる）
+    ES_SETTINGS: Optional[dict] = None
+    ES_MAPPINGS: Optional[dict] = None
+    # index の default_pipeline にする ingest pipeline（_reindex や一括登録にも効く）
+    ES_PIPELINE: Optional[dict] = None
+    # 1 ページで数千件作られるので __dict__ を持たせない
+    __slots__ = ("_id", "_data", "_inner_hits", "_highlight", "_user", "_auth", "_memo")
     _id: Optional[str]
     _data: Dict[str, Any]
     _inner_hits: Optional[dict]
     _highlight: Optional[Dict[str, List]]
     _user: BaseUser
     _auth: AuthCredentials
+    _memo: Optional[Dict[str, Any]]
 
     def __init__(
         self,
@@ -80,8 +611,9 @@ class ESDocModel:
         self._data = data or {}
         self._inner_hits = inner_hits
         self._highlight = highlight
-        self._user = user or UnauthenticatedUser()
-        self._auth = auth or AuthCredentials()
+        self._user = user or _ANONYMOUS
+        self._auth = auth or _NO_CREDENTIALS
+        self._memo = None
 
     def __str__(self):
         return "<ESDocModel({}) id={}>".format(self.ES_INDEX, self._id)
@@ -96,6 +628,24 @@ class ESDocModel:
         else:
             return {}
 
+    def dumps(self) -> bytes:
+        """_source を msgpack にする（asdict と違ってコピーしない）"""
+        return msgpack.dumps(self._data)
+
+    def _converted(self, name: str, convert: Callable[[Any], Any]) -> Any:
+        """_data[name] を convert したもの（空なら None）。インスタンスごとに覚えておく"""
+        memo = self._memo
+        if memo is None:
+            memo = self._memo = {}
+        elif name in memo:
+            return memo[name]
+        v = self._data.get(name)
+        value = memo[name] = convert(v) if v else None
+        return value
+
+    def _datetime(self, name: str) -> Optional[datetime]:
+        return self._converted(name, parse_datetime)
+
     def authenticate(self, auth, user):
         self._auth = auth
         self._user = user
@@ -106,13 +656,18 @@ class ESDocModel:
         id: str,
         user: Optional[BaseUser],
         auth: Optional[AuthCredentials],
+        fields: Optional[List[str]] = None,
         **kwargs
     ) -> Optional[T]:
+        kwargs.update(_source_params(fields))
+        started = time.perf_counter()
         try:
             res = await services.es.get(index=cls.ES_INDEX, id=id, **kwargs)
         except NotFoundError:
             return None
-        return cls(res["_id"], data=res["_source"], user=user, auth=auth)
+        finally:
+            _observe_es("get", started)
+        return cls(res["_id"], data=res.get("_source"), user=user, auth=auth)
 
     @classmethod
     async def _es_mget(
@@ -120,22 +675,33 @@ class ESDocModel:
         ids: Sequence[str],
         user: Optional[BaseUser],
         auth: Optional[AuthCredentials],
+        fields: Optional[List[str]] = None,
         **kwargs
     ):
         if not isinstance(ids, list):
             ids = list(ids)
         if not ids:
             return []
+        kwargs.update(_source_params(fields))
+        started = time.perf_counter()
         res = await services.es.mget(index=cls.ES_INDEX, body={"ids": ids}, **kwargs)
+        _observe_es("mget", started)
         return [
-            cls(doc["_id"], data=doc["_source"], user=user, auth=auth)
+            cls(doc["_id"], data=doc.get("_source"), user=user, auth=auth)
             for doc in res["docs"]
             if doc["found"]
         ]
 
     @classmethod
     async def _es_search_raw(cls, body: dict, **kwargs):
-        return await services.es.search(index=cls.ES_INDEX, body=body, **kwargs)
+        slow_queries.prepare(body)
+        started = time.perf_counter()
+        res = await services.es.search(index=cls.ES_INDEX, body=body, **kwargs)
+        _observe_es("search_raw", started, res)
+        slow_queries.record(
+            "search_raw", cls.ES_INDEX, body, time.perf_counter() - started, res
+        )
+        return res
 
     @classmethod
     async def _es_search_pagable(
@@ -150,8 +716,20 @@ class ESDocModel:
         before: Optional[str],
         highlight=None,
         _source=None,
+        fields: Optional[List[str]] = None,
+        track_total_hits: Union[bool, int, None] = None,
+        consistent: bool = False,
+        aggs: Optional[dict] = None,
     ):
-        es = services.es
+        """search_after によるページング
+
+        ``fields`` が指定された場合は ``_source`` より優先し、そのフィールドだけを取得する。
+        ``track_total_hits`` は ES にそのまま渡す（False なら total_count は None）。
+        ``consistent`` なら最初のページで PIT を開き、以降のページは cursor に
+        埋め込んだ PIT の上で検索する（途中の更新で要素が飛んだり重複したりしない）。
+        ``aggs`` は同じ検索で集計し、結果を ``aggregations`` に入れる
+        （集計は search_after によらず検索条件に合う全体が対象）。
+        """
         if sort is None:
             sort = [{"_id": "desc"}]
 
@@ -164,89 +742,70 @@ class ESDocModel:
         if size > 2000:
             size = 2000
 
+        cursor = before if reverse_order else after
+        (search_after, pit) = _parse_cursor(cursor or "", cls.ES_INDEX)
+        if consistent and cursor is None:
+            pit = await point_in_times.open(cls.ES_INDEX)
+        if pit is not None:
+            # 暗黙の _shard_doc と違い、逆順のページでも順序が反転するよう明示する
+            sort = sort + [{"_shard_doc": "asc"}]
+
+        forward_sort = sort
         if reverse_order:
             sort = _reversed_sort_spec(sort)
 
         body = {"size": size + 1, "query": query, "sort": sort}
-        if not reverse_order and after:
-            search_after = _cursor_to_sort(after)
-            if len(sort) == len(search_after):
-                body["search_after"] = search_after
-        elif reverse_order and before:
-            search_after = _cursor_to_sort(before)
-            if len(sort) == len(search_after):
-                body["search_after"] = search_after
+        if search_after and len(sort) == len(search_after):
+            body["search_after"] = search_after
 
+        if track_total_hits is not None:
+            body["track_total_hits"] = track_total_hits
         if highlight:
             body["highlight"] = highlight
-        if _source:
+        if aggs:
+            body["aggs"] = aggs
+        if fields is not None:
+            _source = {"includes": fields} if fields else False
+        if _source is not None:
             body["_source"] = _source
 
-        search_meta = {"index": cls.ES_INDEX}
-        msearch_body = [search_meta, body]
-
-        nextprev: Optional[str] = None
+        prev = "has_next_page" if reverse_order else "has_previous_page"
         pagable: Dict[str, Any] = {}
-        if not reverse_order:
-            if after is None:
-                pagable["has_previous_page"] = False
-            else:
-                nextprev = "has_previous_page"
+        if pit is not None:
+            (res, pit) = await point_in_times.search(cls.ES_INDEX, body, pit)
+            hits = res["hits"]["hits"]
+            # スナップショットは変わらないので cursor の要素より前には必ず要素がある
+            pagable[prev] = bool(cursor is not None and hits)
         else:
-            if before is None:
-                pagable["has_next_page"] = False
-            else:
-                nextprev = "has_next_page"
-
-        if nextprev:
-            msearch_body.extend(
-                [
-                    search_meta,
-                    {"_source": False, "size": 1, "query": query, "sort": sort},
-                ]
+            (res, pagable[prev]) = await _search_with_boundaries(
+                cls.ES_INDEX, body, forward_sort, cursor, reverse_order
             )
+            hits = res["hits"]["hits"]
 
-        # wait tasks
-        msearch_res = await es.msearch(body=msearch_body)
-        res = msearch_res["responses"][0]
-        total = res["hits"]["total"]
-        total_count = total["value"]
-        total_rel = total["relation"]
-        hits = res["hits"]["hits"]
-
-        if not reverse_order:
-            if len(hits) > size:
-                pagable["has_next_page"] = True
-                hits = hits[:size]
-            else:
-                pagable["has_next_page"] = False
-        else:
-            if len(hits) > size:
-                pagable["has_previous_page"] = True
-                hits = hits[:size]
-            else:
-                pagable["has_previous_page"] = False
-
-        if nextprev:
-            nextprev_res = msearch_res["responses"][1]["hits"]["hits"]
-            initial = nextprev_res[0] if nextprev_res else None
-            pagable[nextprev] = bool(
-                initial and len(hits) and initial["sort"] != hits[0]["sort"]
-            )
+        total = res["hits"].get("total") or {}
+        (total_count, total_rel) = (total.get("value"), total.get("relation"))
 
+        pagable["has_previous_page" if reverse_order else "has_next_page"] = (
+            len(hits) > size
+        )
+        hits = hits[:size]
         if reverse_order:
             hits.reverse()
 
         if hits:
-            pagable["start_cursor"] = _sort_to_cursor(hits[0]["sort"])
-            pagable["end_cursor"] = _sort_to_cursor(hits[-1]["sort"])
+            pagable["start_cursor"] = _sort_to_cursor(
+                hits[0]["sort"], pit, cls.ES_INDEX
+            )
+            pagable["end_cursor"] = _sort_to_cursor(hits[-1]["sort"], pit, cls.ES_INDEX)
 
         pagable["total_count"] = total_count
         pagable["total_count_rel"] = total_rel
+        if aggs:
+            pagable["aggregations"] = res.get("aggregations") or {}
         pagable["items"] = [
             cls(
                 hit["_id"],
-                data=hit["_source"],
+                data=hit.get("_source"),
                 inner_hits=hit.get("inner_hits"),
                 highlight=hit.get("highlight"),
                 user=user,
@@ -263,7 +822,11 @@ class ESDocModel:
         self._id = res["_id"]
 
     async def _es_update(
-        self, update, refresh: Optional[bool] = None, doc_as_upsert=False, **kwargs
+        self,
+        update,
+        refresh: Union[bool, str, None] = None,
+        doc_as_upsert=False,
+        **kwargs
     ):
         if self._id is None:
             raise RuntimeError("This document doesn't have an id")
@@ -275,12 +838,52 @@ class ESDocModel:
         if doc_as_upsert:
             body["doc_as_upsert"] = True
 
+        started = time.perf_counter()
         res = await services.es.update(
             index=self.ES_INDEX, id=self._id, refresh=refresh, body=body, **kwargs
         )
+        _observe_es("update", started)
         self._id = res["_id"]
+        self._memo = None
         if kwargs["_source"]:
             self._data.update(res["get"]["_source"])
 
+    @classmethod
+    async def _es_bulk_update(
+        cls: Type[T],
+        updates: Sequence[Tuple[str, dict]],
+        user: Optional[BaseUser],
+        auth: Optional[AuthCredentials],
+        _source: Union[bool, dict] = True,
+        doc_as_upsert: bool = False,
+        refresh: bool = False,
+    ) -> List[Union[T, Exception]]:
+        """複数の文書の部分更新を BulkWriter で 1 回のリクエストにまとめる
+
+        失敗した文書の位置には例外（BulkItemError など）が入る。
+        ``refresh`` なら、返る時点で更新が検索に出ている。
+        """
+        writer = services.bulk_writer
+        futures = []
+        for (id, update) in updates:
+            body: Dict[str, Any] = {"doc": update}
+            if doc_as_upsert:
+                body["doc_as_upsert"] = True
+            futures.append(
+                await writer.update(
+                    cls.ES_INDEX, id, body, _source=_source, refresh=refresh
+                )
+            )
+        await writer.flush()
+
+        results: List[Union[T, Exception]] = []
+        for result in await asyncio.gather(*futures, return_exceptions=True):
+            if isinstance(result, Exception):
+                results.append(result)
+            else:
+                data = result.get("get", {}).get("_source")
+                results.append(cls(result["_id"], data=data, user=user, auth=auth))
+        return results
+
     async def _es_delete(self, refresh=False):
         await services.es.delete(index=self.ES_INDEX, id=self._id, refresh=refresh)
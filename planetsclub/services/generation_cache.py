@@ -0,0 +1,67 @@
+"""世代番号つきの Redis のキャッシュ
+
+エントリは保存した時点の世代番号とともに Redis に置き、読むときに現在の世代番号と
+同じものだけを使う。世代番号を進める（INCR する）と、それまでのエントリは
+まとめて使われなくなり、TTL で消える。Redis に繋がらなければキャッシュしない。
+"""
+
+import logging
+from typing import Any, Optional, Tuple
+
+import msgpack
+
+from planetsclub.services import metrics, services
+
+_LOGGER = logging.getLogger("planetsclub.services.generation_cache")
+
+
+class GenerationCache:
+    """``name`` は /metrics の cache ラベル（planetsclub_redis_cache_*）"""
+
+    def __init__(self, name: str, key_prefix: str, ttl: int, generation_key: str):
+        self.name = name
+        self.key_prefix = key_prefix
+        self.ttl = ttl
+        self.generation_key = generation_key
+        self.hits = 0
+        self.misses = 0
+
+    async def _load(self, key: str) -> Tuple[Optional[Any], int]:
+        """保存された値（現在の世代のものだけ）と現在の世代番号（使えなければ -1）"""
+        if self.ttl <= 0:
+            return (None, -1)
+        try:
+            with (await services.redis_pool) as r:
+                (generation, entry) = await r.mget(
+                    self.generation_key, self.key_prefix + key
+                )
+        except Exception:
+            _LOGGER.exception("exception:")
+            return (None, -1)
+
+        current = int(generation) if generation else 0
+        if entry:
+            try:
+                (entry_generation, value) = msgpack.loads(entry, raw=False)
+            except (ValueError, TypeError):
+                # 形式の違う（以前の版の）エントリは無いものとする
+                entry_generation = None
+            if entry_generation == current:
+                self.hits += 1
+                metrics.REDIS_CACHE_LOOKUPS.inc(self.name, "hit")
+                return (value, current)
+        self.misses += 1
+        metrics.REDIS_CACHE_LOOKUPS.inc(self.name, "miss")
+        return (None, current)
+
+    async def _store(self, key: str, generation: int, value: Any):
+        """``generation`` は保存する値を求める前に _load で読んだもの"""
+        if generation < 0 or self.ttl <= 0:
+            return
+        try:
+            with (await services.redis_pool) as r:
+                await r.setex(
+                    self.key_prefix + key, self.ttl, msgpack.dumps([generation, value])
+                )
+        except Exception:
+            _LOGGER.exception("exception:")
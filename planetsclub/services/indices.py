@@ -0,0 +1,256 @@
+"""Elasticsearch の index の作成と移行
+
+各 ESDocModel は ``ES_INDEX``（エイリアス名）、``ES_INDEX_VERSION``、``ES_SETTINGS``、
+``ES_MAPPINGS`` を宣言する。実体の index は ``<ES_INDEX>-v<ES_INDEX_VERSION>`` で、
+アプリケーションは常にエイリアスを通して読み書きする。
+
+    python -m planetsclub.services.indices status
+    python -m planetsclub.services.indices create
+    python -m planetsclub.services.indices migrate planets-archive [--delete-old]
+    python -m planetsclub.services.indices reprocess planets-archive
+
+migrate は新しい版の index を作り、_reindex で文書を写してからエイリアスを
+1 回の _aliases で付け替える（読み出しは止まらない）。写している間は
+refresh と複製を止めておき、終わったら宣言どおりの設定に戻す。
+エイリアスではなく同じ名前の index がある（以前のままの）場合は、
+付け替えと同時にその index を削除する。
+既に宣言された版を指しているなら、refresh_interval などの設定だけを合わせる。
+
+ES_PIPELINE（index の default_pipeline）は移行で写す文書と新しく書く文書に適用される。
+同じ版のままパイプラインを変えたときは、reprocess で登録し直して既存の文書にも通す。
+
+写している間の書き込みが新しい index から漏れないよう、古い index には
+index.blocks.write を付ける（移行中の更新は失敗する）。失敗したら外すが、
+付け替えた後は付けたままにする（古い index に戻すときは外すこと）。
+"""
+
+import argparse
+import asyncio
+import logging
+import sys
+import time
+from typing import Any, Dict, List, Optional, TextIO, Type
+
+from elasticsearch import NotFoundError
+
+from planetsclub.services import create_elasticsearch, services
+
+_LOGGER = logging.getLogger("planetsclub.services.indices")
+
+# 移行中の設定
+_REINDEX_SETTINGS = {"index": {"refresh_interval": "-1", "number_of_replicas": 0}}
+_WRITE_BLOCK = {"index": {"blocks.write": True}}
+_NO_WRITE_BLOCK = {"index": {"blocks.write": False}}
+
+_POLL_INTERVAL = 2.0
+
+
+def index_name(model) -> str:
+    return "{}-v{}".format(model.ES_INDEX, model.ES_INDEX_VERSION)
+
+
+def index_body(model, settings: Optional[dict] = None) -> dict:
+    body: Dict[str, Any] = {"settings": dict(settings or model.ES_SETTINGS or {})}
+    if model.ES_PIPELINE:
+        body["settings"]["index"] = dict(
+            body["settings"].get("index", {}), default_pipeline=index_name(model)
+        )
+    if model.ES_MAPPINGS:
+        body["mappings"] = model.ES_MAPPINGS
+    return body
+
+
+def dynamic_settings(model) -> dict:
+    """作成後に変えられる設定（移行の後に戻すもの）"""
+    index = (model.ES_SETTINGS or {}).get("index", {})
+    return {
+        "index": {
+            "refresh_interval": index.get("refresh_interval", "1s"),
+            "number_of_replicas": index.get("number_of_replicas", 1),
+        }
+    }
+
+
+async def current_indices(alias: str) -> List[str]:
+    """エイリアスの指す index（エイリアスでなく index そのものならその名前）"""
+    es = services.es
+    try:
+        res = await es.indices.get_alias(name=alias)
+        return sorted(res.keys())
+    except NotFoundError:
+        pass
+    if await es.indices.exists(index=alias):
+        return [alias]
+    return []
+
+
+def swap_actions(alias: str, old: List[str], new: str) -> List[dict]:
+    actions: List[dict] = []
+    for index in old:
+        if index == alias:
+            # エイリアスの無かった以前の index は付け替えと同時に消す
+            actions.append({"remove_index": {"index": index}})
+        else:
+            actions.append({"remove": {"index": index, "alias": alias}})
+    actions.append({"add": {"index": new, "alias": alias}})
+    return actions
+
+
+async def create(model) -> bool:
+    """index とエイリアスが無ければ作る（作ったら True）"""
+    es = services.es
+    if await current_indices(model.ES_INDEX):
+        return False
+    name = index_name(model)
+    await _put_pipeline(model)
+    await es.indices.create(index=name, body=index_body(model))
+    await es.indices.update_aliases(
+        body={"actions": [{"add": {"index": name, "alias": model.ES_INDEX}}]}
+    )
+    _LOGGER.info("created %s as %s", name, model.ES_INDEX)
+    return True
+
+
+async def migrate(model, delete_old: bool = False, out: Optional[TextIO] = None):
+    """宣言された版の index に写してエイリアスを付け替える"""
+    es = services.es
+    (alias, new) = (model.ES_INDEX, index_name(model))
+    old = await current_indices(alias)
+    if old == [new]:
+        await _put_pipeline(model)
+        await es.indices.put_settings(index=new, body=dynamic_settings(model))
+        _LOGGER.info("%s already points to %s", alias, new)
+        return
+    if not old:
+        await create(model)
+        return
+
+    reindex_settings = dict(model.ES_SETTINGS or {})
+    reindex_settings["index"] = dict(
+        reindex_settings.get("index", {}), **_REINDEX_SETTINGS["index"]
+    )
+    await _put_pipeline(model)
+    await es.indices.create(index=new, body=index_body(model, reindex_settings))
+
+    await es.indices.put_settings(index=",".join(old), body=_WRITE_BLOCK)
+    try:
+        started = time.perf_counter()
+        res = await es.reindex(
+            body={"source": {"index": alias}, "dest": {"index": new}},
+            wait_for_completion=False,
+        )
+        await wait_for_task(res["task"], started, out)
+
+        await es.indices.put_settings(index=new, body=dynamic_settings(model))
+        await es.indices.refresh(index=new)
+        await es.indices.update_aliases(body={"actions": swap_actions(alias, old, new)})
+    except BaseException:
+        await es.indices.put_settings(index=",".join(old), body=_NO_WRITE_BLOCK)
+        raise
+    _LOGGER.info("%s now points to %s (was %s)", alias, new, ", ".join(old))
+
+    if delete_old:
+        for index in old:
+            if index != alias:
+                await es.indices.delete(index=index)
+                await es.ingest.delete_pipeline(id=index, ignore=404)
+
+
+async def reprocess(model, out: Optional[TextIO] = None):
+    """ES_PIPELINE を登録し直し、既存の文書にも _update_by_query で通す"""
+    if not model.ES_PIPELINE:
+        return
+    await _put_pipeline(model)
+    started = time.perf_counter()
+    res = await services.es.update_by_query(
+        index=model.ES_INDEX,
+        pipeline=index_name(model),
+        conflicts="proceed",
+        wait_for_completion=False,
+    )
+    await wait_for_task(res["task"], started, out)
+
+
+async def _put_pipeline(model):
+    """index と同じ名前で ES_PIPELINE を登録する（default_pipeline から参照する）"""
+    if model.ES_PIPELINE:
+        await services.es.ingest.put_pipeline(
+            id=index_name(model), body=model.ES_PIPELINE
+        )
+
+
+async def wait_for_task(task_id: str, started: float, out: Optional[TextIO] = None):
+    """_reindex / _update_by_query のタスクの終わりを待ち、進み具合を表示する"""
+    while True:
+        await asyncio.sleep(_POLL_INTERVAL)
+        res = await services.es.tasks.get(task_id=task_id)
+        status = res["task"]["status"]
+        done = sum(status.get(k, 0) for k in ("created", "updated", "deleted", "noops"))
+        elapsed = time.perf_counter() - started
+        if out is not None:
+            print(
+                "processed {}/{} docs in {:.1f}s, {:.0f} docs/sec".format(
+                    done, status["total"], elapsed, done / elapsed if elapsed else 0.0
+                ),
+                file=out,
+                flush=True,
+            )
+        if res.get("completed"):
+            failures = (res.get("response") or {}).get("failures") or []
+            if res.get("error") or failures:
+                raise RuntimeError(
+                    "reindex failed: {}".format(res.get("error") or failures[:3])
+                )
+            return
+
+
+def _models() -> List[Type]:
+    # モデルはこのモジュールを import するのでここで読み込む
+    from planetsclub.archives.models import ArchiveContentModel, ArchiveModel
+    from planetsclub.users.models import UserModel
+
+    return [ArchiveModel, ArchiveContentModel, UserModel]
+
+
+async def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m planetsclub.services.indices")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("status")
+    subparsers.add_parser("create")
+    migrate_parser = subparsers.add_parser("migrate")
+    migrate_parser.add_argument("alias", nargs="?")
+    migrate_parser.add_argument("--delete-old", action="store_true")
+    reprocess_parser = subparsers.add_parser("reprocess")
+    reprocess_parser.add_argument("alias", nargs="?")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    services.es = create_elasticsearch()
+    try:
+        models = _models()
+        if args.command in ("migrate", "reprocess") and args.alias:
+            models = [m for m in models if m.ES_INDEX == args.alias]
+            if not models:
+                parser.error("unknown index: " + args.alias)
+        for model in models:
+            if args.command == "status":
+                current = await current_indices(model.ES_INDEX)
+                print(
+                    "{}: {} (declared {})".format(
+                        model.ES_INDEX,
+                        ", ".join(current) or "missing",
+                        index_name(model),
+                    )
+                )
+            elif args.command == "create":
+                await create(model)
+            elif args.command == "reprocess":
+                await reprocess(model, sys.stderr)
+            else:
+                await migrate(model, args.delete_old, sys.stderr)
+    finally:
+        await services.es.transport.close()
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(main())
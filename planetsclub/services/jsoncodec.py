@@ -0,0 +1,94 @@
+"""JSON の符号化・復号
+
+orjson、ujson、標準の json のうち使えるものを選ぶ（``JSON_CODEC`` で指定、既定は auto）。
+
+- ``dumps``: datetime や Enum を ``default`` で変換する。ujson は変換の仕組みを
+  持たず datetime を黙って数値にしてしまうので、ujson の場合は標準の json を使う。
+- ``dumps_native``: 値が JSON の型だけからなる場合（GraphQL の結果など）に使う最速の経路。
+- ``loads``
+"""
+
+import json
+import logging
+from typing import Any, Callable, Optional
+
+_LOGGER = logging.getLogger("planetsclub.services.jsoncodec")
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+_std_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+
+def _std_dumps(obj: Any, default: Optional[Callable[[Any], Any]] = None) -> str:
+    if default is None:
+        return _std_encoder.encode(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=default)
+
+
+class JSONCodec:
+    name = "json"
+
+    def dumps(self, obj: Any, default: Optional[Callable[[Any], Any]] = None) -> str:
+        return _std_dumps(obj, default)
+
+    def dumps_native(self, obj: Any) -> bytes:
+        return _std_encoder.encode(obj).encode("utf-8")
+
+    def loads(self, s: Any) -> Any:
+        return json.loads(s)
+
+
+class UJSONCodec(JSONCodec):
+    name = "ujson"
+
+    def dumps_native(self, obj: Any) -> bytes:
+        return ujson.dumps(
+            obj, ensure_ascii=False, escape_forward_slashes=False
+        ).encode("utf-8")
+
+    def loads(self, s: Any) -> Any:
+        return ujson.loads(s)
+
+
+class ORJSONCodec(JSONCodec):
+    name = "orjson"
+
+    def __init__(self):
+        # datetime も default を通して標準の json と同じ isoformat にする
+        self._option = getattr(orjson, "OPT_PASSTHROUGH_DATETIME", 0)
+
+    def dumps(self, obj: Any, default: Optional[Callable[[Any], Any]] = None) -> str:
+        return orjson.dumps(obj, default=default, option=self._option).decode("utf-8")
+
+    def dumps_native(self, obj: Any) -> bytes:
+        return orjson.dumps(obj)
+
+    def loads(self, s: Any) -> Any:
+        return orjson.loads(s)
+
+
+_CODECS = {"orjson": (orjson, ORJSONCodec), "ujson": (ujson, UJSONCodec)}
+
+
+def get_codec(name: str = "auto") -> JSONCodec:
+    """``name`` のコーデック。入っていなければ使えるもののうち速いものにする"""
+    if name == "json":
+        return JSONCodec()
+    if name != "auto":
+        (module, codec) = _CODECS.get(name, (None, None))
+        if module is not None:
+            return codec()
+        _LOGGER.warning("JSON codec %r is not available", name)
+    for (module, codec) in _CODECS.values():
+        if module is not None:
+            return codec()
+    return JSONCodec()
@@ -0,0 +1,80 @@
+"""ワーカープロセス内のキャッシュ"""
+
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Generic, Hashable, Optional, Tuple, TypeVar
+
+from planetsclub.services import metrics
+
+V = TypeVar("V")
+
+
+class LocalCache(Generic[V]):
+    """A bounded LRU cache whose entries expire after ``ttl`` seconds
+
+    A cache with a ``name`` also counts its hits, misses, evictions and
+    expirations in ``planetsclub_local_cache_events_total`` (for sizing).
+    """
+
+    def __init__(self, maxsize: int, ttl: float, name: Optional[str] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self._entries: "OrderedDict[Hashable, Tuple[float, V]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[V]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            self._count("miss")
+            return None
+
+        (expires_at, value) = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            self._count("expiration")
+            self._count("miss")
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        self._count("hit")
+        return value
+
+    def set(self, key: Hashable, value: V) -> None:
+        entries = self._entries
+        entries[key] = (time.monotonic() + self.ttl, value)
+        entries.move_to_end(key)
+        while len(entries) > self.maxsize:
+            entries.popitem(last=False)
+            self.evictions += 1
+            self._count("eviction")
+
+    def pop(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def _count(self, event: str):
+        if self.name is not None:
+            metrics.LOCAL_CACHE_EVENTS.inc(self.name, event)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
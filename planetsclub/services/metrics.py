@@ -0,0 +1,365 @@
+"""Prometheus 形式のメトリクス
+
+各ワーカーは自分の値を持ち、一定間隔で Redis のホストごとのハッシュに書き込む。
+``/metrics`` はそのホストの全ワーカーの値を足し合わせて返すので、gunicorn の
+ワーカーが複数あってもどのワーカーが応答しても同じ集計になる。
+止まったワーカーの値は別のハッシュに足し込んで残す（再起動で合計が減らない）。
+"""
+
+import logging
+import os
+import socket
+import time
+from bisect import bisect_left
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import aiohttp
+import msgpack
+from aioredis.connection import RedisConnection
+from aioredis.pool import ConnectionsPool
+
+_LOGGER = logging.getLogger("planetsclub.services.metrics")
+
+_REDIS_KEY_PREFIX = "planetsclub-metrics-"
+_RETIRED_KEY_PREFIX = "planetsclub-metrics-retired-"
+
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+Labels = Tuple[str, ...]
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Labels, Any] = {}
+
+    def snapshot(self) -> List[list]:
+        return [[list(labels), _copy(v)] for (labels, v) in self._values.items()]
+
+    def _format_labels(self, labels: Iterable[str], extra: str = "") -> str:
+        pairs = [
+            '{}="{}"'.format(k, _escape(v)) for (k, v) in zip(self.labelnames, labels)
+        ]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    @staticmethod
+    def merge(a, b):
+        return a + b
+
+    def render(self, values: Dict[Labels, Any]) -> List[str]:
+        return [
+            "{}{} {}".format(self.name, self._format_labels(labels), _num(value))
+            for (labels, value) in sorted(values.items())
+        ]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels: str):
+        # [バケットごとの件数..., +Inf の件数, 合計]（バケットは累積しない）
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        entry[bisect_left(self.buckets, value)] += 1
+        entry[-1] += value
+
+    @staticmethod
+    def merge(a, b):
+        return [x + y for (x, y) in zip(a, b)]
+
+    def render(self, values: Dict[Labels, Any]) -> List[str]:
+        lines = []
+        for (labels, entry) in sorted(values.items()):
+            count = 0
+            for (bound, n) in zip(self.buckets + (float("inf"),), entry):
+                count += n
+                le = 'le="{}"'.format("+Inf" if bound == float("inf") else bound)
+                lines.append(
+                    "{}_bucket{} {}".format(
+                        self.name, self._format_labels(labels, le), int(count)
+                    )
+                )
+            suffix = self._format_labels(labels)
+            lines.append("{}_sum{} {}".format(self.name, suffix, _num(entry[-1])))
+            lines.append("{}_count{} {}".format(self.name, suffix, int(count)))
+        return lines
+
+
+def _copy(value):
+    return list(value) if isinstance(value, list) else value
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _num(value: float) -> str:
+    return repr(float(value))
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (), **kw):
+        return self._register(Histogram(name, help, labelnames, **kw))
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError("duplicate metric: " + metric.name)
+        self._metrics[metric.name] = metric
+        return metric
+
+    def snapshot(self) -> Dict[str, List[list]]:
+        return {name: m.snapshot() for (name, m) in self._metrics.items()}
+
+    def render(self, snapshots: Iterable[Dict[str, List[list]]]) -> str:
+        """複数のワーカーのスナップショットを足し合わせて text format にする"""
+        merged: Dict[str, Dict[Labels, Any]] = {name: {} for name in self._metrics}
+        for snapshot in snapshots:
+            for (name, values) in snapshot.items():
+                metric = self._metrics.get(name)
+                if metric is None:
+                    continue
+                target = merged[name]
+                for (labels, value) in values:
+                    labels = tuple(labels)
+                    current = target.get(labels)
+                    target[labels] = (
+                        value if current is None else metric.merge(current, value)
+                    )
+
+        lines = []
+        for (name, metric) in self._metrics.items():
+            lines.append("# HELP {} {}".format(name, metric.help))
+            lines.append("# TYPE {} {}".format(name, metric.type))
+            lines.extend(metric.render(merged[name]))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+GRAPHQL_OPERATION_SECONDS = registry.histogram(
+    "planetsclub_graphql_operation_seconds",
+    "GraphQL operation latency",
+    ("operation", "type", "cached"),
+)
+GRAPHQL_RESOLVER_SECONDS = registry.histogram(
+    "planetsclub_graphql_resolver_seconds",
+    "Latency of root and asynchronous GraphQL field resolvers",
+    ("field",),
+)
+ES_REQUEST_SECONDS = registry.histogram(
+    "planetsclub_es_request_seconds",
+    "Elasticsearch request latency seen by the client",
+    ("operation",),
+)
+ES_TOOK_SECONDS = registry.histogram(
+    "planetsclub_es_took_seconds", "Elasticsearch reported took", ("operation",)
+)
+REDIS_COMMAND_SECONDS = registry.histogram(
+    "planetsclub_redis_command_seconds", "Redis command latency", ("command",)
+)
+REDIS_POOL_WAIT_SECONDS = registry.histogram(
+    "planetsclub_redis_pool_wait_seconds", "Time spent waiting for a Redis connection"
+)
+REDIS_CACHE_LOOKUPS = registry.counter(
+    "planetsclub_redis_cache_lookups_total",
+    "Lookups in the Redis-backed caches by result (hit / miss)",
+    ("cache", "result"),
+)
+REDIS_CACHE_SAVED_SECONDS = registry.counter(
+    "planetsclub_redis_cache_saved_seconds_total",
+    "Execution time saved by cache hits (the time the cached result took to compute)",
+    ("cache",),
+)
+LOCAL_CACHE_EVENTS = registry.counter(
+    "planetsclub_local_cache_events_total",
+    "Worker-local cache hits, misses, evictions and expirations",
+    ("cache", "event"),
+)
+MSGHUB_MESSAGES = registry.counter(
+    "planetsclub_msghub_messages_total",
+    "Subscription messages delivered, dropped or coalesced, and slow subscribers"
+    " disconnected",
+    ("event",),
+)
+MSGHUB_LAG_SECONDS = registry.histogram(
+    "planetsclub_msghub_lag_seconds",
+    "Time a message waited in a subscription queue before it was read",
+)
+HTTP_CLIENT_SECONDS = registry.histogram(
+    "planetsclub_http_client_seconds",
+    "Outbound HTTP request latency",
+    ("method", "host", "status"),
+)
+
+
+class MetricsPublisher:
+    """このワーカーの値を Redis に書き、同じホストの全ワーカーの値を集める"""
+
+    def __init__(self, registry: Registry, interval: float):
+        self.registry = registry
+        self.interval = interval
+        self.key = _REDIS_KEY_PREFIX + socket.gethostname()
+        self.retired_key = _RETIRED_KEY_PREFIX + socket.gethostname()
+        self.worker = str(os.getpid())
+
+    @property
+    def ttl(self) -> int:
+        return int(self.interval * 3) + 1
+
+    async def publish(self, redis_pool):
+        snapshot = msgpack.dumps([time.time(), self.registry.snapshot()])
+        with (await redis_pool) as r:
+            tr = r.pipeline()
+            tr.hset(self.key, self.worker, snapshot)
+            tr.expire(self.key, self.ttl)
+            tr.expire(self.retired_key, self.ttl)
+            await tr.execute()
+
+    async def collect(self, redis_pool) -> List[Dict[str, List[list]]]:
+        """最新の値を書いてから、全てのワーカー（止まったものを含む）の値を返す"""
+        await self.publish(redis_pool)
+        with (await redis_pool) as r:
+            entries = await r.hgetall(self.key)
+            snapshots = []
+            for (worker, value) in entries.items():
+                (published_at, snapshot) = msgpack.loads(value, raw=False)
+                if time.time() - published_at <= self.interval * 3:
+                    snapshots.append(snapshot)
+                elif await r.hdel(self.key, worker):
+                    # 消せたワーカーだけが足し込む（同時に集めても二重に数えない）
+                    await self._retire(r, snapshot)
+            retired = await r.hgetall(self.retired_key)
+        if retired:
+            snapshots.append(_unflatten(retired))
+        return snapshots
+
+    async def _retire(self, r, snapshot: Dict[str, List[list]]):
+        """止まったワーカーの値を retired_key のハッシュに足し込む"""
+        tr = r.pipeline()
+        for (name, values) in snapshot.items():
+            for (labels, value) in values:
+                if isinstance(value, list):
+                    for (i, v) in enumerate(value):
+                        field = msgpack.dumps([name, labels, i])
+                        tr.hincrbyfloat(self.retired_key, field, v)
+                else:
+                    field = msgpack.dumps([name, labels, None])
+                    tr.hincrbyfloat(self.retired_key, field, value)
+        tr.expire(self.retired_key, self.ttl)
+        await tr.execute()
+
+
+def _unflatten(fields: Dict[bytes, bytes]) -> Dict[str, List[list]]:
+    """_retire で書いたハッシュをスナップショットの形に戻す"""
+    values: Dict[Tuple[str, Labels], Any] = {}
+    for (field, value) in fields.items():
+        (name, labels, i) = msgpack.loads(field, raw=False)
+        key = (name, tuple(labels))
+        if i is None:
+            values[key] = float(value)
+        else:
+            entry = values.setdefault(key, [])
+            entry.extend([0.0] * (i + 1 - len(entry)))
+            entry[i] = float(value)
+    snapshot: Dict[str, List[list]] = {}
+    for ((name, labels), value) in values.items():
+        snapshot.setdefault(name, []).append([list(labels), value])
+    return snapshot
+
+
+class InstrumentedConnection(RedisConnection):
+    """コマンドごとの応答時間を測る aioredis の接続"""
+
+    def execute(self, command, *args, **kwargs):
+        fut = super().execute(command, *args, **kwargs)
+        started = time.perf_counter()
+        name = command.decode() if isinstance(command, bytes) else str(command)
+
+        def done(_):
+            REDIS_COMMAND_SECONDS.observe(time.perf_counter() - started, name.upper())
+
+        fut.add_done_callback(done)
+        return fut
+
+
+class InstrumentedPool(ConnectionsPool):
+    """接続が空くのを待った時間を測る aioredis のプール"""
+
+    async def acquire(self, command=None, args=()):
+        started = time.perf_counter()
+        try:
+            return await super().acquire(command, args)
+        finally:
+            REDIS_POOL_WAIT_SECONDS.observe(time.perf_counter() - started)
+
+
+def http_trace_config() -> aiohttp.TraceConfig:
+    """aiohttp.ClientSession の外向きのリクエストを測る"""
+
+    async def on_request_start(session, ctx, params):
+        ctx.started = time.perf_counter()
+
+    async def on_request_end(session, ctx, params):
+        _observe_http(ctx, params, str(params.response.status))
+
+    async def on_request_exception(session, ctx, params):
+        _observe_http(ctx, params, "error")
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    return trace_config
+
+
+def _observe_http(ctx, params, status: str):
+    started: Optional[float] = getattr(ctx, "started", None)
+    if started is not None:
+        HTTP_CLIENT_SECONDS.observe(
+            time.perf_counter() - started, params.method, params.url.host or "", status
+        )
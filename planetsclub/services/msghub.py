@@ -1,13 +1,17 @@
-"""Redisを用いたメッセージブローカーの実装（未使用）"""
+"""Redisを用いたメッセージブローカーの実装"""
 
 
 import asyncio
 import logging
-import weakref
+import time
+from collections import OrderedDict
+from enum import Enum
+from typing import Any, Dict, List, Optional, Tuple
 
 import msgpack
 from async_timeout import timeout
 
+from planetsclub.services import metrics
 from planetsclub.services.redis import create_redis
 
 _LOGGER = logging.getLogger("planetsclub.msghub")
@@ -17,23 +21,246 @@ _PING_INTERVAL = 10
 _PING_TIMEOUT = 4
 
 
+class TopicTrie:
+    """Registry of receivers keyed by topic pattern
+
+    A pattern is either an exact topic (``"a.b"``), ``"*"`` or a prefix
+    wildcard (``"a.b.*"``). A prefix wildcard matches the prefix itself and
+    every topic below it. Receivers are held strongly until discarded.
+    """
+
+    __slots__ = ("_root",)
+
+    def __init__(self):
+        self._root = _TrieNode()
+
+    @staticmethod
+    def _parse(pattern):
+        if pattern == "*":
+            return ((), True)
+        nodes = pattern.split(".")
+        wildcard = nodes[-1] == "*"
+        if wildcard:
+            nodes.pop()
+        if not nodes or "*" in nodes or "" in nodes:
+            raise ValueError("invalid topic pattern: {!r}".format(pattern))
+        return (nodes, wildcard)
+
+    def add(self, pattern, receiver):
+        (nodes, wildcard) = self._parse(pattern)
+        node = self._root
+        for name in nodes:
+            child = node.children.get(name)
+            if child is None:
+                child = node.children[name] = _TrieNode()
+            node = child
+        if wildcard:
+            if node.wildcard is None:
+                node.wildcard = set()
+            node.wildcard.add(receiver)
+        else:
+            if node.exact is None:
+                node.exact = set()
+            node.exact.add(receiver)
+
+    def discard(self, pattern, receiver):
+        (nodes, wildcard) = self._parse(pattern)
+        path = [self._root]
+        for name in nodes:
+            node = path[-1].children.get(name)
+            if node is None:
+                return
+            path.append(node)
+
+        node = path[-1]
+        if wildcard:
+            if node.wildcard is not None:
+                node.wildcard.discard(receiver)
+                if not node.wildcard:
+                    node.wildcard = None
+        else:
+            if node.exact is not None:
+                node.exact.discard(receiver)
+                if not node.exact:
+                    node.exact = None
+
+        # prune empty branches
+        for i in range(len(nodes), 0, -1):
+            node = path[i]
+            if node.children or node.exact or node.wildcard:
+                break
+            del path[i - 1].children[nodes[i - 1]]
+
+    def match(self, topic):
+        """Return receivers of all patterns matching ``topic`` (without duplicates)"""
+        node = self._root
+        buckets = [node.wildcard] if node.wildcard else []
+        for name in topic.split("."):
+            node = node.children.get(name)
+            if node is None:
+                break
+            if node.wildcard:
+                buckets.append(node.wildcard)
+        else:
+            if node.exact:
+                buckets.append(node.exact)
+
+        if not buckets:
+            return ()
+        elif len(buckets) == 1:
+            return tuple(buckets[0])
+        return set().union(*buckets)
+
+    def clear(self):
+        self._root = _TrieNode()
+
+
+class _TrieNode:
+    __slots__ = ("children", "exact", "wildcard")
+
+    def __init__(self):
+        self.children = {}
+        self.exact = None
+        self.wildcard = None
+
+
+class OverflowPolicy(Enum):
+    DROP_OLDEST = "drop_oldest"  # 最も古いメッセージを捨てる
+    COALESCE = "coalesce"  # 同じキーの未読メッセージを置き換える
+    DISCONNECT = "disconnect"  # 購読を打ち切る
+
+
+class SubscriptionOverflow(Exception):
+    pass
+
+
 class Subscription:
-    def __init__(self, hub, queue, topics):
+    """A bounded per-subscriber queue
+
+    ``key(topic, data)`` decides which pending messages are coalesced under
+    :attr:`OverflowPolicy.COALESCE` (the topic by default).
+    """
+
+    def __init__(self, hub, topics, maxsize, overflow, key=None):
         self._hub = hub
-        self._queue = queue
         self.topics = topics
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self._key = key or (lambda topic, data: topic)
+        self._pending: "OrderedDict[Any, Tuple[str, Any, float]]" = OrderedDict()
+        self._seq = 0
+        self._waiter: Optional[asyncio.Future] = None
+        self._error: Optional[Exception] = None
+        self.delivered = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def _deliver(self, topic, data):
+        pending = self._pending
+        now = time.monotonic()
+        if self.overflow is OverflowPolicy.COALESCE:
+            key = self._key(topic, data)
+            if key in pending:
+                # 順序と enqueue 時刻は最初のメッセージのものを引き継ぐ
+                pending[key] = (topic, data, pending[key][2])
+                self.coalesced += 1
+                metrics.MSGHUB_MESSAGES.inc("coalesced")
+                return
+        else:
+            key = self._seq
+            self._seq += 1
+
+        if len(pending) >= self.maxsize:
+            if self.overflow is OverflowPolicy.DISCONNECT:
+                self._fail(SubscriptionOverflow("subscriber is too slow"))
+                return
+            pending.popitem(last=False)
+            self.dropped += 1
+            metrics.MSGHUB_MESSAGES.inc("dropped")
+
+        pending[key] = (topic, data, now)
+        self._wakeup()
+
+    def _fail(self, error):
+        self._error = error
+        self.dropped += len(self._pending) + 1
+        metrics.MSGHUB_MESSAGES.inc("dropped", amount=len(self._pending) + 1)
+        metrics.MSGHUB_MESSAGES.inc("disconnected")
+        self._pending.clear()
+        self._hub.unsubscribe(self)
+        self._wakeup()
+
+    def _wakeup(self):
+        waiter = self._waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def qsize(self):
+        return len(self._pending)
 
     async def get(self):
-        return await self._queue.get()
+        while not self._pending:
+            if self._error is not None:
+                raise self._error
+            self._waiter = asyncio.get_event_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+
+        (_, (topic, data, enqueued_at)) = self._pending.popitem(last=False)
+        lag = time.monotonic() - enqueued_at
+        self.last_lag = lag
+        if lag > self.max_lag:
+            self.max_lag = lag
+        self.delivered += 1
+        metrics.MSGHUB_LAG_SECONDS.observe(lag)
+        metrics.MSGHUB_MESSAGES.inc("delivered")
+        return (topic, data)
+
+    async def __aiter__(self):
+        try:
+            while True:
+                yield await self.get()
+        finally:
+            self.close()
 
     def close(self):
         self._hub.unsubscribe(self)
 
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "topics": list(self.topics),
+            "pending": len(self._pending),
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "last_lag": self.last_lag,
+            "max_lag": self.max_lag,
+        }
+
+
+class _Listener:
+    def __init__(self, callback):
+        self.callback = callback
+
+    def _deliver(self, topic, data):
+        try:
+            self.callback(topic, data)
+        except Exception:
+            _LOGGER.exception("exception in listener:")
+
 
 class MessageHub:
-    def __init__(self, redis_pool):
-        self._redis_pool = redis_pool
-        self._subscriptions = {}
+    def __init__(self, queue_size=100, overflow=OverflowPolicy.DROP_OLDEST):
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self._redis_pool = None
+        self._registry = TopicTrie()
+        self._subscriptions = set()
+        self._listeners = []
         self._redis_task = None
 
     async def _redis_subscriber(self):
@@ -70,26 +297,13 @@ class MessageHub:
                 _LOGGER.exception(exc)
                 await asyncio.sleep(2)
 
-    async def run(self):
+    async def run(self, redis_pool):
+        self._redis_pool = redis_pool
         self._redis_task = asyncio.ensure_future(self._redis_subscriber())
 
     async def _process_msg(self, topic, data):
-        def gen_topic_name():
-            yield "*"
-            nodes = topic.split(".")
-            for i in range(1, len(nodes) + 1):
-                yield ".".join(nodes[:i]) + ".*"
-            yield topic
-
-        subs = self._subscriptions
-        all_queues = set()
-        for to in gen_topic_name():
-            queues = subs.get(to)
-            if queues:
-                all_queues.update(queues)
-
-        for queue in all_queues:
-            await queue.put((topic, data))
+        for receiver in self._registry.match(topic):
+            receiver._deliver(topic, data)
 
     async def emit(self, topic, data):
         with (await self._redis_pool) as r:
@@ -98,7 +312,8 @@ class MessageHub:
     def close(self):
         if self._redis_task:
             self._redis_task.cancel()
-            self._subscriptions.clear()
+            for subscription in list(self._subscriptions):
+                self.unsubscribe(subscription)
 
     async def wait_close(self):
         if self._redis_task:
@@ -107,26 +322,44 @@ class MessageHub:
             except asyncio.CancelledError:
                 pass
 
-    def subscribe(self, topic_or_topics):
+    def add_listener(self, topic, callback):
+        """Call ``callback(topic, data)`` synchronously for each matching message
+
+        Unlike subscriptions, listeners survive ``close()``.
+        """
+        listener = _Listener(callback)
+        self._listeners.append((topic, listener))
+        self._registry.add(topic, listener)
+
+    def remove_listener(self, topic, callback):
+        for (i, (t, listener)) in enumerate(self._listeners):
+            if t == topic and listener.callback == callback:
+                self._registry.discard(topic, listener)
+                del self._listeners[i]
+                return
+
+    def subscribe(self, topic_or_topics, maxsize=None, overflow=None, key=None):
         if isinstance(topic_or_topics, str):
             topics = (topic_or_topics,)
         else:
             topics = tuple(set(topic_or_topics))
 
-        queue = asyncio.Queue()
-        subs = self._subscriptions
+        subscription = Subscription(
+            self,
+            topics,
+            maxsize or self.queue_size,
+            overflow or self.overflow,
+            key=key,
+        )
         for topic in topics:
-            if topic not in subs:
-                subs[topic] = weakref.WeakSet()
-            subs[topic].add(queue)
-
-        return Subscription(self, queue, topics)
+            self._registry.add(topic, subscription)
+        self._subscriptions.add(subscription)
+        return subscription
 
     def unsubscribe(self, subscription):
-        queue = subscription._queue
-        subs = self._subscriptions
         for topic in subscription.topics:
-            if topic in subs:
-                subs[topic].discard(queue)
-                if not subs[topic]:
-                    subs.pop(topic)
+            self._registry.discard(topic, subscription)
+        self._subscriptions.discard(subscription)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [subscription.stats() for subscription in self._subscriptions]
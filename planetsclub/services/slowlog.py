@@ -0,0 +1,140 @@
+"""Elasticsearch の遅い検索の記録
+
+``ES_SLOW_QUERY_THRESHOLD`` 秒以上かかった検索を、ES に送った body、``took``、
+ヒット数、元になった GraphQL の操作とともに ``ES_SLOW_QUERY_LOG`` に 1 行 1 件の
+JSON で書き出す（サイズでローテートする）。GraphQL の変数は、
+``ES_SLOW_QUERY_LOG_VARIABLES`` が無ければ名前だけを残す。
+
+profile の出力は次のどちらかの場合に付ける:
+
+- 管理者が ``X-ES-Profile: 1`` ヘッダ付きで送った操作: 検索そのものに
+  ``profile: true`` を付け、閾値によらず記録する
+- 遅かった検索のうち ``ES_SLOW_QUERY_PROFILE_SAMPLE`` の割合: 応答を返したあとで
+  ``profile: true`` を付けて裏で実行し直す
+"""
+
+import asyncio
+import json
+import logging
+import random
+import time
+from contextvars import ContextVar
+from logging.handlers import RotatingFileHandler
+from typing import Any, Optional
+
+from planetsclub import settings
+from planetsclub.services import services
+
+_LOGGER = logging.getLogger("planetsclub.services.slowlog")
+
+# 実行中の GraphQL の操作（GraphQLServer が設定する）
+current_operation: ContextVar[Optional[dict]] = ContextVar(
+    "current_operation", default=None
+)
+# この操作の検索に profile を付けるか
+profile_requested: ContextVar[bool] = ContextVar("profile_requested", default=False)
+
+
+class SlowQueryLog:
+    def __init__(
+        self,
+        threshold: float,
+        path: str,
+        max_bytes: int,
+        backups: int,
+        profile_sample: float,
+    ):
+        self.threshold = threshold
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.profile_sample = profile_sample
+        self._logger: Optional[logging.Logger] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def prepare(self, body: dict) -> bool:
+        """profile を要求された操作なら body に profile を付ける"""
+        if self.enabled and profile_requested.get():
+            body["profile"] = True
+            return True
+        return False
+
+    def record(
+        self, operation: str, index: str, body: dict, elapsed: float, res: Any
+    ) -> None:
+        """検索の結果を見て、遅ければ（または profile 付きなら）記録する"""
+        if not self.enabled:
+            return
+        profiled = bool(body.get("profile"))
+        if elapsed < self.threshold and not profiled:
+            return
+        try:
+            entry = self._entry(operation, index, body, elapsed, res)
+            if profiled:
+                entry["profile"] = res.get("profile")
+            elif self.profile_sample > 0 and random.random() < self.profile_sample:
+                asyncio.ensure_future(self._profile(entry, index, body))
+                return
+            self._write(entry)
+        except Exception:
+            _LOGGER.exception("exception:")
+
+    @staticmethod
+    def _entry(
+        operation: str, index: str, body: dict, elapsed: float, res: Any
+    ) -> dict:
+        hits = res.get("hits") or {}
+        total = hits.get("total")
+        if isinstance(total, dict):
+            total = total.get("value")
+        return {
+            "time": time.time(),
+            "operation": operation,
+            "index": index,
+            "elapsed": round(elapsed, 6),
+            "took": res.get("took"),
+            "timed_out": res.get("timed_out"),
+            "hits": len(hits.get("hits") or ()),
+            "total": total,
+            "graphql": current_operation.get(),
+            "body": {k: v for (k, v) in body.items() if k != "profile"},
+        }
+
+    async def _profile(self, entry: dict, index: str, body: dict):
+        try:
+            body = dict(body, profile=True)
+            # PIT の検索は index を指定できない
+            path = "/_search" if "pit" in body else "/{}/_search".format(index)
+            res = await services.es.transport.perform_request("POST", path, body=body)
+            entry["profile"] = res.get("profile")
+            entry["profile_took"] = res.get("took")
+        except Exception:
+            _LOGGER.exception("exception:")
+        self._write(entry)
+
+    def _write(self, entry: dict):
+        logger = self._logger
+        if logger is None:
+            logger = self._logger = logging.getLogger("planetsclub.slowlog")
+            logger.propagate = False
+            logger.setLevel(logging.INFO)
+            handler = RotatingFileHandler(
+                self.path,
+                maxBytes=self.max_bytes,
+                backupCount=self.backups,
+                encoding="utf-8",
+            )
+            logger.addHandler(handler)
+        logger.info(json.dumps(entry, ensure_ascii=False, default=str))
+
+
+slow_queries = SlowQueryLog(
+    settings.ES_SLOW_QUERY_THRESHOLD,
+    settings.ES_SLOW_QUERY_LOG,
+    settings.ES_SLOW_QUERY_LOG_MAX_BYTES,
+    settings.ES_SLOW_QUERY_LOG_BACKUPS,
+    settings.ES_SLOW_QUERY_PROFILE_SAMPLE,
+)
@@ -11,3 +11,74 @@ REDIS_URL = config("REDIS_URL")
 ELASTICSEARCH_HOSTS = config("ELASTICSEARCH_HOSTS").split(",")
 ELASTICSEARCH_HTTP_AUTH = tuple(config("ELASTICSEARCH_HTTP_AUTH").split(":"))
 ELASTICSEARCH_USE_SSL = config("ELASTICSEARCH_USE_SSL", cast=bool, default=True)
+ES_PAGE_BOUNDARY_TTL = config("ES_PAGE_BOUNDARY_TTL", cast=int, default=30)
+ES_PIT_KEEP_ALIVE = config("ES_PIT_KEEP_ALIVE", cast=int, default=120)
+ES_PIT_MAX_LIFETIME = config("ES_PIT_MAX_LIFETIME", cast=int, default=15 * 60)
+ES_PIT_MAX_OPEN = config("ES_PIT_MAX_OPEN", cast=int, default=200)
+ES_BULK_MAX_ACTIONS = config("ES_BULK_MAX_ACTIONS", cast=int, default=500)
+ES_BULK_MAX_BYTES = config("ES_BULK_MAX_BYTES", cast=int, default=5 * 1024 * 1024)
+ES_BULK_FLUSH_INTERVAL = config("ES_BULK_FLUSH_INTERVAL", cast=float, default=1.0)
+ES_BULK_MAX_PENDING = config("ES_BULK_MAX_PENDING", cast=int, default=5000)
+ES_BULK_CONCURRENCY = config("ES_BULK_CONCURRENCY", cast=int, default=2)
+# unified / fvh（fvh は index に term_vector が必要）
+ES_HIGHLIGHTER = config("ES_HIGHLIGHTER", default="unified")
+# 空なら遅い検索を記録しない
+ES_SLOW_QUERY_LOG = config("ES_SLOW_QUERY_LOG", default="")
+ES_SLOW_QUERY_THRESHOLD = config("ES_SLOW_QUERY_THRESHOLD", cast=float, default=1.0)
+ES_SLOW_QUERY_LOG_MAX_BYTES = config(
+    "ES_SLOW_QUERY_LOG_MAX_BYTES", cast=int, default=10 * 1024 * 1024
+)
+ES_SLOW_QUERY_LOG_BACKUPS = config("ES_SLOW_QUERY_LOG_BACKUPS", cast=int, default=5)
+# 記録に GraphQL の変数の値も残す（既定は変数の名前だけ）
+ES_SLOW_QUERY_LOG_VARIABLES = config(
+    "ES_SLOW_QUERY_LOG_VARIABLES", cast=bool, default=False
+)
+ES_SLOW_QUERY_PROFILE_SAMPLE = config(
+    "ES_SLOW_QUERY_PROFILE_SAMPLE", cast=float, default=0.0
+)
+
+METRICS_PUBLISH_INTERVAL = config("METRICS_PUBLISH_INTERVAL", cast=float, default=10.0)
+METRICS_MAX_OPERATION_LABELS = config(
+    "METRICS_MAX_OPERATION_LABELS", cast=int, default=100
+)
+# /metrics に Authorization: Bearer <METRICS_TOKEN> で接続する（空なら管理者だけ）
+METRICS_TOKEN = config("METRICS_TOKEN", default="")
+
+# auto / orjson / ujson / json
+JSON_CODEC = config("JSON_CODEC", default="auto")
+
+ARCHIVE_FACET_CACHE_TTL = config("ARCHIVE_FACET_CACHE_TTL", cast=int, default=300)
+
+ARCHIVE_SUGGEST_CACHE_SIZE = config(
+    "ARCHIVE_SUGGEST_CACHE_SIZE", cast=int, default=2000
+)
+ARCHIVE_SUGGEST_CACHE_TTL = config(
+    "ARCHIVE_SUGGEST_CACHE_TTL", cast=float, default=30.0
+)
+# inline: 本文と HTML もアーカイブの文書に置く
+# index: planets-archive-content に分けて置く（python -m planetsclub.archives.content）
+ARCHIVE_CONTENT_STORE = config("ARCHIVE_CONTENT_STORE", default="inline")
+
+USER_CACHE_SIZE = config("USER_CACHE_SIZE", cast=int, default=1000)
+USER_CACHE_TTL = config("USER_CACHE_TTL", cast=float, default=5.0)
+
+MSGHUB_QUEUE_SIZE = config("MSGHUB_QUEUE_SIZE", cast=int, default=100)
+MSGHUB_OVERFLOW_POLICY = config("MSGHUB_OVERFLOW_POLICY", default="drop_oldest")
+
+GRAPHQL_DOCUMENT_CACHE_SIZE = config(
+    "GRAPHQL_DOCUMENT_CACHE_SIZE", cast=int, default=256
+)
+GRAPHQL_PERSISTED_QUERY_TTL = config(
+    "GRAPHQL_PERSISTED_QUERY_TTL", cast=int, default=7 * 24 * 60 * 60
+)
+GRAPHQL_RESPONSE_CACHE_TTL = config("GRAPHQL_RESPONSE_CACHE_TTL", cast=int, default=60)
+# 静的に見積もった操作のコストの上限（planetsclub.graphql.cost）
+GRAPHQL_COST_LIMIT_ANONYMOUS = config(
+    "GRAPHQL_COST_LIMIT_ANONYMOUS", cast=int, default=1000
+)
+GRAPHQL_COST_LIMIT_MEMBER = config("GRAPHQL_COST_LIMIT_MEMBER", cast=int, default=5000)
+GRAPHQL_COST_LIMIT_ADMIN = config("GRAPHQL_COST_LIMIT_ADMIN", cast=int, default=20000)
+
+SESSION_VERSIONS_REFRESH_INTERVAL = config(
+    "SESSION_VERSIONS_REFRESH_INTERVAL", cast=float, default=60.0
+)
@@ -2,6 +2,8 @@ from typing import Optional
 
 
 class BaseUser:
+    __slots__ = ()
+
     @property
     def id(self) -> Optional[str]:
         raise NotImplementedError
@@ -31,6 +33,8 @@ class BaseUser:
 
 
 class UnauthenticatedUser(BaseUser):
+    __slots__ = ()
+
     @property
     def id(self):
         return None
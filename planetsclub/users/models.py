@@ -1,27 +1,90 @@
 """users"""
 
+import asyncio
+import logging
 from datetime import datetime
-from typing import Dict, List, Optional, Tuple, Type, TypeVar
+from typing import Dict, List, Optional, Tuple, Type, TypeVar, Union
 
-import dateutil.parser
 import msgpack
 from pytz import UTC
 from starlette.authentication import AuthCredentials
 
+from planetsclub import settings
 from planetsclub.services import services
-from planetsclub.services.elasticsearch import ESDocModel
+from planetsclub.services.elasticsearch import (
+    STORED_ONLY,
+    TEXT_ANALYSIS,
+    TEXT_WITH_KEYWORD,
+    ESDocModel,
+)
+from planetsclub.services.localcache import LocalCache
 
 from .base import BaseUser, UnauthenticatedUser
 
+_LOGGER = logging.getLogger("planetsclub.users")
+
 T = TypeVar("T", bound="UserModel")
 
 
 FBAPI_BASE = "https://graph.facebook.com/v3.3"
 FBAPI_GROUP_BASE = FBAPI_BASE + "/727594310962689"
 
+_REDIS_KEY_PREFIX = "planetsclub-user-"
+_REDIS_CACHE_TTL = 30
+_SESSION_VERSIONS_KEY = "planetsclub-user-versions"
+# ハッシュを ES から作り直したことを示すフィールド（ハッシュが消えればこれも消える）
+_SESSION_VERSIONS_COMPLETE = "*"
+
+# users.updated.* で他のワーカーや購読者に送るフィールド
+_BROADCAST_FIELDS = (
+    "real_name",
+    "picture_uri",
+    "is_admin",
+    "deactivated",
+    "created_at",
+    "updated_at",
+)
+
+# Redis の手前に置くワーカー内キャッシュ（ユーザ ID -> ES の _source）
+user_local_cache: LocalCache[dict] = LocalCache(
+    settings.USER_CACHE_SIZE, settings.USER_CACHE_TTL, "user"
+)
+
+
+def _on_user_updated(topic, data):
+    user_local_cache.pop(data["id"])
+
+
+services.msghub.add_listener("users.updated.*", _on_user_updated)
+
 
 class UserModel(ESDocModel, BaseUser):
     ES_INDEX = "planets-users"
+    ES_INDEX_VERSION = 3
+    ES_SETTINGS = {
+        "index": {
+            "number_of_shards": 1,
+            "number_of_replicas": 1,
+            "refresh_interval": "1s",
+        },
+        "analysis": TEXT_ANALYSIS,
+    }
+    ES_MAPPINGS = {
+        # 宣言していないフィールドは _source に残すだけで索引しない
+        "dynamic": False,
+        "properties": {
+            "real_name": TEXT_WITH_KEYWORD,
+            "email": {"type": "keyword"},
+            "google_id": {"type": "keyword"},
+            "picture_uri": STORED_ONLY,
+            "is_admin": {"type": "boolean"},
+            "deactivated": {"type": "boolean"},
+            "session_version": {"type": "integer"},
+            "created_at": {"type": "date"},
+            "updated_at": {"type": "date"},
+        },
+    }
+    __slots__ = ()
     _CACHE_KEY = "users_cache"
 
     # @classmethod
@@ -93,35 +156,65 @@ class UserModel(ESDocModel, BaseUser):
     def created_at(self) -> Optional[datetime]:
         if not self._user.is_member:
             return None
-        v = self._data.get("created_at")
-        return dateutil.parser.parse(v) if v else None
+        return self._datetime("created_at")
 
     @property
     def updated_at(self) -> Optional[datetime]:
         if not self._user.is_member:
             return None
-        v = self._data.get("updated_at")
-        return dateutil.parser.parse(v) if v else None
+        return self._datetime("updated_at")
 
     @classmethod
     async def get_by_id(
         cls: Type[T], id: str, user: BaseUser, auth: AuthCredentials
     ) -> Optional[T]:
-        with (await services.redis_pool) as r:
-            du = await r.get("planetsclub-user-" + id)
+        users = await cls.get_many_by_ids([id], user, auth)
+        return users.get(id)
 
-        u: Optional[T] = None
-        if du:
-            u = cls(id, msgpack.loads(du, raw=False), user=user, auth=auth)
-        else:
-            u = await super()._es_get(id, user, auth)
-            if u:
-                with (await services.redis_pool) as r:
-                    await r.setex(
-                        "planetsclub-user-" + id, 30, msgpack.dumps(u.asdict())
-                    )
+    @classmethod
+    async def get_many_by_ids(
+        cls: Type[T], ids: List[str], user: BaseUser, auth: AuthCredentials
+    ) -> Dict[str, T]:
+        """ワーカー内キャッシュ、Redis (MGET)、ES (mget) の順に引く"""
+        users: Dict[str, T] = {}
+        remaining: List[str] = []
+        for id in ids:
+            data = user_local_cache.get(id)
+            if data is not None:
+                users[id] = cls(id, dict(data), user=user, auth=auth)
+            else:
+                remaining.append(id)
+
+        if not remaining:
+            return users
 
-        return u
+        with (await services.redis_pool) as r:
+            cached = await r.mget(*[_REDIS_KEY_PREFIX + id for id in remaining])
+
+        missing: List[str] = []
+        for (id, du) in zip(remaining, cached):
+            if du:
+                data = msgpack.loads(du, raw=False)
+                user_local_cache.set(id, data)
+                users[id] = cls(id, dict(data), user=user, auth=auth)
+            else:
+                missing.append(id)
+
+        if missing:
+            found = await super()._es_mget(missing, user, auth)
+            if found:
+                with (await services.redis_pool) as r:
+                    tr = r.pipeline()
+                    for u in found:
+                        tr.setex(_REDIS_KEY_PREFIX + u.id, _REDIS_CACHE_TTL, u.dumps())
+                    await tr.execute()
+            for u in found:
+                # キャッシュには ES から受け取った dict をそのまま入れ、u には浅いコピーを持たせる
+                user_local_cache.set(u.id, u._data)
+                u._data = dict(u._data)
+                users[u.id] = u
+
+        return users
 
     @classmethod
     async def get_by_facebook_access_token(
@@ -169,6 +262,9 @@ class UserModel(ESDocModel, BaseUser):
         last=None,
         after=None,
         before=None,
+        fields: Optional[List[str]] = None,
+        track_total_hits: Union[bool, int, None] = None,
+        consistent: bool = False,
     ):
         if not user.is_member:
             return None
@@ -196,52 +292,279 @@ class UserModel(ESDocModel, BaseUser):
             last=last,
             after=after,
             before=before,
+            fields=fields,
+            track_total_hits=track_total_hits,
+            consistent=consistent,
         )
 
     async def deactivate(self: T) -> bool:
         if not self._user.is_admin:
             return False
 
-        await self._es_update({"deactivated": True})
+        await self._update_session_state({"deactivated": True})
         return True
 
     async def activate(self: T) -> bool:
         if not self._user.is_admin:
             return False
 
-        await self._es_update({"deactivated": False})
+        await self._update_session_state({"deactivated": False})
         return True
 
     async def change_admin_state(self, state: bool) -> bool:
         if not self._user.is_admin:
             return False
 
-        await self._es_update({"is_admin": state})
+        await self._update_session_state({"is_admin": state})
         return True
 
+    async def _update_session_state(self, update: dict):
+        """アカウント状態や権限を変え、発行済みのトークンを失効させる
+
+        先にバージョンを進めるので、ES への書き込みが失敗しても古いトークンは
+        ES の状態で検証し直される。バージョンは同じ更新で文書にも書き、
+        Redis のハッシュが失われたときはそこから作り直す。
+        """
+        version = await session_versions.bump(
+            self._id, self._data.get("session_version", 0)
+        )
+        update["session_version"] = version
+        await self._es_update(update)
+
     async def _es_update(self, update, *args, **kwargs):
-        with (await services.redis_pool) as r:
-            await r.delete("planetsclub-user-" + self._id)
         update["updated_at"] = datetime.now(UTC)
-        return await super()._es_update(update, *args, **kwargs)
+        try:
+            res = await super()._es_update(update, *args, **kwargs)
+        except Exception:
+            # 書き込まれたかどうか分からないので、このワーカーと Redis のものは消す
+            await self._invalidate_cache(broadcast=False)
+            raise
+        await self._invalidate_cache()
+        return res
+
+    async def _invalidate_cache(self, broadcast: bool = True):
+        """全ワーカーのキャッシュから自身を消す"""
+        user_local_cache.pop(self._id)
+        with (await services.redis_pool) as r:
+            await r.delete(_REDIS_KEY_PREFIX + self._id)
+        if not broadcast:
+            return
+        try:
+            # メールアドレスなどは流さない
+            data = {k: self._data[k] for k in _BROADCAST_FIELDS if k in self._data}
+            await services.msghub.emit(
+                "users.updated." + self._id, {"id": self._id, "data": data}
+            )
+        except Exception:
+            # 取りこぼしても USER_CACHE_TTL 秒で失効する
+            _LOGGER.exception("exception:")
 
     async def _es_index(self):
         self._data["created_at"] = datetime.now(UTC)
         return await super()._es_index()
 
 
+class SessionVersions:
+    """ユーザごとのセッションバージョン（失効管理）
+
+    Redis のハッシュに、アカウント状態や権限が変わったユーザだけ番号を持たせる。
+    各ワーカーはその写しをメモリに持ち、変更はメッセージハブで受け取るので、
+    トークンの検証にバックエンドへの問い合わせは要らない。
+    番号はユーザの文書にも書いてあり、ハッシュが失われていれば ES から作り直す。
+    作り直せるまでは ``ready`` が偽になり、トークンのクレームを信用しない。
+    """
+
+    def __init__(self):
+        self._versions: Dict[str, int] = {}
+        self._ready = False
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def ready(self) -> bool:
+        return self._ready
+
+    def get(self, id: str) -> int:
+        return self._versions.get(id, 0)
+
+    async def bump(self, id: str, floor: int = 0) -> int:
+        """``floor`` は ES の文書にあるバージョン（これより大きい番号にする）"""
+        with (await services.redis_pool) as r:
+            version = await r.hincrby(_SESSION_VERSIONS_KEY, id, 1)
+            if version <= floor:
+                # ハッシュが失われていた（次の load で ES から作り直す）
+                version = floor + 1
+                await r.hset(_SESSION_VERSIONS_KEY, id, version)
+        self._versions[id] = max(version, self.get(id))
+        try:
+            await services.msghub.emit(
+                "users.version." + id, {"id": id, "version": version}
+            )
+        except Exception:
+            # 取りこぼしても定期的な再読み込みで反映される
+            _LOGGER.exception("exception:")
+        return version
+
+    async def load(self) -> None:
+        try:
+            with (await services.redis_pool) as r:
+                versions = await r.hgetall(_SESSION_VERSIONS_KEY, encoding="utf-8")
+            if _SESSION_VERSIONS_COMPLETE not in versions:
+                versions = await self._rebuild(versions)
+        except Exception:
+            self._ready = False
+            raise
+        versions.pop(_SESSION_VERSIONS_COMPLETE, None)
+        self._versions = {k: int(v) for (k, v) in versions.items()}
+        self._ready = True
+
+    async def _rebuild(self, versions: Dict[str, str]) -> Dict[str, str]:
+        """ES の文書にあるバージョンをハッシュに書き戻す"""
+        _LOGGER.warning("rebuilding %s from Elasticsearch", _SESSION_VERSIONS_KEY)
+        # 状態を変えたことのあるユーザだけなので 1 回の検索で足りる
+        res = await services.es.search(
+            index=UserModel.ES_INDEX,
+            body={
+                "query": {"range": {"session_version": {"gt": 0}}},
+                "_source": ["session_version"],
+                "size": 10000,
+            },
+        )
+        merged = {k: int(v) for (k, v) in versions.items()}
+        for hit in res["hits"]["hits"]:
+            version = hit["_source"].get("session_version") or 0
+            if version > merged.get(hit["_id"], 0):
+                merged[hit["_id"]] = version
+
+        with (await services.redis_pool) as r:
+            pipe = r.pipeline()
+            for (id, version) in merged.items():
+                pipe.hset(_SESSION_VERSIONS_KEY, id, version)
+            pipe.hset(_SESSION_VERSIONS_KEY, _SESSION_VERSIONS_COMPLETE, 1)
+            await pipe.execute()
+        return {k: str(v) for (k, v) in merged.items()}
+
+    def _on_version_changed(self, topic, data):
+        if data["version"] > self.get(data["id"]):
+            self._versions[data["id"]] = data["version"]
+
+    async def start(self) -> None:
+        services.msghub.add_listener("users.version.*", self._on_version_changed)
+        try:
+            await self.load()
+        except Exception:
+            # 読めるまではトークンごとに ES で検証する
+            _LOGGER.exception("exception:")
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        services.msghub.remove_listener("users.version.*", self._on_version_changed)
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(settings.SESSION_VERSIONS_REFRESH_INTERVAL)
+            try:
+                await self.load()
+            except Exception:
+                _LOGGER.exception("exception:")
+
+
+session_versions = SessionVersions()
+
+
+class SessionUser(BaseUser):
+    """トークンのクレームだけから作るユーザ
+
+    Permission checks only need the id and the flags carried by the token. The
+    full ``UserModel`` is fetched by :meth:`load` when a resolver needs profile
+    fields.
+    """
+
+    __slots__ = ("_id", "_auth", "_is_admin", "_model")
+
+    def __init__(self, id: str, auth: AuthCredentials, is_admin: bool):
+        self._id = id
+        self._auth = auth
+        self._is_admin = is_admin
+        self._model: Optional[UserModel] = None
+
+    @property
+    def id(self) -> str:
+        return self._id
+
+    @property
+    def is_authenticated(self) -> bool:
+        return True
+
+    @property
+    def is_active(self) -> bool:
+        return True
+
+    @property
+    def is_member(self) -> bool:
+        return True
+
+    @property
+    def is_admin(self) -> bool:
+        return self._is_admin
+
+    def is_member_or_me(self) -> bool:
+        return True
+
+    async def load(self) -> Optional[UserModel]:
+        if self._model is None:
+            user = await UserModel.get_by_id(
+                self._id, UnauthenticatedUser(), AuthCredentials()
+            )
+            if user is not None:
+                user.authenticate(self._auth, user)
+            self._model = user
+        return self._model
+
+
 class AuthenticationBackend:
+    def __init__(self, versions: Optional[SessionVersions] = None):
+        self.versions = versions or session_versions
+
+    async def startup(self):
+        await self.versions.start()
+
+    async def shutdown(self):
+        await self.versions.stop()
+
     async def load(self, request, auth_data):
         if auth_data:
             _id = auth_data.get("sub")
             scopes = auth_data.get("scope")
             if _id and (scopes is not None):
+                version = auth_data.get("ver")
+                if (
+                    version is not None
+                    and self.versions.ready
+                    and version >= self.versions.get(_id)
+                ):
+                    # クレームが最新なので ES や Redis を見る必要はない
+                    if auth_data.get("act"):
+                        auth = AuthCredentials(scopes)
+                        return (
+                            auth,
+                            SessionUser(_id, auth, bool(auth_data.get("adm"))),
+                        )
+                    return (AuthCredentials(), UnauthenticatedUser())
+
                 user = await UserModel.get_by_id(
                     _id, UnauthenticatedUser(), AuthCredentials()
                 )
                 if user and user.is_active:
                     auth = AuthCredentials(scopes)
                     user.authenticate(auth, user)
+                    # 古いクレームを持つトークンを更新する
+                    request["auth_cookie"].set(auth, user)
                     return (auth, user)
 
         return (AuthCredentials(), UnauthenticatedUser())
@@ -249,6 +572,12 @@ class AuthenticationBackend:
     async def dump(self, request, auth, user):
         if isinstance(user, UserModel):
             # exp = datetime.now(UTC) + timedelta(days=7)
-            return {"sub": user.id, "scope": auth.scopes}  # , "exp": exp}
+            return {
+                "sub": user.id,
+                "scope": auth.scopes,
+                "act": user.is_active,
+                "adm": bool(user.is_admin),
+                "ver": self.versions.get(user.id),
+            }  # , "exp": exp}
         else:
             return None
@@ -0,0 +1,531 @@
+"""テストとベンチマーク用の Elasticsearch / Redis の代用品
+
+ES は ``_es_search_pagable`` などが使う範囲（match_all 相当の検索、sort、
+search_after、msearch、PIT、get/mget/index/update/bulk）だけを実装し、呼び出し回数を数える。
+"""
+
+import asyncio
+import json
+import time
+from copy import deepcopy
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from elasticsearch import NotFoundError
+
+from planetsclub.services import CustomJSONSerializer
+
+
+class FakeElasticsearch:
+    def __init__(self, latency: float = 0.0):
+        self.indices = _FakeIndices()
+        self.latency = latency
+        self.requests = 0
+        self.searches = 0
+        self.bulk_requests = 0
+        self.pits: Dict[str, Tuple[str, Dict[str, dict]]] = {}
+        self.transport = _FakeTransport(self)
+        # refresh() の後は、検索には最後に refresh した時点の文書だけが出る
+        self.searchable: Optional[Dict[str, Dict[str, dict]]] = None
+        # update や ingest の script の代わりに呼ぶ関数（script の source -> 文書を書き換える関数）
+        self.scripts: Dict[str, Callable[[dict], None]] = {}
+        # index と同じ名前のパイプラインを default_pipeline として適用する
+        self.pipelines: Dict[str, dict] = {}
+        self.ingest = _FakeIngest(self)
+
+    def add(self, index: str, id: str, source: dict):
+        self.indices.setdefault(index, {})[id] = deepcopy(source)
+
+    def refresh(self):
+        self.searchable = deepcopy(self.indices)
+
+    def _ingest(self, index: str, id: str, source: dict):
+        """set（{{_id}} だけ）と script のプロセッサ"""
+        pipeline = self.pipelines.get(self.indices.aliases.get(index, index))
+        for processor in (pipeline or {}).get("processors", []):
+            ((kind, spec),) = processor.items()
+            if kind == "set":
+                source[spec["field"]] = spec["value"].replace("{{_id}}", id)
+            elif kind == "script":
+                self.scripts[spec["source"]](source)
+
+    def _refreshed(self, kwargs: dict):
+        if kwargs.get("refresh") and self.searchable is not None:
+            self.refresh()
+
+    async def _request(self):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    # search
+
+    async def search(self, index: str, body: dict, **kwargs):
+        await self._request()
+        return self._search(index, body)
+
+    async def msearch(self, body: List[dict], **kwargs):
+        await self._request()
+        responses = []
+        for (meta, search_body) in zip(body[::2], body[1::2]):
+            responses.append(self._search(meta["index"], search_body))
+        return {"took": 0, "responses": responses}
+
+    def _search(self, index: str, body: dict, docs=None) -> dict:
+        self.searches += 1
+        started = time.perf_counter()
+        sort = [_normalize_sort(s) for s in body.get("sort") or ["_score"]]
+        if docs is None:
+            indices = self.indices if self.searchable is None else self.searchable
+            docs = indices.get(index, {})
+        hits = []
+        for (n, (id, source)) in enumerate(docs.items()):
+            values = [_sort_value(id, source, field, n) for (field, _) in sort]
+            hits.append({"_index": index, "_id": id, "_source": source, "sort": values})
+        # 安定ソートを優先度の低いキーから重ねる（比較関数を使うより桁違いに速い）
+        for (i, (_, order)) in reversed(list(enumerate(sort))):
+            desc = order == "desc"
+            hits.sort(key=lambda h: _missing_last(h["sort"][i], desc), reverse=desc)
+
+        search_after = body.get("search_after")
+        if search_after is not None:
+            hits = [
+                h for h in hits if _compare_values(sort, h["sort"], search_after) > 0
+            ]
+
+        total = len(hits)
+        hits = [_project(h, body.get("_source")) for h in hits[: body.get("size", 10)]]
+        result: Dict[str, Any] = {
+            "took": int((time.perf_counter() - started) * 1000),
+            "hits": {"hits": hits},
+        }
+        if body.get("suggest"):
+            result["suggest"] = _suggest(docs, body["suggest"])
+        if body.get("aggs"):
+            result["aggregations"] = _aggregate(list(docs.values()), body["aggs"])
+        if body.get("profile"):
+            result["profile"] = {"shards": [{"id": "[fake][docs][0]", "searches": []}]}
+        track_total_hits = body.get("track_total_hits", 10000)
+        if track_total_hits is True:
+            result["hits"]["total"] = {"value": total, "relation": "eq"}
+        elif track_total_hits:
+            result["hits"]["total"] = {
+                "value": min(total, track_total_hits),
+                "relation": "eq" if total <= track_total_hits else "gte",
+            }
+        return result
+
+    # documents
+
+    async def get(self, index: str, id: str, **kwargs):
+        await self._request()
+        source = self.indices.get(index, {}).get(id)
+        if source is None:
+            raise NotFoundError(404, "not_found", {"_id": id})
+        doc = {"_index": index, "_id": id, "found": True, "_source": source}
+        return _project(doc, _source_spec(kwargs))
+
+    async def mget(self, index: str, body: dict, **kwargs):
+        await self._request()
+        docs = []
+        for id in body["ids"]:
+            source = self.indices.get(index, {}).get(id)
+            if source is None:
+                docs.append({"_index": index, "_id": id, "found": False})
+            else:
+                doc = {"_index": index, "_id": id, "found": True, "_source": source}
+                docs.append(_project(doc, _source_spec(kwargs)))
+        return {"docs": docs}
+
+    async def index(self, index: str, body: dict, id: Optional[str] = None, **kwargs):
+        await self._request()
+        if id is None:
+            id = "fake{}".format(sum(len(docs) for docs in self.indices.values()))
+        self.add(index, id, body)
+        self._ingest(index, id, self.indices[index][id])
+        self._refreshed(kwargs)
+        return {"_index": index, "_id": id, "result": "created"}
+
+    async def update(self, index: str, id: str, body: dict, **kwargs):
+        await self._request()
+        docs = self.indices.setdefault(index, {})
+        if id not in docs and not body.get("doc_as_upsert"):
+            raise NotFoundError(404, "document_missing_exception", {"_id": id})
+        # 本物と同じく JSON にして受け取る（datetime は文字列になる）
+        doc = json.loads(self.transport.serializer.dumps(body["doc"]))
+        docs.setdefault(id, {}).update(doc)
+        get = _project({"_source": docs[id]}, _source_spec(kwargs))
+        self._refreshed(kwargs)
+        return {"_index": index, "_id": id, "result": "updated", "get": get}
+
+    async def bulk(self, body: str, **kwargs):
+        await self._request()
+        self.bulk_requests += 1
+        lines = [json.loads(line) for line in body.splitlines() if line]
+        items = []
+        while lines:
+            ((op, meta),) = lines.pop(0).items()
+            (index, id) = (meta["_index"], meta.get("_id"))
+            docs = self.indices.setdefault(index, {})
+            if op == "delete":
+                found = docs.pop(id, None) is not None
+                items.append({op: {"_id": id, "status": 200 if found else 404}})
+                continue
+
+            source = lines.pop(0)
+            if op == "index":
+                if id is None:
+                    id = "fake{}".format(len(docs))
+                docs[id] = source
+                self._ingest(index, id, source)
+                items.append({op: {"_id": id, "status": 201, "result": "created"}})
+            elif op == "create" and id in docs:
+                error = {
+                    "type": "version_conflict_engine_exception",
+                    "reason": "exists",
+                }
+                items.append({op: {"_id": id, "status": 409, "error": error}})
+            elif op == "create":
+                docs[id] = source
+                self._ingest(index, id, source)
+                items.append({op: {"_id": id, "status": 201, "result": "created"}})
+            elif id not in docs and not source.get("doc_as_upsert"):
+                error = {"type": "document_missing_exception", "reason": "missing"}
+                items.append({op: {"_id": id, "status": 404, "error": error}})
+            else:
+                if "script" in source:
+                    self.scripts[source["script"]["source"]](docs[id])
+                else:
+                    docs.setdefault(id, {}).update(source["doc"])
+                result = {"_id": id, "status": 200, "result": "updated"}
+                if meta.get("_source"):
+                    result["get"] = _project({"_source": docs[id]}, meta["_source"])
+                items.append({op: result})
+        errors = any("error" in r for item in items for r in item.values())
+        self._refreshed(kwargs)
+        return {"took": 0, "errors": errors, "items": items}
+
+
+class _FakeIndices(Dict[str, Dict[str, dict]]):
+    """index 名 -> 文書。services.indices が使うエイリアスの API も持つ"""
+
+    def __init__(self):
+        super().__init__()
+        # エイリアス -> index（無いものは同じ名前の index として扱う）
+        self.aliases: Dict[str, str] = {}
+
+    async def get_alias(self, name: str):
+        if name not in self.aliases:
+            raise NotFoundError(404, "aliases_not_found_exception", {})
+        return {self.aliases[name]: {"aliases": {name: {}}}}
+
+    async def exists(self, index: str):
+        return index in self
+
+    async def put_settings(self, index: str, body: dict, **kwargs):
+        return {"acknowledged": True}
+
+
+class _FakeIngest:
+    def __init__(self, es: FakeElasticsearch):
+        self.es = es
+
+    async def put_pipeline(self, id: str, body: dict, **kwargs):
+        self.es.pipelines[id] = deepcopy(body)
+        return {"acknowledged": True}
+
+    async def delete_pipeline(self, id: str, **kwargs):
+        self.es.pipelines.pop(id, None)
+        return {"acknowledged": True}
+
+
+class _FakeTransport:
+    """point in time の API だけを扱う"""
+
+    def __init__(self, es: FakeElasticsearch):
+        self.es = es
+        self.serializer = CustomJSONSerializer()
+
+    async def perform_request(self, method, url, params=None, body=None):
+        es = self.es
+        await es._request()
+        if method == "POST" and url.endswith("/_pit"):
+            index = url.strip("/").split("/")[0]
+            pit_id = "pit{}".format(len(es.pits))
+            es.pits[pit_id] = (index, deepcopy(es.indices.get(index, {})))
+            return {"id": pit_id}
+        elif method == "POST" and url == "/_search":
+            pit_id = body["pit"]["id"]
+            if pit_id not in es.pits:
+                raise NotFoundError(404, "search_context_missing_exception", {})
+            (index, docs) = es.pits[pit_id]
+            return dict(es._search(index, body, docs), pit_id=pit_id)
+        elif method == "DELETE" and url == "/_pit":
+            if es.pits.pop(body["id"], None) is None:
+                raise NotFoundError(404, "not_found", {})
+            return {"succeeded": True, "num_freed": 1}
+        raise NotImplementedError(method + " " + url)
+
+
+def _normalize_sort(spec):
+    if isinstance(spec, str):
+        return (spec, "desc" if spec == "_score" else "asc")
+    ((field, order),) = spec.items()
+    if isinstance(order, dict):
+        order = order.get("order", "desc" if field == "_score" else "asc")
+    return (field, order)
+
+
+def _sort_value(id: str, source: dict, field: str, n: int):
+    if field == "_id":
+        return id
+    elif field == "_shard_doc":
+        return n
+    elif field == "_score":
+        return 1.0
+    return source.get(field)
+
+
+def _missing_last(value, reverse: bool):
+    """ES と同じく値の無い文書は昇順でも降順でも最後に置く"""
+    if value is None:
+        return (not reverse, 0)
+    return (reverse, value)
+
+
+def _compare_values(sort, a: list, b: list) -> int:
+    for ((_, order), x, y) in zip(sort, a, b):
+        if x == y:
+            continue
+        if x is None or y is None:
+            return 1 if x is None else -1
+        result = -1 if x < y else 1
+        return -result if order == "desc" else result
+    return 0
+
+
+def _suggest(docs: Dict[str, dict], suggest: dict) -> dict:
+    """completion（privacy の context だけ）"""
+    result = {}
+    for (name, spec) in suggest.items():
+        (prefix, completion) = (spec["prefix"].lower(), spec["completion"])
+        privacy = completion.get("contexts", {}).get("privacy")
+        options = []
+        for (id, source) in docs.items():
+            inputs = source.get(completion["field"], {}).get("input", [])
+            matched = [i for i in inputs if i.lower().startswith(prefix)]
+            if matched and (privacy is None or source.get("privacy") in privacy):
+                options.append(
+                    {"text": matched[0], "_id": id, "_source": deepcopy(source)}
+                )
+        options = options[: completion.get("size", 5)]
+        result[name] = [{"text": spec["prefix"], "options": options}]
+    return result
+
+
+def _aggregate(sources: List[dict], aggs: dict) -> dict:
+    """terms（動的マッピングの .keyword）と年ごとの date_histogram だけ"""
+    result = {}
+    for (name, agg) in aggs.items():
+        counts: Dict[Any, int] = {}
+        if "terms" in agg:
+            field = agg["terms"]["field"].replace(".keyword", "")
+            for source in sources:
+                values = source.get(field)
+                for value in values if isinstance(values, list) else [values]:
+                    if value is not None:
+                        counts[value] = counts.get(value, 0) + 1
+            buckets = sorted(counts.items(), key=lambda kv: (-kv[1], kv[0]))
+            buckets = buckets[: agg["terms"].get("size", 10)]
+            result[name] = {
+                "buckets": [{"key": k, "doc_count": n} for (k, n) in buckets]
+            }
+        else:
+            field = agg["date_histogram"]["field"]
+            for source in sources:
+                if source.get(field):
+                    year = source[field][:4]
+                    counts[year] = counts.get(year, 0) + 1
+            result[name] = {
+                "buckets": [
+                    {"key_as_string": k, "doc_count": n}
+                    for (k, n) in sorted(counts.items())
+                ]
+            }
+    return result
+
+
+def _source_spec(kwargs: dict):
+    """get / mget / update の _source の指定を検索の _source の形にする"""
+    if "_source_includes" in kwargs:
+        return {"includes": kwargs["_source_includes"]}
+    elif "_source_excludes" in kwargs:
+        return {"excludes": kwargs["_source_excludes"]}
+    return kwargs.get("_source")
+
+
+def _project(hit: dict, source) -> dict:
+    hit = dict(hit)
+    if source is False:
+        del hit["_source"]
+    elif isinstance(source, dict) and "includes" in source:
+        hit["_source"] = {
+            k: v for (k, v) in hit["_source"].items() if k in source["includes"]
+        }
+    elif isinstance(source, dict) and "excludes" in source:
+        hit["_source"] = {
+            k: deepcopy(v)
+            for (k, v) in hit["_source"].items()
+            if k not in source["excludes"]
+        }
+    else:
+        hit["_source"] = deepcopy(hit["_source"])
+    return hit
+
+
+class FakeRedis:
+    """aioredis の ``with (await pool) as r:`` で使われる範囲の代用品"""
+
+    def __init__(self, latency: float = 0.0):
+        self.data: Dict[str, Any] = {}
+        self.latency = latency
+        self.commands = 0
+
+    def __await__(self):
+        if False:
+            yield
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    async def _command(self):
+        self.commands += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    @staticmethod
+    def _encode(value):
+        if isinstance(value, bytes):
+            return value
+        return str(value).encode("utf-8")
+
+    @staticmethod
+    def _decode(value, encoding):
+        if value is not None and encoding:
+            return value.decode(encoding)
+        return value
+
+    async def get(self, key, encoding=None):
+        await self._command()
+        return self._decode(self.data.get(key), encoding)
+
+    async def mget(self, key, *keys, encoding=None):
+        await self._command()
+        return [self._decode(self.data.get(k), encoding) for k in (key,) + keys]
+
+    async def set(self, key, value, **kwargs):
+        await self._command()
+        self.data[key] = self._encode(value)
+        return True
+
+    async def setex(self, key, seconds, value):
+        return await self.set(key, value)
+
+    async def delete(self, key, *keys):
+        await self._command()
+        return sum(1 for k in (key,) + keys if self.data.pop(k, None) is not None)
+
+    async def incr(self, key):
+        await self._command()
+        value = int(self.data.get(key) or 0) + 1
+        self.data[key] = self._encode(value)
+        return value
+
+    async def zadd(self, key, score, member):
+        await self._command()
+        self.data.setdefault(key, {})[member] = score
+        return 1
+
+    async def zrem(self, key, member):
+        await self._command()
+        return 1 if self.data.get(key, {}).pop(member, None) is not None else 0
+
+    async def zcard(self, key):
+        await self._command()
+        return len(self.data.get(key, {}))
+
+    async def zremrangebyscore(self, key, min=float("-inf"), max=float("inf")):
+        await self._command()
+        zset = self.data.get(key, {})
+        removed = [m for (m, score) in zset.items() if min <= score <= max]
+        for m in removed:
+            del zset[m]
+        return len(removed)
+
+    async def hset(self, key, field, value):
+        await self._command()
+        self.data.setdefault(key, {})[self._encode(field)] = self._encode(value)
+        return 1
+
+    async def hgetall(self, key, encoding=None):
+        await self._command()
+        return {
+            self._decode(k, encoding): self._decode(v, encoding)
+            for (k, v) in self.data.get(key, {}).items()
+        }
+
+    async def hdel(self, key, field, *fields):
+        await self._command()
+        h = self.data.get(key, {})
+        return sum(
+            1 for f in (field,) + fields if h.pop(self._encode(f), None) is not None
+        )
+
+    async def hincrby(self, key, field, increment=1):
+        await self._command()
+        h = self.data.setdefault(key, {})
+        value = int(h.get(self._encode(field)) or 0) + increment
+        h[self._encode(field)] = self._encode(value)
+        return value
+
+    async def hincrbyfloat(self, key, field, increment=1.0):
+        await self._command()
+        h = self.data.setdefault(key, {})
+        value = float(h.get(self._encode(field)) or 0) + increment
+        h[self._encode(field)] = self._encode(value)
+        return value
+
+    async def expire(self, key, timeout):
+        await self._command()
+        return 1 if key in self.data else 0
+
+    def pipeline(self):
+        return _FakePipeline(self)
+
+
+class _FakePipeline:
+    def __init__(self, redis: FakeRedis):
+        self.redis = redis
+        self.calls: List[Any] = []
+
+    def __getattr__(self, name):
+        method = getattr(self.redis, name)
+
+        def call(*args, **kwargs):
+            self.calls.append((method, args, kwargs))
+
+        return call
+
+    async def execute(self):
+        # 1 往復として数える
+        await self.redis._command()
+        (commands, latency) = (self.redis.commands, self.redis.latency)
+        self.redis.latency = 0.0
+        try:
+            results = [await method(*a, **kw) for (method, a, kw) in self.calls]
+        finally:
+            (self.redis.commands, self.redis.latency) = (commands, latency)
+        return results
@@ -0,0 +1,253 @@
+import asyncio
+import io
+import json
+
+import pytest
+from starlette.authentication import AuthCredentials
+
+from planetsclub import settings
+from planetsclub.archives import content
+from planetsclub.archives import models as archives_models
+from planetsclub.archives.content import prune_contents, split_contents
+from planetsclub.archives.models import ArchiveContentModel, ArchiveModel
+from planetsclub.archives.transfer import import_documents
+from planetsclub.graphql.response_cache import ResponseCache
+from planetsclub.services import indices, services
+from planetsclub.services.dataloader import DataLoader
+from planetsclub.services.elasticsearch import BulkWriter
+from planetsclub.services.indices import index_name
+from planetsclub.users.base import UnauthenticatedUser
+from planetsclub.users.models import UserModel
+
+from .fakes import FakeElasticsearch, FakeRedis
+
+
+@pytest.mark.asyncio
+async def test_highlight_only_when_requested(monkeypatch):
+    es = FakeElasticsearch()
+    es.add(ArchiveModel.ES_INDEX, "a", {"title": "a", "privacy": "public"})
+    monkeypatch.setattr(services, "es", es)
+    monkeypatch.setattr(services, "redis_pool", FakeRedis())
+    bodies = []
+    search = es._search
+
+    def recording_search(index, body, docs=None):
+        bodies.append(body)
+        return search(index, body, docs)
+
+    monkeypatch.setattr(es, "_search", recording_search)
+
+    async def highlight(**kwargs):
+        bodies.clear()
+        await ArchiveModel.get_archives(
+            UnauthenticatedUser(), AuthCredentials(), **kwargs
+        )
+        return bodies[0].get("highlight")
+
+    assert await highlight(q="宇宙") is None
+    assert await highlight(highlight=True) is None
+    spec = await highlight(q="宇宙", highlight=True)
+    assert spec["fields"] == {"body": {"type": "unified"}}
+
+    monkeypatch.setattr(settings, "ES_HIGHLIGHTER", "fvh")
+    spec = await highlight(q="宇宙", highlight=True)
+    assert spec["fields"] == {"body": {"type": "fvh"}}
+
+
+@pytest.mark.asyncio
+async def test_facets_are_cached_until_update(monkeypatch):
+    es = FakeElasticsearch()
+    for (i, (tags, year)) in enumerate([(["a", "b"], 2018), (["a"], 2019)]):
+        es.add(
+            ArchiveModel.ES_INDEX,
+            "i{}".format(i),
+            {"tags": tags, "published_at": "{}-06-01T00:00:00Z".format(year)},
+        )
+    monkeypatch.setattr(services, "es", es)
+    monkeypatch.setattr(services, "redis_pool", FakeRedis())
+    (user, auth) = (UnauthenticatedUser(), AuthCredentials())
+
+    # 一覧と同じ検索で集計し、その結果を archiveFacets でも使う
+    page = await ArchiveModel.get_archives(user, auth, facets=True)
+    assert page["facets"]["tags"] == [
+        {"value": "a", "count": 2},
+        {"value": "b", "count": 1},
+    ]
+    assert page["facets"]["years"][0] == {"value": "2019", "count": 1}
+    assert "aggregations" not in page
+    requests = es.requests
+    assert await ArchiveModel.get_facets(user, auth) == page["facets"]
+    assert es.requests == requests
+
+    await ArchiveModel._broadcast_updates([ArchiveModel("i0", {})])
+    await ArchiveModel.get_facets(user, auth)
+    assert es.requests == requests + 1
+
+
+@pytest.mark.asyncio
+async def test_cached_facets_after_update(monkeypatch):
+    es = FakeElasticsearch()
+    es.add(ArchiveModel.ES_INDEX, "a", {"tags": ["x"], "privacy": "public"})
+    es.add(ArchiveModel.ES_INDEX, "b", {"tags": ["x"], "privacy": "public"})
+    es.refresh()
+    monkeypatch.setattr(services, "es", es)
+    monkeypatch.setattr(services, "redis_pool", FakeRedis())
+    writer = BulkWriter(interval=60)
+    writer.start()
+    monkeypatch.setattr(services, "bulk_writer", writer)
+    (user, auth, member) = (UnauthenticatedUser(), AuthCredentials(), UserModel("u"))
+
+    async def tags():
+        facets = await ArchiveModel.get_facets(user, auth)
+        return {t["value"]: t["count"] for t in facets["tags"]}
+
+    assert await tags() == {"x": 2}
+    # 更新が検索に出る前の集計が新しい世代で保存されないこと
+    await ArchiveModel.update("a", member, None, {"tags": ["y"]})
+    assert await tags() == {"x": 1, "y": 1}
+    await ArchiveModel.bulk_update([("b", {"tags": ["y"]})], member, None)
+    assert await tags() == {"y": 2}
+    await writer.close()
+
+
+def test_filters_become_filter_clauses():
+    query = ArchiveModel._search_query(
+        UnauthenticatedUser(), None, {"tags": ["a"], "series": [], "years": [2019]}
+    )
+    (tags, years) = query["bool"]["filter"]
+    assert tags == {"terms": {"tags.keyword": ["a"]}}
+    assert years["bool"]["should"][0]["range"]["published_at"]["gte"] == "2019-01-01"
+
+
+@pytest.mark.asyncio
+async def test_suggest(monkeypatch):
+    es = FakeElasticsearch()
+    for (id, title, privacy) in [("p", "Planets", "public"), ("c", "Plan", "club")]:
+        data = {"title": title, "series": "S", "tags": ["t"]}
+        archives_models._set_suggest_input(data)
+        es.add(ArchiveModel.ES_INDEX, id, dict(data, privacy=privacy))
+    monkeypatch.setattr(services, "es", es)
+    monkeypatch.setattr(services, "redis_pool", FakeRedis())
+    archives_models.suggest_cache.clear()
+    archives_models._declared_index_cache.clear()
+
+    # 移行前の index（suggest の mapping が無い）には問い合わせない
+    assert await ArchiveModel.suggest(UnauthenticatedUser(), "pla") == []
+    assert es.searches == 0
+    es.add(ArchiveModel.ES_INDEX, "n", {"title": "New", "privacy": "public"})
+    await ArchiveModel.update("n", UserModel("u"), None, {"title": "Newer"})
+    assert "suggest" not in es.indices[ArchiveModel.ES_INDEX]["n"]
+    del es.indices[ArchiveModel.ES_INDEX]["n"]
+    es.indices.aliases[ArchiveModel.ES_INDEX] = index_name(ArchiveModel)
+    archives_models._declared_index_cache.clear()
+
+    user = UnauthenticatedUser()
+    # 非会員には公開のものだけ
+    assert await ArchiveModel.suggest(user, " PLA") == [{"id": "p", "title": "Planets"}]
+    assert await ArchiveModel.suggest(user, "") == []
+
+    # 同時の問い合わせは 1 つにまとめ、その後はワーカー内のキャッシュから返す
+    requests = es.requests
+    results = await asyncio.gather(
+        *[ArchiveModel.suggest(user, "s", 5) for _ in range(3)]
+    )
+    assert results[0] == results[2] and len(results[0]) == 1
+    await ArchiveModel.suggest(user, "S", 5)
+    assert es.requests == requests + 1
+
+
+@pytest.mark.asyncio
+async def test_pipeline_builds_suggest(monkeypatch):
+    es = FakeElasticsearch()
+    es.indices.aliases[ArchiveModel.ES_INDEX] = index_name(ArchiveModel)
+    # painless の代わりに同じことをする関数
+    es.scripts[archives_models._SUGGEST_SCRIPT] = archives_models._set_suggest_input
+    monkeypatch.setattr(services, "es", es)
+    monkeypatch.setattr(services, "redis_pool", FakeRedis())
+    archives_models.suggest_cache.clear()
+    archives_models._declared_index_cache.clear()
+    await indices.migrate(ArchiveModel)
+
+    # 移行や一括読み込みで書いた文書にも候補が付く
+    source = {"title": "Planets", "series": "", "tags": ["t"], "privacy": "public"}
+    inp = io.StringIO(json.dumps({"_id": "p", "_source": source}) + "\n")
+    assert await import_documents(ArchiveModel.ES_INDEX, inp) == 1
+    doc = es.indices[ArchiveModel.ES_INDEX]["p"]
+    assert (doc["doc_id"], doc["suggest"]) == ("p", {"input": ["Planets", "t"]})
+    user = UnauthenticatedUser()
+    assert await ArchiveModel.suggest(user, "pla") == [{"id": "p", "title": "Planets"}]
+
+
+@pytest.mark.asyncio
+async def test_split_content_store(monkeypatch):
+    es = FakeElasticsearch()
+    html = {"body": "本文", "html_content": "<p>本文</p>"}
+    es.add(ArchiveModel.ES_INDEX, "a", dict(html, title="a"))
+    monkeypatch.setattr(services, "es", es)
+    monkeypatch.setattr(services, "redis_pool", FakeRedis())
+    monkeypatch.setattr(settings, "ARCHIVE_CONTENT_STORE", "index")
+    member = UserModel("u")
+
+    # まだ写していないものはアーカイブの文書から読む
+    item = await ArchiveModel.get_by_id("a", member, None, fields=["title", "body"])
+    assert "body" not in item._data
+    assert await item.get_html_content() == "<p>本文</p>"
+
+    assert await split_contents() == 1
+    assert es.indices[ArchiveContentModel.ES_INDEX]["a"] == html
+
+    # HTML は planets-archive-content にだけ書き、更新の応答には含めない
+    update = {"title": "a", "body": "新しい本文", "html_content": "<p>新しい</p>"}
+    item = await ArchiveModel.update("a", member, None, dict(update))
+    # アーカイブの文書の古い HTML は prune で消す
+    assert es.indices[ArchiveModel.ES_INDEX]["a"]["html_content"] == "<p>本文</p>"
+    assert es.indices[ArchiveContentModel.ES_INDEX]["a"]["html_content"] == (
+        "<p>新しい</p>"
+    )
+    loader = DataLoader(ArchiveModel.get_contents)
+    item = await ArchiveModel.get_by_id("a", member, None, fields=["title"])
+    assert await item.get_body(loader) == "新しい本文"
+    assert await item.get_html_content(loader) == "<p>新しい</p>"
+    assert await item.get_html_content(loader) == "<p>新しい</p>"
+
+    # 写し直しても後から書かれたものは上書きしない
+    assert await split_contents() == 0
+    assert es.indices[ArchiveContentModel.ES_INDEX]["a"]["body"] == "新しい本文"
+
+    # planets-archive-content に無いものは HTML を消さない
+    es.add(ArchiveModel.ES_INDEX, "b", dict(html, title="b"))
+    es.scripts[content._PRUNE_SCRIPT] = lambda source: source.pop("html_content")
+    assert await prune_contents() == 1
+    assert "html_content" not in es.indices[ArchiveModel.ES_INDEX]["a"]
+    assert es.indices[ArchiveModel.ES_INDEX]["b"]["html_content"] == "<p>本文</p>"
+    assert not es.pits
+
+
+@pytest.mark.asyncio
+async def test_cached_listing_after_update(monkeypatch):
+    es = FakeElasticsearch()
+    es.add(ArchiveModel.ES_INDEX, "a", {"title": "old", "privacy": "public"})
+    es.add(ArchiveModel.ES_INDEX, "b", {"title": "old", "privacy": "public"})
+    es.refresh()
+    monkeypatch.setattr(services, "es", es)
+    monkeypatch.setattr(services, "redis_pool", FakeRedis())
+    writer = BulkWriter(interval=60)
+    writer.start()
+    monkeypatch.setattr(services, "bulk_writer", writer)
+    (cache, member) = (ResponseCache(60), UserModel("u"))
+
+    async def cached_titles():
+        # レスポンスキャッシュと同じく、世代を読んでから実行して保存する
+        (response, generation) = await cache.get("k")
+        if response is None:
+            page = await ArchiveModel.get_archives(member, None)
+            response = sorted(item.title for item in page["items"])
+            await cache.set("k", generation, response, 0.0)
+        return response
+
+    assert await cached_titles() == ["old", "old"]
+    await ArchiveModel.update("a", member, None, {"title": "new"})
+    assert await cached_titles() == ["new", "old"]
+    await ArchiveModel.bulk_update([("b", {"title": "new"})], member, None)
+    assert await cached_titles() == ["new", "new"]
+    await writer.close()
@@ -0,0 +1,34 @@
+import asyncio
+
+import pytest
+
+from planetsclub.services.dataloader import DataLoader
+
+
+@pytest.mark.asyncio
+async def test_dataloader_batches_keys_in_one_tick():
+    batches = []
+
+    async def batch_load(keys):
+        batches.append(list(keys))
+        return {k: k.upper() for k in keys if k != "missing"}
+
+    loader = DataLoader(batch_load)
+    results = await asyncio.gather(
+        loader.load("a"), loader.load("b"), loader.load("a"), loader.load("missing")
+    )
+    assert results == ["A", "B", "A", None]
+    assert batches == [["a", "b", "missing"]]
+
+    assert await loader.load("b") == "B"
+    assert len(batches) == 1
+
+
+@pytest.mark.asyncio
+async def test_dataloader_propagates_errors():
+    async def batch_load(keys):
+        raise RuntimeError("boom")
+
+    loader = DataLoader(batch_load)
+    with pytest.raises(RuntimeError):
+        await loader.load("a")
@@ -0,0 +1,272 @@
+import asyncio
+import json
+from datetime import datetime, timezone
+
+import pytest
+
+from planetsclub.services import elasticsearch, services, slowlog
+from planetsclub.services.elasticsearch import (
+    BulkItemError,
+    BulkWriter,
+    ESDocModel,
+    page_boundaries,
+    parse_datetime,
+)
+from planetsclub.services.slowlog import SlowQueryLog
+
+from .fakes import FakeElasticsearch, FakeRedis
+
+
+class Doc(ESDocModel):
+    ES_INDEX = "docs"
+
+
+def test_parse_datetime():
+    utc = timezone.utc
+    assert parse_datetime("2019-07-01T10:00:00.123Z") == datetime(
+        2019, 7, 1, 10, 0, 0, 123000, tzinfo=utc
+    )
+    assert parse_datetime("2019-07-01T10:00:00.123456+00:00").microsecond == 123456
+    # fromisoformat が読めない形は dateutil で読む
+    assert parse_datetime("2019-07-01T10:00:00.1Z") == datetime(
+        2019, 7, 1, 10, 0, 0, 100000, tzinfo=utc
+    )
+
+    doc = Doc("1", {"t": "2019-07-01T10:00:00Z"})
+    assert doc._datetime("t") is doc._datetime("t")
+    assert doc._datetime("missing") is None
+
+
+@pytest.fixture
+def fake_services(monkeypatch):
+    es = FakeElasticsearch()
+    for i in range(7):
+        es.add("docs", "d{}".format(i), {"n": i})
+    monkeypatch.setattr(services, "es", es)
+    monkeypatch.setattr(services, "redis_pool", FakeRedis())
+    return es
+
+
+async def _walk():
+    pages = []
+    cursor = None
+    while True:
+        p = await Doc._es_search_pagable(
+            None, None, None, [{"n": "asc"}], 3, None, cursor, None
+        )
+        pages.append(
+            (
+                [item.id for item in p["items"]],
+                p["has_previous_page"],
+                p["has_next_page"],
+            )
+        )
+        if not p["has_next_page"]:
+            return pages
+        cursor = p["end_cursor"]
+
+
+@pytest.mark.asyncio
+async def test_page_boundaries_replace_probe_search(fake_services, monkeypatch):
+    # 最後のページから逆向きにたどるために末尾のカーソルを作る
+    end = await Doc._es_search_pagable(
+        None, None, None, [{"n": "asc"}], 10, None, None, None
+    )
+
+    monkeypatch.setattr(page_boundaries, "ttl", 0)
+    fake_services.searches = 0
+    probed = await _walk()
+    assert fake_services.searches == 5
+    assert probed == [
+        (["d0", "d1", "d2"], False, True),
+        (["d3", "d4", "d5"], True, True),
+        (["d6"], True, False),
+    ]
+
+    monkeypatch.setattr(page_boundaries, "ttl", 30)
+    fake_services.searches = 0
+    assert await _walk() == probed
+    assert fake_services.searches == 3
+
+    fake_services.searches = 0
+    pages = []
+    cursor = end["end_cursor"]
+    # before のページでも末尾は既知なので追加の検索は不要
+    for _ in range(2):
+        p = await Doc._es_search_pagable(
+            None, None, None, [{"n": "asc"}], None, 3, None, cursor
+        )
+        pages.append(
+            (
+                [item.id for item in p["items"]],
+                p["has_previous_page"],
+                p["has_next_page"],
+            )
+        )
+        cursor = p["start_cursor"]
+    assert pages == [
+        (["d3", "d4", "d5"], True, True),
+        (["d0", "d1", "d2"], False, True),
+    ]
+    assert fake_services.searches == 2
+
+
+@pytest.mark.asyncio
+async def test_point_in_time_pagination(fake_services, monkeypatch):
+    page = await Doc._es_search_pagable(
+        None, None, None, [{"n": "asc"}], 3, None, None, None, consistent=True
+    )
+    assert [item.id for item in page["items"]] == ["d0", "d1", "d2"]
+    assert len(fake_services.pits) == 1
+
+    # スナップショットの後の変更は見えない
+    fake_services.add("docs", "d3", {"n": -1})
+    fake_services.add("docs", "x", {"n": 4})
+    page = await Doc._es_search_pagable(
+        None, None, None, [{"n": "asc"}], 3, None, page["end_cursor"], None
+    )
+    assert [item.id for item in page["items"]] == ["d3", "d4", "d5"]
+    assert (page["has_previous_page"], page["has_next_page"]) == (True, True)
+
+    page = await Doc._es_search_pagable(
+        None, None, None, [{"n": "asc"}], None, 2, None, page["start_cursor"]
+    )
+    assert [item.id for item in page["items"]] == ["d1", "d2"]
+    assert (page["has_previous_page"], page["has_next_page"]) == (True, True)
+
+    # PIT が失効していたら、_shard_doc の値は使えないので続きは取れない
+    cursor = page["end_cursor"]
+    fake_services.pits.clear()
+    with pytest.raises(elasticsearch.InvalidCursor):
+        await Doc._es_search_pagable(
+            None, None, None, [{"n": "asc"}], 10, None, cursor, None
+        )
+    assert not fake_services.pits
+
+    # 古すぎる PIT も同じ（閉じる）
+    page = await Doc._es_search_pagable(
+        None, None, None, [{"n": "asc"}], 3, None, None, None, consistent=True
+    )
+    monkeypatch.setattr(elasticsearch.point_in_times, "max_lifetime", -1)
+    with pytest.raises(elasticsearch.InvalidCursor):
+        await Doc._es_search_pagable(
+            None, None, None, [{"n": "asc"}], 3, None, page["end_cursor"], None
+        )
+    assert not fake_services.pits
+
+    # 最初のページなら開き直して検索する
+    page = await Doc._es_search_pagable(
+        None, None, None, [{"n": "asc"}], 3, None, None, None, consistent=True
+    )
+    assert [item.id for item in page["items"]] == ["d3", "d0", "d1"]
+    assert len(fake_services.pits) == 1
+
+
+@pytest.mark.asyncio
+async def test_point_in_time_cursor_is_signed(fake_services):
+    page = await Doc._es_search_pagable(
+        None, None, None, [{"n": "asc"}], 3, None, None, None, consistent=True
+    )
+    cursor = page["end_cursor"]
+    (search_after, pit) = elasticsearch._parse_cursor(cursor, "docs")
+    assert (search_after[0], pit["id"]) == (2, next(iter(fake_services.pits)))
+
+    # 開いた時刻を書き換えたもの、別の index で開いた PIT は受け付けない
+    forged = elasticsearch._cursor_to_sort(cursor)
+    payload = elasticsearch.msgpack.loads(forged["d"], raw=False)
+    payload["t"] += 3600
+    forged["d"] = elasticsearch.msgpack.dumps(payload, use_bin_type=True)
+    forged = elasticsearch.base64.urlsafe_b64encode(
+        elasticsearch.msgpack.dumps(forged, use_bin_type=True)
+    ).decode("ascii")
+    with pytest.raises(elasticsearch.InvalidCursor):
+        await Doc._es_search_pagable(
+            None, None, None, [{"n": "asc"}], 3, None, forged, None
+        )
+    with pytest.raises(elasticsearch.InvalidCursor):
+        elasticsearch._parse_cursor(cursor, "other")
+
+    # 壊れた cursor は無視する
+    for broken in (b"\x81\x90\x01", b"\xc1", b"\xd9"):
+        broken = elasticsearch.base64.urlsafe_b64encode(broken).decode("ascii")
+        assert elasticsearch._parse_cursor(broken, "docs") == (None, None)
+
+
+@pytest.mark.asyncio
+async def test_bulk_writer(fake_services, monkeypatch):
+    writer = BulkWriter(max_actions=3, interval=60, max_pending=4, concurrency=1)
+    writer.start()
+    monkeypatch.setattr(services, "bulk_writer", writer)
+
+    futures = [await writer.update("docs", "d0", {"doc": {"n": 10}}, _source=True)]
+    futures.append(await writer.update("docs", "missing", {"doc": {"n": 0}}))
+    futures.append(await writer.index("docs", "d7", {"n": 7}))
+    # max_actions に達したので送られる
+    assert (await futures[0])["get"]["_source"] == {"n": 10}
+    with pytest.raises(BulkItemError) as excinfo:
+        await futures[1]
+    assert excinfo.value.status == 404
+    assert (await futures[2])["result"] == "created"
+    assert fake_services.bulk_requests == 1
+
+    # 確定していない操作が max_pending を超えると待たされる
+    writer.max_actions = 10
+    futures = [await writer.delete("docs", "d{}".format(i)) for i in range(4)]
+    blocked = asyncio.ensure_future(writer.delete("docs", "d5"))
+    await asyncio.sleep(0)
+    assert not blocked.done()
+    await writer.flush()
+    futures.append(await blocked)
+    await writer.flush()
+    await asyncio.gather(*futures)
+    assert fake_services.bulk_requests == 3
+
+    results = await Doc._es_bulk_update([("d6", {"n": 0}), ("x", {"n": 1})], None, None)
+    assert [r.asdict() for r in results if isinstance(r, Doc)] == [{"n": 0}]
+    assert isinstance(results[1], BulkItemError)
+
+    # 応答の items が足りなくても待ち続けない
+    bulk = fake_services.bulk
+
+    async def short_bulk(body, **kwargs):
+        res = await bulk(body, **kwargs)
+        return dict(res, items=res["items"][:1])
+
+    monkeypatch.setattr(fake_services, "bulk", short_bulk)
+    futures = [await writer.index("docs", "d{}".format(i), {"n": i}) for i in (8, 9)]
+    await writer.flush()
+    assert (await futures[0])["result"] == "created"
+    with pytest.raises(BulkItemError):
+        await futures[1]
+    await writer.close()
+
+
+@pytest.mark.asyncio
+async def test_slow_query_log(fake_services, monkeypatch, tmp_path):
+    log = SlowQueryLog(0.5, str(tmp_path / "slow.log"), 1024 * 1024, 1, 0.0)
+    monkeypatch.setattr(elasticsearch, "slow_queries", log)
+
+    async def search():
+        await Doc._es_search_pagable(
+            None, None, {"match_all": {}}, [{"n": "asc"}], 3, None, None, None
+        )
+
+    # 閾値より速い検索は記録しない
+    await search()
+    assert not (tmp_path / "slow.log").exists()
+
+    log.threshold = 0.0
+    operation = {"name": "GetDocs", "user": "u1", "variables": None}
+    slowlog.current_operation.set(operation)
+    await search()
+    # 管理者の要求なら profile を付ける
+    slowlog.profile_requested.set(True)
+    await search()
+
+    entries = [json.loads(line) for line in (tmp_path / "slow.log").open()]
+    assert len(entries) == 2
+    assert entries[0]["graphql"] == operation
+    assert entries[0]["body"]["query"] == {"match_all": {}}
+    assert (entries[0]["hits"], entries[0]["total"]) == (4, 7)
+    assert "profile" not in entries[0]
+    assert entries[1]["profile"]["shards"]
@@ -1,5 +1,238 @@
-from planetsclub import graphql
+from types import SimpleNamespace
+
+import pytest
+from ariadne.extensions import ExtensionManager
+from graphql import GraphQLError, parse
+from starlette.authentication import AuthCredentials
+from starlette.requests import Request
+
+from planetsclub import graphql, settings
+from planetsclub.archives.models import ArchiveModel
+from planetsclub.graphql.cost import operation_cost
+from planetsclub.graphql.projection import ARCHIVE_ITEM_SOURCE_FIELDS, source_includes
+from planetsclub.graphql.response_cache import ResponseCache
+from planetsclub.graphql.server import (
+    DocumentCache,
+    GraphQLServer,
+    PersistedQueryNotFound,
+    _set_slowlog_context,
+    _ValidationFailed,
+)
+from planetsclub.services import metrics, services, slowlog
+from planetsclub.users.base import UnauthenticatedUser
+
+from .fakes import FakeElasticsearch, FakeRedis
 
 
 def test_make_executable_schema():
     graphql._make_executable_schema()
+
+
+def test_document_cache():
+    cache = DocumentCache(graphql._make_executable_schema(), maxsize=1)
+    query = "{ archiveItems { totalCount } }"
+    document = cache.parse_and_validate(query)
+    assert cache.parse_and_validate(query) is document
+    assert cache.get(cache.hash_query(query)) is document
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    cache.parse_and_validate("{ me { id } }")
+    assert cache.get(cache.hash_query(query)) is None
+
+    with pytest.raises(_ValidationFailed):
+        cache.parse_and_validate("{ unknownField }")
+    with pytest.raises(_ValidationFailed):
+        cache.parse_and_validate("{")
+
+
+@pytest.mark.asyncio
+async def test_persisted_query_hash_mismatch():
+    server = GraphQLServer(graphql._make_executable_schema())
+    data = {
+        "query": "{ me { id } }",
+        "extensions": {"persistedQuery": {"version": 1, "sha256Hash": "00"}},
+    }
+    with pytest.raises(GraphQLError):
+        await server.get_document(data)
+
+
+@pytest.mark.asyncio
+async def test_persisted_query_redis_down(monkeypatch):
+    async def unavailable():
+        raise ConnectionRefusedError()
+
+    monkeypatch.setattr(services, "redis_pool", unavailable())
+    server = GraphQLServer(graphql._make_executable_schema())
+    data = {"extensions": {"persistedQuery": {"version": 1, "sha256Hash": "ab"}}}
+    with pytest.raises(PersistedQueryNotFound):
+        await server.get_document(data)
+
+
+def test_source_includes():
+    document = parse(
+        """
+        {
+          archiveItems {
+            totalCount
+            items { id title ...F ... on ArchiveItem { createdBy { id } } }
+          }
+        }
+        fragment F on ArchiveItem { sourceId bodyHighlights }
+        """
+    )
+    (operation, fragment) = document.definitions
+    info = SimpleNamespace(
+        field_nodes=[operation.selection_set.selections[0]], fragments={"F": fragment},
+    )
+    assert source_includes(info, ARCHIVE_ITEM_SOURCE_FIELDS, ("items",)) == [
+        "created_by",
+        "source_id",
+        "title",
+    ]
+    assert source_includes(info, ARCHIVE_ITEM_SOURCE_FIELDS) is None
+
+
+def test_response_cache_key():
+    cache = ResponseCache(ttl=60)
+    context = {"request": SimpleNamespace(user=UnauthenticatedUser())}
+
+    def key(query, variables=None):
+        return cache.key_for(context, "fp", parse(query), variables, None)
+
+    assert key("{ archiveItems { totalCount } }") is not None
+    assert key("{ archiveItems { totalCount } }", {"q": "a"}) != key(
+        "{ archiveItems { totalCount } }", {"q": "b"}
+    )
+    assert key("{ archiveItems { totalCount } me { id } }") is None
+    assert key("mutation { signOut }") is None
+
+
+@pytest.mark.asyncio
+async def test_response_cache_metrics(monkeypatch):
+    monkeypatch.setattr(services, "redis_pool", FakeRedis())
+    cache = ResponseCache(ttl=60)
+
+    def reported():
+        lines = metrics.registry.render([metrics.registry.snapshot()]).splitlines()
+        names = [
+            'planetsclub_redis_cache_lookups_total{cache="response",result="hit"}',
+            'planetsclub_redis_cache_lookups_total{cache="response",result="miss"}',
+            'planetsclub_redis_cache_saved_seconds_total{cache="response"}',
+        ]
+        values = dict(line.rsplit(" ", 1) for line in lines if " " in line)
+        return [float(values.get(name, 0)) for name in names]
+
+    before = reported()
+    (response, generation) = await cache.get("k")
+    await cache.set("k", generation, {"data": {}}, 0.25)
+    assert (await cache.get("k"))[0] == {"data": {}}
+    after = reported()
+    assert [a - b for (a, b) in zip(after, before)] == [1.0, 1.0, 0.25]
+
+
+def test_operation_cost():
+    schema = graphql._make_executable_schema()
+
+    def cost(query, variables=None):
+        document = parse(query)
+        return operation_cost(schema, document, document.definitions[0], variables)
+
+    items = "items { id title bodyHighlights createdBy { id } updatedBy { id } }"
+    # 10 + 20 * (1 + 2 + 1 + 1)
+    assert cost("{ archiveItems(first: 20) { totalCount %s } }" % items) == 110
+    assert (
+        cost(
+            "query Q($n: Int) { archiveItems(first: $n) { ...F } }"
+            " fragment F on ArchiveItems { %s }" % items,
+            {"n": 2000},
+        )
+        == 10 + 2000 * 5
+    )
+    # 変数の既定値も数える
+    assert (
+        cost("query Q($n: Int = 2000) { archiveItems(first: $n) { %s } }" % items)
+        == 10 + 2000 * 5
+    )
+    # first が無ければ既定の 10 件
+    assert cost("{ archiveItems { items { id title } } }") == 10 + 10
+    assert cost("{ me { id realName } }") == 0
+
+
+@pytest.mark.asyncio
+async def test_query_too_costly():
+    server = GraphQLServer(graphql._make_executable_schema())
+    context = {"request": SimpleNamespace(scope={"user": UnauthenticatedUser()})}
+    data = {"query": "{ archiveItems(first: 2000) { items { id bodyHighlights } } }"}
+    (success, response) = await server.execute_operation(
+        data, context, ExtensionManager(), None
+    )
+    assert not success
+    assert response["errors"][0]["extensions"]["code"] == "QUERY_TOO_COSTLY"
+    assert response["extensions"]["cost"] == {
+        "requested": 10 + 2000 * 3,
+        "limit": settings.GRAPHQL_COST_LIMIT_ANONYMOUS,
+    }
+
+
+@pytest.mark.asyncio
+async def test_total_count_modes(monkeypatch):
+    es = FakeElasticsearch()
+    for i in range(3):
+        es.add(ArchiveModel.ES_INDEX, "a{}".format(i), {"privacy": "public"})
+    monkeypatch.setattr(services, "es", es)
+    monkeypatch.setattr(services, "redis_pool", FakeRedis())
+    server = GraphQLServer(graphql._make_executable_schema())
+    server.response_cache.ttl = 0
+    bodies = []
+    search = es._search
+
+    def recording_search(index, body, docs=None):
+        bodies.append(body)
+        return search(index, body, docs)
+
+    monkeypatch.setattr(es, "_search", recording_search)
+    scope = {"type": "http", "headers": [], "user": UnauthenticatedUser()}
+    scope["auth"] = AuthCredentials()
+
+    async def items(arguments, selection="totalCount totalCountRel"):
+        bodies.clear()
+        query = "{ archiveItems(first: 1%s) { %s items { id } } }" % (
+            arguments,
+            selection,
+        )
+        (success, response) = await server.execute_operation(
+            {"query": query}, {"request": Request(scope)}, ExtensionManager(), None
+        )
+        assert success, response
+        page = response["data"]["archiveItems"]
+        return (bodies[0].get("track_total_hits"), page.get("totalCount"), page)
+
+    (tracked, count, page) = await items(", countMode: EXACT")
+    assert (tracked, count, page["totalCountRel"]) == (True, 3, "eq")
+    (tracked, count, page) = await items(", countMode: CAPPED, countCap: 2")
+    assert (tracked, count, page["totalCountRel"]) == (2, 2, "gte")
+    # hits.total が無ければ totalCount は null
+    (tracked, count, page) = await items(", countMode: NONE")
+    assert (tracked, count, page["totalCountRel"]) == (False, None, None)
+    # 件数を選択していなければ数え方によらず数えない
+    (tracked, _, page) = await items(", countMode: EXACT", selection="")
+    assert tracked is False and "totalCount" not in page
+    # 既定は ES の既定（10000 件まで）
+    (tracked, count, _) = await items("")
+    assert (tracked, count) == (None, 3)
+
+
+def test_slowlog_keeps_only_variable_names(monkeypatch):
+    data = {"operationName": "Q", "variables": {"q": "宇宙", "first": 10}}
+
+    def logged_variables():
+        (operation, profile) = _set_slowlog_context(data, {})
+        try:
+            return slowlog.current_operation.get()["variables"]
+        finally:
+            slowlog.current_operation.reset(operation)
+            slowlog.profile_requested.reset(profile)
+
+    assert logged_variables() == ["first", "q"]
+    monkeypatch.setattr(settings, "ES_SLOW_QUERY_LOG_VARIABLES", True)
+    assert logged_variables() == {"q": "宇宙", "first": 10}
@@ -0,0 +1,87 @@
+from types import SimpleNamespace
+
+import pytest
+
+from planetsclub.archives.facets import TERMS_FACETS
+from planetsclub.archives.models import SORTS, ArchiveItemSort, ArchiveModel
+from planetsclub.services import indices, services
+from planetsclub.services.indices import (
+    dynamic_settings,
+    index_body,
+    index_name,
+    swap_actions,
+)
+from planetsclub.users.models import UserModel
+
+
+def test_swap_actions_replaces_legacy_index():
+    assert swap_actions(
+        "planets-archive", ["planets-archive"], "planets-archive-v2"
+    ) == [
+        {"remove_index": {"index": "planets-archive"}},
+        {"add": {"index": "planets-archive-v2", "alias": "planets-archive"}},
+    ]
+    assert swap_actions(
+        "planets-archive", ["planets-archive-v1"], "planets-archive-v2"
+    ) == [
+        {"remove": {"index": "planets-archive-v1", "alias": "planets-archive"}},
+        {"add": {"index": "planets-archive-v2", "alias": "planets-archive"}},
+    ]
+
+
+def test_archive_index_declaration():
+    assert index_name(ArchiveModel) == "planets-archive-v3"
+    assert dynamic_settings(ArchiveModel)["index"]["refresh_interval"] == "1s"
+
+    properties = ArchiveModel.ES_MAPPINGS["properties"]
+    # ファセットで集計する keyword サブフィールド
+    for field in TERMS_FACETS.values():
+        (name, sub) = field.split(".")
+        assert properties[name]["fields"][sub]["type"] == "keyword"
+    assert properties["html_content"]["index"] is False
+
+
+def test_default_sort_matches_index_sort():
+    settings = index_body(ArchiveModel)["settings"]["index"]
+    assert settings["default_pipeline"] == "planets-archive-v3"
+    # 一覧の既定の並びが index のソートと一致しないと ES は打ち切れない
+    sort = [
+        (field, order if isinstance(order, str) else order["order"])
+        for s in SORTS[ArchiveItemSort.CREATED_AT_DESC]
+        for (field, order) in s.items()
+    ]
+    assert sort == list(zip(settings["sort.field"], settings["sort.order"]))
+
+
+@pytest.mark.asyncio
+async def test_migrate_blocks_writes_while_copying(monkeypatch):
+    calls = []
+
+    def record(name, result=None):
+        async def call(**kwargs):
+            calls.append((name, kwargs.get("index"), kwargs.get("body")))
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        return call
+
+    es = SimpleNamespace(
+        indices=SimpleNamespace(
+            get_alias=record("get_alias", {"planets-users-v1": {}}),
+            create=record("create"),
+            put_settings=record("put_settings"),
+        ),
+        ingest=SimpleNamespace(put_pipeline=record("put_pipeline")),
+        reindex=record("reindex", RuntimeError("reindex failed")),
+    )
+    monkeypatch.setattr(services, "es", es)
+    with pytest.raises(RuntimeError):
+        await indices.migrate(UserModel)
+    blocks = [
+        body["index"]["blocks.write"]
+        for (name, index, body) in calls
+        if name == "put_settings" and index == "planets-users-v1"
+    ]
+    # 写す前に書き込みを止め、失敗したら戻す
+    assert blocks == [True, False]
@@ -0,0 +1,31 @@
+from datetime import datetime, timezone
+from enum import Enum
+
+import pytest
+
+from planetsclub.services import CustomJSONSerializer
+from planetsclub.services.jsoncodec import get_codec
+
+
+class Color(Enum):
+    RED = "red"
+
+
+@pytest.mark.parametrize("name", ["json", "ujson", "orjson"])
+def test_codecs_agree(name):
+    if name != "json":
+        # 入っていないと get_codec は別のコーデックにするので、試さずに飛ばす
+        pytest.importorskip(name)
+    codec = get_codec(name)
+    assert codec.name == name
+    doc = {"title": "タイトル</em>", "n": 1, "tags": ["a"], "x": None, "f": 1.5}
+    assert codec.loads(codec.dumps_native(doc)) == doc
+
+    serializer = CustomJSONSerializer()
+    when = datetime(2019, 7, 1, 10, 0, 0, 123000, tzinfo=timezone.utc)
+    data = codec.loads(codec.dumps({"c": Color.RED, "t": when}, serializer.default))
+    assert data == {"c": "red", "t": "2019-07-01T10:00:00.123000+00:00"}
+
+
+def test_unknown_codec_falls_back():
+    assert get_codec("nonexistent").name in ("orjson", "ujson", "json")
@@ -0,0 +1,31 @@
+from planetsclub.services import metrics
+from planetsclub.services.localcache import LocalCache
+
+
+def test_local_cache_lru_eviction():
+    cache = LocalCache(maxsize=2, ttl=60, name="test-lru")
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["hits"] == 3
+    assert cache.stats()["misses"] == 1
+
+    # 名前のあるキャッシュは /metrics にも出す
+    lines = metrics.registry.render([metrics.registry.snapshot()]).splitlines()
+    line = 'planetsclub_local_cache_events_total{{cache="test-lru",event="{}"}} {}'
+    for (event, count) in [("hit", 3), ("miss", 1), ("eviction", 1)]:
+        assert line.format(event, float(count)) in lines
+
+
+def test_local_cache_ttl():
+    cache = LocalCache(maxsize=10, ttl=-1)
+    cache.set("a", 1)
+    assert cache.get("a") is None
+    assert len(cache) == 0
+    assert cache.stats()["expirations"] == 1
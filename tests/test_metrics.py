@@ -0,0 +1,96 @@
+import time
+
+import msgpack
+import pytest
+from starlette.authentication import AuthCredentials
+from starlette.requests import Request
+
+from planetsclub import metrics_endpoint, settings
+from planetsclub.graphql import extensions
+from planetsclub.graphql.extensions import operation_label
+from planetsclub.services import services
+from planetsclub.services.metrics import MetricsPublisher, Registry
+from planetsclub.users.base import UnauthenticatedUser
+from planetsclub.users.models import SessionUser
+
+from .fakes import FakeRedis
+
+
+def test_render_merges_worker_snapshots():
+    registry = Registry()
+    requests = registry.counter("requests_total", "Requests", ("path",))
+    latency = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+
+    requests.inc("/graphql")
+    latency.observe(0.05)
+    latency.observe(0.5)
+    first = registry.snapshot()
+
+    requests.inc("/graphql", amount=2)
+    latency.observe(5.0)
+    second = registry.snapshot()
+
+    lines = registry.render([first, second]).splitlines()
+    assert "# TYPE latency_seconds histogram" in lines
+    assert 'requests_total{path="/graphql"} 4.0' in lines
+    assert 'latency_seconds_bucket{le="0.1"} 2' in lines
+    assert 'latency_seconds_bucket{le="1.0"} 4' in lines
+    assert 'latency_seconds_bucket{le="+Inf"} 5' in lines
+    assert "latency_seconds_count 5" in lines
+
+
+def test_operation_label(monkeypatch):
+    monkeypatch.setattr(extensions, "_operation_labels", set())
+    monkeypatch.setattr(settings, "METRICS_MAX_OPERATION_LABELS", 2)
+    assert operation_label(None) == "anonymous"
+    assert operation_label("GetArchiveItems") == "GetArchiveItems"
+    assert operation_label("x" * 100) == "other"
+    assert operation_label('a"b') == "other"
+    # 上限を超えた新しい名前は other にまとめる
+    assert operation_label("GetUser") == "GetUser"
+    assert operation_label("Random1") == "other"
+    assert operation_label("GetArchiveItems") == "GetArchiveItems"
+
+
+@pytest.mark.asyncio
+async def test_collect_keeps_totals_of_stopped_workers():
+    registry = Registry()
+    requests = registry.counter("requests_total", "Requests")
+    latency = registry.histogram("latency_seconds", "Latency", buckets=(0.1,))
+    requests.inc()
+    latency.observe(0.05)
+    redis = FakeRedis()
+    publisher = MetricsPublisher(registry, interval=10.0)
+
+    # 止まったワーカーの最後の値
+    stopped = {"requests_total": [[[], 5.0]], "latency_seconds": [[[], [2, 1, 3.0]]]}
+    await redis.hset(publisher.key, "1", msgpack.dumps([time.time() - 60, stopped]))
+    for _ in range(2):
+        lines = registry.render(await publisher.collect(redis)).splitlines()
+        assert "requests_total 6.0" in lines
+        assert 'latency_seconds_bucket{le="+Inf"} 4' in lines
+        assert "latency_seconds_sum 3.05" in lines
+    assert list(await redis.hgetall(publisher.key)) == [publisher.worker.encode()]
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint_requires_token(monkeypatch):
+    monkeypatch.setattr(settings, "METRICS_TOKEN", "secret")
+    monkeypatch.setattr(services, "redis_pool", FakeRedis())
+
+    async def get(authorization=None, user=None):
+        headers = [(b"authorization", authorization.encode())] if authorization else []
+        scope = {
+            "type": "http",
+            "headers": headers,
+            "user": user or UnauthenticatedUser(),
+        }
+        return await metrics_endpoint(Request(scope))
+
+    assert (await get()).status_code == 403
+    assert (await get("Bearer wrong")).status_code == 403
+    response = await get("Bearer secret")
+    assert response.status_code == 200
+    assert b"# TYPE planetsclub_graphql_operation_seconds histogram" in response.body
+    admin = SessionUser("a", AuthCredentials(["authenticated"]), True)
+    assert (await get(user=admin)).status_code == 200
@@ -0,0 +1,106 @@
+import pytest
+
+from planetsclub.services import metrics
+from planetsclub.services.msghub import (
+    MessageHub,
+    OverflowPolicy,
+    SubscriptionOverflow,
+    TopicTrie,
+)
+
+
+class Receiver:
+    pass
+
+
+def test_topic_trie_matching():
+    trie = TopicTrie()
+    (r_all, r_a, r_ab, r_abc, r_exact) = [Receiver() for _ in range(5)]
+    trie.add("*", r_all)
+    trie.add("a.*", r_a)
+    trie.add("a.b.*", r_ab)
+    trie.add("a.b.c.*", r_abc)
+    trie.add("a.b", r_exact)
+    trie.add("a.b.*", r_exact)
+
+    assert set(trie.match("a.b.c")) == {r_all, r_a, r_ab, r_abc, r_exact}
+    assert set(trie.match("a.b")) == {r_all, r_a, r_ab, r_exact}
+    assert set(trie.match("a")) == {r_all, r_a}
+    assert set(trie.match("x.y")) == {r_all}
+
+    trie.discard("*", r_all)
+    trie.discard("a.b.c.*", r_abc)
+    assert set(trie.match("a.b.c")) == {r_a, r_ab, r_exact}
+    assert "c" not in trie._root.children["a"].children["b"].children
+
+
+def test_topic_trie_rejects_invalid_patterns():
+    trie = TopicTrie()
+    for pattern in ["", "a..b", "a.*.b", "*.a"]:
+        with pytest.raises(ValueError):
+            trie.add(pattern, Receiver())
+
+
+@pytest.mark.asyncio
+async def test_message_hub_dispatch():
+    hub = MessageHub()
+    received = []
+    hub.add_listener("users.updated.*", lambda topic, data: received.append(data))
+    sub = hub.subscribe(["users.*", "users.updated.1"])
+
+    await hub._process_msg("users.updated.1", {"id": "1"})
+    assert received == [{"id": "1"}]
+    assert await sub.get() == ("users.updated.1", {"id": "1"})
+    assert sub.qsize() == 0
+
+    sub.close()
+    await hub._process_msg("users.updated.2", {"id": "2"})
+    assert received == [{"id": "1"}, {"id": "2"}]
+    assert sub.qsize() == 0
+
+
+@pytest.mark.asyncio
+async def test_subscription_overflow_policies():
+    hub = MessageHub(queue_size=2)
+    before = _hub_metrics()
+
+    drop = hub.subscribe("a.*")
+    coalesce = hub.subscribe("a.*", overflow=OverflowPolicy.COALESCE)
+    disconnect = hub.subscribe("a.*", overflow=OverflowPolicy.DISCONNECT)
+    for (topic, n) in [("a.1", 1), ("a.2", 2), ("a.1", 3), ("a.3", 4)]:
+        await hub._process_msg(topic, n)
+
+    assert [await drop.get(), await drop.get()] == [("a.1", 3), ("a.3", 4)]
+    assert drop.stats()["dropped"] == 2
+
+    assert [await coalesce.get(), await coalesce.get()] == [("a.2", 2), ("a.3", 4)]
+    assert coalesce.stats()["coalesced"] == 1
+    assert coalesce.stats()["dropped"] == 1
+
+    with pytest.raises(SubscriptionOverflow):
+        await disconnect.get()
+    assert disconnect not in hub._subscriptions
+
+    # 件数と待ち時間は /metrics にも出す
+    after = _hub_metrics()
+    changes = {event: after[event] - before.get(event, 0) for event in after}
+    assert changes == {
+        "delivered": 4,
+        "dropped": 6,
+        "coalesced": 1,
+        "disconnected": 1,
+        "lag": 4,
+    }
+
+
+def _hub_metrics():
+    snapshot = metrics.registry.snapshot()
+    counts = {
+        labels[0]: value
+        for (labels, value) in snapshot["planetsclub_msghub_messages_total"]
+    }
+    # ヒストグラムはバケットごとの件数と合計
+    counts["lag"] = sum(
+        sum(entry[:-1]) for (_, entry) in snapshot["planetsclub_msghub_lag_seconds"]
+    )
+    return counts
@@ -0,0 +1,77 @@
+import gzip
+import io
+import json
+import sys
+
+import pytest
+
+from planetsclub import settings
+from planetsclub.archives.models import ArchiveContentModel, ArchiveModel
+from planetsclub.archives.transfer import _open, export_documents, import_documents
+from planetsclub.services import services
+
+from .fakes import FakeElasticsearch
+
+
+@pytest.mark.asyncio
+async def test_export_and_import_roundtrip(monkeypatch, tmpdir):
+    es = FakeElasticsearch()
+    for i in range(25):
+        es.add("src", "a{:02d}".format(i), {"title": "タイトル{}".format(i), "n": i})
+    monkeypatch.setattr(services, "es", es)
+
+    path = str(tmpdir.join("archives.ndjson.gz"))
+    with _open(path, "w") as out:
+        assert await export_documents("src", out, batch_size=10) == 25
+    # point in time の上で読み、終わったら閉じる
+    assert es.searches == 3
+    assert not es.pits
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        assert len(f.readlines()) == 25
+
+    with _open(path, "r") as inp:
+        assert await import_documents("dst", inp, batch_size=10) == 25
+    assert es.bulk_requests == 3
+    assert es.indices["dst"] == es.indices["src"]
+
+    inp = io.StringIO('{"_id": "x", "_source": {}}\n\n{"_source": {"n": 1}}\n')
+    assert await import_documents("dst", inp) == 2
+
+
+@pytest.mark.asyncio
+async def test_transfer_with_split_contents(monkeypatch):
+    monkeypatch.setattr(settings, "ARCHIVE_CONTENT_STORE", "index")
+    es = FakeElasticsearch()
+    # prune で HTML を消したもの、まだ split していないもの
+    es.add(ArchiveModel.ES_INDEX, "a", {"title": "a", "body": "本文"})
+    es.add(ArchiveContentModel.ES_INDEX, "a", {"body": "本文", "html_content": "<p>"})
+    es.add(ArchiveModel.ES_INDEX, "b", {"title": "b", "html_content": "<b>"})
+    monkeypatch.setattr(services, "es", es)
+
+    out = io.StringIO()
+    assert await export_documents(ArchiveModel.ES_INDEX, out) == 2
+    docs = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [doc["_source"].get("html_content") for doc in docs] == ["<p>", "<b>"]
+
+    es = FakeElasticsearch()
+    monkeypatch.setattr(services, "es", es)
+    out.seek(0)
+    assert await import_documents(ArchiveModel.ES_INDEX, out) == 2
+    assert es.indices[ArchiveModel.ES_INDEX] == {
+        "a": {"title": "a", "body": "本文"},
+        "b": {"title": "b"},
+    }
+    assert es.indices[ArchiveContentModel.ES_INDEX] == {
+        "a": {"body": "本文", "html_content": "<p>"},
+        "b": {"html_content": "<b>"},
+    }
+
+
+def test_open_stdout_is_not_closed(monkeypatch):
+    buffer = io.BytesIO()
+    stdout = io.TextIOWrapper(buffer, encoding="ascii")
+    monkeypatch.setattr(sys, "stdout", stdout)
+    with _open("-", "w") as out:
+        out.write("宇宙\n")
+    assert not stdout.closed
+    assert buffer.getvalue() == "宇宙\n".encode("utf-8")
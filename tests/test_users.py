@@ -0,0 +1,116 @@
+from unittest import mock
+
+import pytest
+from starlette.authentication import AuthCredentials
+
+from planetsclub.services import services
+from planetsclub.services.elasticsearch import NotFoundError
+from planetsclub.users import models
+from planetsclub.users.base import UnauthenticatedUser
+from planetsclub.users.models import (
+    AuthenticationBackend,
+    SessionUser,
+    SessionVersions,
+    UserModel,
+    user_local_cache,
+)
+
+from .fakes import FakeElasticsearch, FakeRedis
+
+
+@pytest.fixture
+def backends(monkeypatch):
+    monkeypatch.setattr(services, "es", FakeElasticsearch())
+    monkeypatch.setattr(services, "redis_pool", FakeRedis())
+
+    async def emit(topic, data):
+        pass
+
+    monkeypatch.setattr(services.msghub, "emit", emit)
+    return (services.es, services.redis_pool)
+
+
+@pytest.mark.asyncio
+async def test_authentication_from_session_claims(backends):
+    versions = SessionVersions()
+    await versions.load()
+    backend = AuthenticationBackend(versions)
+    claims = {"sub": "123", "scope": ["authenticated"], "act": True, "adm": True}
+
+    (auth, user) = await backend.load({}, dict(claims, ver=0))
+    assert isinstance(user, SessionUser)
+    assert user.id == "123"
+    assert user.is_admin
+    assert auth.scopes == ["authenticated"]
+
+    (auth, user) = await backend.load({}, dict(claims, ver=0, act=False))
+    assert isinstance(user, UnauthenticatedUser)
+
+
+def test_session_versions_follow_broadcasts():
+    versions = SessionVersions()
+    versions._on_version_changed("users.version.1", {"id": "1", "version": 3})
+    versions._on_version_changed("users.version.1", {"id": "1", "version": 2})
+    assert versions.get("1") == 3
+    assert versions.get("2") == 0
+
+
+@pytest.mark.asyncio
+async def test_session_versions_survive_lost_hash(backends, monkeypatch):
+    (es, redis) = backends
+    es.add(UserModel.ES_INDEX, "1", {"real_name": "a", "is_admin": True})
+    es.add(UserModel.ES_INDEX, "2", {"real_name": "b"})
+    monkeypatch.setattr(models, "session_versions", SessionVersions())
+    claims = {"sub": "2", "scope": ["authenticated"], "act": True, "adm": True}
+
+    admin = SessionUser("1", AuthCredentials(["authenticated"]), True)
+    target = await UserModel.get_by_id("2", admin, AuthCredentials())
+    assert await target.change_admin_state(True)
+    assert await target.deactivate()
+    assert es.indices[UserModel.ES_INDEX]["2"]["session_version"] == 2
+
+    # ハッシュが失われても ES から作り直し、古いトークンは通さない
+    redis.data.clear()
+    versions = SessionVersions()
+    await versions.load()
+    assert versions.ready
+    assert versions.get("2") == 2
+    (auth, user) = await AuthenticationBackend(versions).load({}, dict(claims, ver=1))
+    assert isinstance(user, UnauthenticatedUser)
+
+    # 次に進める番号は文書にあるものより大きい
+    redis.data.clear()
+    target = await UserModel.get_by_id("2", admin, AuthCredentials())
+    assert await target.activate()
+    assert es.indices[UserModel.ES_INDEX]["2"]["session_version"] == 3
+
+    # 読めていなければクレームを信用せず ES を見る
+    es.indices[UserModel.ES_INDEX]["2"]["deactivated"] = True
+    user_local_cache.clear()
+    redis.data.clear()
+    backend = AuthenticationBackend(SessionVersions())
+    (auth, user) = await backend.load({}, dict(claims, ver=3))
+    assert isinstance(user, UnauthenticatedUser)
+
+
+@pytest.mark.asyncio
+async def test_update_broadcasts_only_profile_fields(monkeypatch):
+    es = FakeElasticsearch()
+    es.add(UserModel.ES_INDEX, "1", {"real_name": "a", "email": "a@example.com"})
+    monkeypatch.setattr(services, "es", es)
+    monkeypatch.setattr(services, "redis_pool", FakeRedis())
+    emitted = []
+
+    async def emit(topic, data):
+        emitted.append(data)
+
+    monkeypatch.setattr(services.msghub, "emit", emit)
+
+    user = UserModel("1")
+    await user._es_update({"real_name": "b"})
+    assert emitted == [{"id": "1", "data": {"real_name": "b", "updated_at": mock.ANY}}]
+
+    # 更新できなければ流さない
+    with pytest.raises(NotFoundError):
+        await UserModel("2")._es_update({"real_name": "c"})
+    assert len(emitted) == 1